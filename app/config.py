@@ -1,9 +1,106 @@
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict  # ✅ IMPORT CORRETTO
 
 class Settings(BaseSettings):
     scheduler_interval_minutes: int = 10
+    run_scheduler_in_api: bool = True       # False quando il polling gira in `python -m app.worker`
+    worker_heartbeat_seconds: int = 10
+    worker_heartbeat_timeout_seconds: int = 60
+    worker_metrics_port: int = 9108         # /metrics del worker dedicato (0 = disattivato)
     firebase_server_key: str | None = None
 
+    # 🔹 Notifiche push
+    notification_sender: str = "firebase"   # "firebase" oppure "fake" (locale, per test/offline)
+    notification_workers: int = 2
+    notification_queue_size: int = 10000
+    notification_batch_size: int = 100      # messaggi per chiamata send_each (max 500)
+    notification_batch_wait_seconds: float = 0.2
+    notification_max_retries: int = 3
+    notification_dedup_seconds: int = 600   # finestra anti-spam per (tratta, treno, evento)
+    notification_dedup_max_entries: int = 100_000
+
+    # 🔹 Stream eventi (SSE / WebSocket)
+    stream_heartbeat_seconds: float = 15.0
+    stream_retry_ms: int = 3000             # attesa suggerita ai client SSE prima di riconnettersi
+    stream_queue_size: int = 256            # eventi in attesa per client prima della disconnessione
+    stream_history_size: int = 10_000       # eventi tenuti in memoria per Last-Event-ID
+    stream_feed_poll_seconds: float = 2.0   # lettura cambi dal DB se lo scheduler gira nel worker
+    stream_feed_overlap_seconds: float = 300.0
+
+    # 🔹 Database
+    db_pool_size: int = 10                  # connessioni tenute aperte per engine (sync e async)
+    db_max_overflow: int = 20               # connessioni extra oltre pool_size nei picchi
+    db_pool_timeout: float = 30.0           # attesa massima di una connessione libera
+    db_pool_recycle: int = 1800             # secondi prima di riaprire una connessione (proxy/firewall)
+    db_batch_size: int = 500                # righe per istruzione di insert/upsert in blocco
+    bulk_import_max_rows: int = 10000       # righe accettate da POST /routes/bulk
+
+    # 🔹 Retention dello storico (0 = conserva per sempre)
+    retention_enabled: bool = True
+    retention_run_minutes: int = 60         # frequenza del compattatore
+    retention_raw_days: int = 7             # righe di trains → intervalli di stato
+    retention_interval_days: int = 90       # intervalli → riepiloghi giornalieri
+    retention_daily_days: int = 730         # riepiloghi giornalieri → eliminati
+    retention_notification_days: int = 30   # log notifiche → eliminati
+    retention_slice_hours: int = 24         # finestra di righe compattate per transazione
+
+    # 🔹 Statistiche di affidabilità (rollup per tratta/treno)
+    analytics_late_minutes: int = 5         # giornata "in ritardo" se il ritardo massimo lo raggiunge
+    analytics_fold_minutes: int = 60        # frequenza con cui le giornate chiuse entrano nei rollup
+
+    # 🔹 Client HTTP verso Viaggiatreno
+    viaggiatreno_base_url: str = "https://www.viaggiatreno.it/infomobilita/resteasy/viaggiatreno"
+    http_pool_connections: int = 4          # pool distinti (uno per host)
+    http_pool_maxsize: int = 32             # connessioni keep-alive per pool
+    http_connect_timeout: float = 3.05
+    http_read_timeout: float = 10.0
+    http_max_retries: int = 3               # retry su 5xx / timeout / errori di rete
+    http_backoff_base: float = 0.5          # secondi, raddoppia ad ogni tentativo
+    http_backoff_max: float = 8.0
+    upstream_mode: str = "live"             # "live", "record" (cattura su file) oppure "replay" (senza rete)
+    upstream_capture_path: str = "captures/upstream.jsonl.gz"
+    upstream_replay_speed: float = 1.0      # 1 = ritmo originale, 10 = 10x; 0 = sequenziale senza attese
+
+    # 🔹 Cache risposte upstream (secondi)
+    cache_max_bytes: int = 64 * 1024 * 1024  # memoria stimata dei valori in cache (record proiettati)
+    cache_stale_seconds: float = 60.0       # finestra stale-while-revalidate dopo la scadenza
+    cache_ttl_partenze: float = 30.0
+    cache_ttl_andamento_treno: float = 30.0
+    cache_ttl_autocompleta_stazione: float = 86400.0
+    cache_ttl_default: float = 30.0
+
+    # 🔹 Polling adattivo (prossimo controllo per singola risorsa)
+    adaptive_polling: bool = True
+    poll_tick_seconds: int = 30             # frequenza con cui si estraggono le risorse scadute
+    poll_min_seconds: int = 60              # treni in partenza/in viaggio o con ritardo in aumento
+    poll_max_seconds: int = 1800            # treni arrivati, cancellati o lontani
+    poll_max_per_tick: int = 5000           # budget di risorse upstream per tick (solo con adaptive_polling)
+
+    # 🔹 Polling concorrente verso Viaggiatreno
+    upstream_concurrency: int = 32          # richieste in volo contemporaneamente
+    upstream_per_host_limit: int = 16       # richieste in volo per singolo host
+    upstream_deadline_seconds: float = 15.0  # deadline per singola richiesta
+
+    # 🔹 Protezione di Viaggiatreno (condivisa da scheduler e API)
+    upstream_rate_limit: float = 20.0       # richieste/s, token bucket globale (0 = nessun limite)
+    upstream_rate_burst: int = 40           # richieste consentite a raffica prima di attendere
+    upstream_rate_max_wait: float = 10.0    # attesa massima di un token prima di considerare upstream non disponibile
+    breaker_failure_threshold: int = 5      # richieste fallite consecutive che aprono il circuito
+    breaker_reset_seconds: float = 30.0     # durata dell'apertura prima della richiesta di prova
+
+    # 🔹 Polling distribuito su più worker (lease su DB)
+    poll_shards: int = 16                   # stazioni di partenza ripartite per crc32(codice) % poll_shards
+    shard_lease_seconds: int = 60           # scadenza del lease se il poller smette di rinnovarlo
+
+    @model_validator(mode="after")
+    def _check_retention(self) -> "Settings":
+        # gli intervalli devono sopravvivere alle righe grezze da cui nascono, altrimenti
+        # compact_raw ricrea intervalli di giorni già riassunti (conflitto sui riepiloghi)
+        if self.retention_raw_days and self.retention_interval_days \
+                and self.retention_interval_days < self.retention_raw_days:
+            raise ValueError("retention_interval_days deve essere >= retention_raw_days (0 = conserva per sempre)")
+        return self
+
     model_config = SettingsConfigDict(
         env_file=".env",
         env_prefix="",
@@ -0,0 +1,127 @@
+# app/db/bulk.py
+
+from datetime import datetime
+from typing import Iterable
+from sqlalchemy import case, insert
+from sqlalchemy.orm import Session
+from ..config import settings
+from ..models import Train, TrainDay, TrainState
+
+
+def dialect_insert(db: Session):
+    """Restituisce il costrutto insert() del dialetto in uso (serve per ON CONFLICT)."""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Upsert non supportato per il dialetto {dialect}")
+    return insert
+
+
+def upsert(db: Session, model, rows: Iterable[dict], keys: list[str]) -> None:
+    """
+    INSERT ... ON CONFLICT (keys) DO UPDATE di più righe in un'unica istruzione.
+    Le colonne aggiornate sono tutte quelle presenti nelle righe tranne le chiavi.
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    stmt = dialect_insert(db)(model).values(rows)
+    updates = {c: stmt.excluded[c] for c in rows[0] if c not in keys}
+    db.execute(stmt.on_conflict_do_update(index_elements=keys, set_=updates))
+
+
+def greatest(new, current):
+    """Massimo tra due espressioni, portabile (SQLite non ha GREATEST)."""
+    return case((new > current, new), else_=current)
+
+
+def upsert_train_days(db: Session, rows: list[dict]) -> None:
+    """Upsert delle giornate di servizio: ritardo massimo e cancellazione si combinano con max."""
+    if not rows:
+        return
+    stmt = dialect_insert(db)(TrainDay).values(rows)
+    ex = stmt.excluded
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["route_id", "train_code", "day"],
+        set_={
+            "observations": TrainDay.observations + ex.observations,
+            "max_delay": greatest(ex.max_delay, TrainDay.max_delay),
+            "cancelled": greatest(ex.cancelled, TrainDay.cancelled),
+        },
+    ))
+
+
+class WriteBatch:
+    """
+    Accumula le scritture di un tick (storico treni, stato corrente, giornate di servizio)
+    e le esegue in blocco con poche istruzioni, a gruppi di batch_size righe.
+    Non esegue commit: la transazione resta del chiamante.
+    """
+
+    def __init__(self, db: Session, batch_size: int | None = None):
+        self.db = db
+        self.batch_size = batch_size or settings.db_batch_size
+        self.history: list[dict] = []
+        self.states: dict[tuple[int, str], dict] = {}
+        self.days: dict[tuple[int, str, object], dict] = {}
+        self.written = {"history": 0, "states": 0, "days": 0}
+
+    def __len__(self) -> int:
+        return len(self.history) + len(self.states) + len(self.days)
+
+    def add_train(self, route_id: int, train_code: str, status: str, delay: int, when: datetime) -> None:
+        """
+        Registra un cambio di stato: riga di storico, upsert dello stato corrente
+        e aggiornamento della giornata di servizio (per le statistiche di affidabilità).
+        """
+        row = {
+            "route_id": route_id,
+            "train_code": train_code,
+            "last_status": status,
+            "delay_minutes": delay,
+            "last_update": when,
+        }
+        self.history.append(row)
+        self.states[(route_id, train_code)] = row
+        self.add_day(route_id, train_code, status, delay, when)
+
+    def add_day(self, route_id: int, train_code: str, status: str, delay: int, when: datetime) -> None:
+        """Aggiorna la giornata di servizio (UTC) del treno: osservazioni, ritardo massimo, cancellazione."""
+        cancelled = 1 if status == "Cancellato" else 0
+        day_key = (route_id, train_code, when.date())
+        day = self.days.get(day_key)
+        if day is None:
+            self.days[day_key] = {
+                "route_id": route_id, "train_code": train_code, "day": when.date(),
+                "weekday": (when.weekday() + 1) % 7, "hour": when.hour,
+                "observations": 1, "max_delay": delay, "cancelled": cancelled,
+            }
+        else:
+            day["observations"] += 1
+            day["max_delay"] = max(day["max_delay"], delay)
+            day["cancelled"] = max(day["cancelled"], cancelled)
+        self._maybe_flush()
+
+    def _maybe_flush(self) -> None:
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def _chunks(self, rows: list[dict]):
+        for i in range(0, len(rows), self.batch_size):
+            yield rows[i:i + self.batch_size]
+
+    def flush(self) -> None:
+        for chunk in self._chunks(self.history):
+            self.db.execute(insert(Train), chunk)
+        for chunk in self._chunks(list(self.states.values())):
+            upsert(self.db, TrainState, chunk, keys=["route_id", "train_code"])
+        for chunk in self._chunks(list(self.days.values())):
+            upsert_train_days(self.db, chunk)
+
+        self.written["history"] += len(self.history)
+        self.written["states"] += len(self.states)
+        self.written["days"] += len(self.days)
+        self.history, self.states, self.days = [], {}, {}
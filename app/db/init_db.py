@@ -1,9 +1,32 @@
+from sqlalchemy import func, insert, select
+from .migrations import run_migrations
 from .session import engine
-from ..models import Base
+from ..models import Base, Train, TrainState
+
+def _backfill_train_states() -> None:
+    """
+    Popola train_states dall'ultimo record di ogni treno nello storico,
+    solo se la tabella è ancora vuota (primo avvio dopo l'introduzione).
+    """
+    with engine.begin() as conn:
+        if conn.execute(select(func.count()).select_from(TrainState)).scalar():
+            return
+        latest_ids = select(func.max(Train.id)).group_by(Train.route_id, Train.train_code)
+        cols = ["route_id", "train_code", "last_status", "delay_minutes", "last_update"]
+        result = conn.execute(
+            insert(TrainState).from_select(
+                cols,
+                select(*(getattr(Train, c) for c in cols)).where(Train.id.in_(latest_ids)),
+            )
+        )
+        if result.rowcount:
+            print(f"[INIT_DB] Stato corrente ricostruito per {result.rowcount} treni.")
 
 def init_db() -> None:
     print("[INIT_DB] Avvio creazione tabelle...")
     Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    _backfill_train_states()
     print("[INIT_DB] Tabelle create (se non esistevano).")
 
 if __name__ == "__main__":
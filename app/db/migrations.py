@@ -0,0 +1,120 @@
+# app/db/migrations.py
+
+from datetime import datetime
+from sqlalchemy import Column, DateTime, MetaData, String, Table, inspect, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+
+# Tabella di servizio: una riga per migrazione applicata
+_meta = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    _meta,
+    Column("version", String(64), primary_key=True),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+class Migration:
+    """
+    Modifica di schema idempotente, applicata una sola volta e registrata in schema_migrations.
+    statements: SQL per dialetto ("postgresql", "sqlite") oppure "*" per tutti.
+    concurrent=True: su Postgres gli statement girano in autocommit (CREATE INDEX CONCURRENTLY
+    non blocca le scritture sulle tabelle grandi, ma non può stare in una transazione).
+    unless: controllo sulla connessione; se vero gli statement vengono saltati (es. colonna
+    già creata da create_all su un database nuovo, dove SQLite non ha ADD COLUMN IF NOT EXISTS).
+    """
+
+    def __init__(
+        self, version: str, description: str, statements: dict[str, list[str]],
+        concurrent: bool = False, unless=None,
+    ):
+        self.version = version
+        self.description = description
+        self.statements = statements
+        self.concurrent = concurrent
+        self.unless = unless
+
+    def sql_for(self, dialect: str) -> list[str]:
+        return self.statements.get(dialect, self.statements.get("*", []))
+
+
+def _has_column(table: str, column: str):
+    return lambda conn: column in {c["name"] for c in inspect(conn).get_columns(table)}
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(
+        "0001_history_indexes",
+        "Indici composti per lo storico per tratta/treno e per i log notifiche",
+        {
+            "postgresql": [
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_trains_route_update "
+                "ON trains (route_id, last_update, id) INCLUDE (train_code, last_status, delay_minutes)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_trains_route_train_update "
+                "ON trains (route_id, train_code, last_update, id) INCLUDE (last_status, delay_minutes)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_notification_logs_route_train_event_sent "
+                "ON notification_logs (route_id, train_code, event_type, sent_at)",
+            ],
+            "*": [
+                "CREATE INDEX IF NOT EXISTS ix_trains_route_update ON trains (route_id, last_update, id)",
+                "CREATE INDEX IF NOT EXISTS ix_trains_route_train_update "
+                "ON trains (route_id, train_code, last_update, id)",
+                "CREATE INDEX IF NOT EXISTS ix_notification_logs_route_train_event_sent "
+                "ON notification_logs (route_id, train_code, event_type, sent_at)",
+            ],
+        },
+        concurrent=True,
+    ),
+    Migration(
+        "0002_train_days_folded",
+        "Le giornate chiuse restano in train_days (segnate come già sommate ai rollup)",
+        {"*": ["ALTER TABLE train_days ADD COLUMN folded INTEGER NOT NULL DEFAULT 0"]},
+        unless=_has_column("train_days", "folded"),
+    ),
+]
+
+
+def applied_versions(engine: Engine) -> set[str]:
+    _meta.create_all(bind=engine)
+    with engine.connect() as conn:
+        return set(conn.scalars(select(schema_migrations.c.version)))
+
+
+def run_migrations(engine: Engine) -> list[str]:
+    """Applica in ordine le migrazioni mancanti. Restituisce le versioni applicate ora."""
+    done = applied_versions(engine)
+    dialect = engine.dialect.name
+    applied = []
+    for m in MIGRATIONS:
+        if m.version in done:
+            continue
+        print(f"[MIGRATE] {m.version}: {m.description}")
+        if m.concurrent and dialect == "postgresql":
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                for sql in m.sql_for(dialect):
+                    conn.execute(text(sql))
+            with engine.begin() as conn:
+                _record(conn, m.version)
+        else:
+            with engine.begin() as conn:
+                if m.unless is None or not m.unless(conn):
+                    for sql in m.sql_for(dialect):
+                        conn.execute(text(sql))
+                _record(conn, m.version)
+        applied.append(m.version)
+    return applied
+
+
+def _record(conn, version: str) -> None:
+    try:
+        with conn.begin_nested():
+            conn.execute(schema_migrations.insert().values(version=version, applied_at=datetime.utcnow()))
+    except IntegrityError:
+        pass  # applicata in parallelo da un altro processo (gli statement sono idempotenti)
+
+
+if __name__ == "__main__":
+    from .session import engine
+
+    print(run_migrations(engine) or "[MIGRATE] Schema già aggiornato")
@@ -1,7 +1,12 @@
 import os
+from typing import AsyncIterator, Iterator
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
 from dotenv import load_dotenv
+from ..config import settings
+from ..services.metrics import instrument_engine
 
 load_dotenv()
 DB_USER = os.getenv("DB_USER")
@@ -10,9 +15,57 @@ DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT", "5432")
 DB_NAME = os.getenv("DB_NAME")
 
-DATABASE_URL = f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# DATABASE_URL esplicito (es. sqlite:///./trainwatcher.db per prove locali) ha la precedenza sulle DB_*
+DATABASE_URL = os.getenv("DATABASE_URL") or f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL non configurato (.env)")
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+
+def _async_url(url: str) -> str:
+    """Stesso database con il driver asincrono: asyncpg per Postgres, aiosqlite per SQLite."""
+    parsed = make_url(url)
+    driver = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}.get(parsed.get_backend_name())
+    if driver is None:
+        raise RuntimeError(f"Nessun driver asincrono noto per {parsed.drivername}: imposta ASYNC_DATABASE_URL")
+    return parsed.set(drivername=f"{parsed.get_backend_name()}+{driver}").render_as_string(hide_password=False)
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or _async_url(DATABASE_URL)
+
+
+def _pool_options(url: str) -> dict:
+    """Dimensionamento del pool (non applicabile a SQLite, che usa il pool predefinito del dialetto)."""
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+    }
+
+
+engine = create_engine(DATABASE_URL, pool_pre_ping=True, **_pool_options(DATABASE_URL))
+instrument_engine(engine)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+# Engine asincrono per gli endpoint di lettura dell'API: nessun thread occupato durante le query
+async_engine = create_async_engine(ASYNC_DATABASE_URL, pool_pre_ping=True, **_pool_options(ASYNC_DATABASE_URL))
+instrument_engine(async_engine.sync_engine)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+
+# ================================
+# 🔹 Dipendenze FastAPI
+# ================================
+def get_db() -> Iterator[Session]:
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_db() -> AsyncIterator[AsyncSession]:
+    async with AsyncSessionLocal() as db:
+        yield db
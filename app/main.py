@@ -1,13 +1,25 @@
 # app/main.py
 
-from fastapi import FastAPI
+import time
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
 from .db.init_db import init_db
+from .db.session import SessionLocal, async_engine
 from .config import settings
-from .routes import health, users, routes_api, trains, stations
+from .routes import analytics, health, users, routes_api, trains, stations, stream
 from .services.scheduler import start_scheduler
+from .services.cache import response_cache
+from .services.dedup import notification_window
+from .services.dispatch import current_dispatcher, get_dispatcher
+from .services.events import ChangeFeed, event_broker
+from .services import heartbeat
+from .services.heartbeat import list_workers
+from .services.sharding import release_leases
+from .services.metrics import HTTP_LATENCY
 
 from apscheduler.schedulers.background import BackgroundScheduler
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 # 🚆 Inizializzazione app FastAPI
 app = FastAPI(
@@ -26,28 +38,72 @@ app.add_middleware(
 )
 
 # 🔗 Registrazione router
+
+# 📈 Latenza delle richieste per route (etichetta = template del path, cardinalità limitata)
+@app.middleware("http")
+async def observe_latency(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_LATENCY.labels(
+            request.method, getattr(route, "path", "unmatched"), status
+        ).observe(time.perf_counter() - started)
+
+
 app.include_router(health.router, tags=["Health"])
 app.include_router(users.router, tags=["Users"])
 app.include_router(routes_api.router, tags=["Routes"])
 app.include_router(trains.router, tags=["Trains"])
 app.include_router(stations.router, tags=["Stations"])
+app.include_router(stream.router, tags=["Stream"])
+app.include_router(analytics.router, tags=["Analytics"])
 
-# 🔄 Variabile globale per lo scheduler
+# 🔄 Variabili globali per lo scheduler (o, se gira nel worker, per il feed dei cambi)
 scheduler: BackgroundScheduler | None = None
+change_feed: ChangeFeed | None = None
 
 
 # 🚀 Startup hooks
 @app.on_event("startup")
 def on_startup():
-    """Inizializza il DB e avvia lo scheduler periodico."""
-    global scheduler
+    """Inizializza il DB e avvia lo scheduler periodico (se non delegato al worker)."""
+    global scheduler, change_feed
     print("[INIT] Avvio TrainWatcher backend...")
     init_db()
-    scheduler = start_scheduler(settings.scheduler_interval_minutes)
-    print(f"[SCHEDULER] Intervallo: {settings.scheduler_interval_minutes} minuti")
+    if settings.run_scheduler_in_api:
+        with SessionLocal() as db:
+            notification_window.warm(db)
+        scheduler = start_scheduler(settings.scheduler_interval_minutes)
+        print(f"[SCHEDULER] Intervallo: {settings.scheduler_interval_minutes} minuti")
+    else:
+        change_feed = ChangeFeed(event_broker).start()
+        print("[SCHEDULER] Disattivato nell'API: il polling gira in `python -m app.worker`")
     print("[INIT] Backend pronto ✅")
 
 
+@app.on_event("shutdown")
+def on_shutdown():
+    """Ferma lo scheduler e svuota la coda delle notifiche prima di uscire."""
+    if scheduler:
+        scheduler.shutdown(wait=False)
+        get_dispatcher().stop()
+        release_leases()
+        heartbeat.clear()
+    if change_feed:
+        change_feed.stop()
+
+
+@app.on_event("shutdown")
+async def close_async_pool():
+    """Chiude le connessioni del pool asincrono."""
+    await async_engine.dispose()
+
+
 # 🏠 Endpoint di base
 @app.get("/", tags=["System"])
 def root():
@@ -64,20 +120,63 @@ def root():
 # 🕒 Endpoint diagnostico scheduler
 @app.get("/scheduler/status", tags=["System"])
 def scheduler_status():
-    """Restituisce lo stato dello scheduler (job, ultima e prossima esecuzione)."""
-    global scheduler
-    if not scheduler:
-        return {"status": "inactive", "message": "Scheduler non avviato"}
+    """
+    Restituisce lo stato dello scheduler: job locale (se gira nell'API) e
+    heartbeat di tutti i poller registrati nel DB (worker dedicati compresi).
+    """
+    with SessionLocal() as db:
+        workers = list_workers(db)
+    alive = [w for w in workers if w["alive"]]
 
-    jobs = scheduler.get_jobs()
-    if not jobs:
-        return {"status": "no-jobs", "message": "Nessun job registrato nello scheduler"}
+    local = None
+    if scheduler:
+        jobs = scheduler.get_jobs()
+        if jobs:
+            job = jobs[0]
+            local = {
+                "job_id": job.id,
+                "next_run_time": job.next_run_time,
+                "trigger": str(job.trigger),
+            }
 
-    job = jobs[0]
+    if not alive and not local:
+        return {
+            "status": "inactive",
+            "message": "Nessun poller attivo",
+            "in_api": settings.run_scheduler_in_api,
+            "workers": workers,
+        }
     return {
         "status": "active",
-        "job_id": job.id,
-        "next_run_time": job.next_run_time,
-        "trigger": str(job.trigger),
+        "in_api": settings.run_scheduler_in_api,
         "interval_minutes": settings.scheduler_interval_minutes,
+        "local_job": local,
+        "workers": workers,
     }
+
+
+# 🗄️ Endpoint diagnostico cache upstream
+@app.get("/cache/stats", tags=["System"])
+def cache_stats():
+    """Contatori della cache delle risposte Viaggiatreno (hit/miss/eviction, memoria occupata)."""
+    return response_cache.stats()
+
+
+# 📣 Endpoint diagnostico coda notifiche
+@app.get("/notifications/stats", tags=["System"])
+def notifications_stats():
+    """
+    Profondità della coda push, invii riusciti/falliti/ritentati e latenze di invio.
+    404 se in questo processo le notifiche non partono (polling nel worker dedicato).
+    """
+    dispatcher = current_dispatcher()
+    if dispatcher is None:
+        raise HTTPException(status_code=404, detail="Dispatcher notifiche non attivo in questo processo")
+    return dispatcher.stats()
+
+
+# 📈 Metriche in formato Prometheus
+@app.get("/metrics", tags=["System"], include_in_schema=False)
+def metrics():
+    """Metriche del processo API (e dello scheduler se gira nell'API) in formato testuale Prometheus."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -1,6 +1,6 @@
-from datetime import datetime
+from datetime import date, datetime
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import Integer, String, Boolean, ForeignKey, Text, DateTime
+from sqlalchemy import Integer, String, Boolean, ForeignKey, Text, DateTime, Date, Index
 
 class Base(DeclarativeBase):
     pass
@@ -25,6 +25,7 @@ class Route(Base):
 
     user: Mapped["User"] = relationship(back_populates="routes")
     trains: Mapped[list["Train"]] = relationship(back_populates="route", cascade="all, delete")
+    states: Mapped[list["TrainState"]] = relationship(cascade="all, delete")
 
 class Train(Base):
     __tablename__ = "trains"
@@ -37,8 +38,109 @@ class Train(Base):
 
     route: Mapped["Route"] = relationship(back_populates="trains")
 
+    # Indici creati anche per le tabelle esistenti da db/migrations.py (stessi nomi).
+    # Su Postgres includono le colonne lette dallo storico, così le pagine sono index-only.
+    __table_args__ = (
+        Index("ix_trains_route_update", "route_id", "last_update", "id",
+              postgresql_include=["train_code", "last_status", "delay_minutes"]),
+        Index("ix_trains_route_train_update", "route_id", "train_code", "last_update", "id",
+              postgresql_include=["last_status", "delay_minutes"]),
+    )
+
+class TrainState(Base):
+    """Stato corrente (ultimo noto) di ogni treno per tratta, aggiornato via upsert."""
+    __tablename__ = "train_states"
+    route_id: Mapped[int] = mapped_column(ForeignKey("routes.id", ondelete="CASCADE"), primary_key=True)
+    train_code: Mapped[str] = mapped_column(String(20), primary_key=True)
+    last_status: Mapped[str] = mapped_column(String(40))
+    delay_minutes: Mapped[int] = mapped_column(Integer, default=0)
+    last_update: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
 # app/models.py
 
+class TrainInterval(Base):
+    """
+    Storico compattato: periodo in cui un treno è rimasto nello stesso stato.
+    Prodotto dal compattatore (services/retention.py) dalle righe di trains più vecchie
+    di retention_raw_days; ended_at è l'inizio dello stato successivo (NULL se non ancora noto).
+    """
+    __tablename__ = "train_intervals"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    route_id: Mapped[int] = mapped_column(ForeignKey("routes.id", ondelete="CASCADE"))
+    train_code: Mapped[str] = mapped_column(String(20))
+    status: Mapped[str] = mapped_column(String(40))
+    delay_minutes: Mapped[int] = mapped_column(Integer, default=0)
+    started_at: Mapped[datetime] = mapped_column(DateTime)
+    ended_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_train_intervals_route_train_start", "route_id", "train_code", "started_at"),
+        Index("ix_train_intervals_started_at", "started_at"),
+    )
+
+
+class TrainDailySummary(Base):
+    """Riepilogo giornaliero per treno e tratta, ottenuto dagli intervalli più vecchi di retention_interval_days."""
+    __tablename__ = "train_daily_summaries"
+
+    route_id: Mapped[int] = mapped_column(ForeignKey("routes.id", ondelete="CASCADE"), primary_key=True)
+    train_code: Mapped[str] = mapped_column(String(20), primary_key=True)
+    day: Mapped[date] = mapped_column(Date, primary_key=True, index=True)
+    transitions: Mapped[int] = mapped_column(Integer, default=0)    # cambi di stato nel giorno
+    delay_sum: Mapped[int] = mapped_column(Integer, default=0)      # somma dei ritardi dei cambi (per la media)
+    max_delay: Mapped[int] = mapped_column(Integer, default=0)
+    cancellations: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class TrainDay(Base):
+    """
+    Giornata di servizio (UTC) di un treno su una tratta, aggiornata ad ogni cambio di stato
+    e alla prima osservazione del giorno: ritardo massimo e cancellazione. Alla chiusura del
+    giorno confluisce in delay_rollups (folded = 1) e resta qui come base per il ricalcolo,
+    fino a retention_daily_days.
+    weekday (0 = domenica) e hour sono quelli della prima osservazione del giorno.
+    """
+    __tablename__ = "train_days"
+
+    route_id: Mapped[int] = mapped_column(ForeignKey("routes.id", ondelete="CASCADE"), primary_key=True)
+    train_code: Mapped[str] = mapped_column(String(20), primary_key=True)
+    day: Mapped[date] = mapped_column(Date, primary_key=True, index=True)
+    weekday: Mapped[int] = mapped_column(Integer)
+    hour: Mapped[int] = mapped_column(Integer)
+    observations: Mapped[int] = mapped_column(Integer, default=1)
+    max_delay: Mapped[int] = mapped_column(Integer, default=0)
+    cancelled: Mapped[int] = mapped_column(Integer, default=0)     # 0/1
+    folded: Mapped[int] = mapped_column(Integer, default=0, server_default="0")  # 0/1: già nei rollup
+
+
+class DelayRollup(Base):
+    """
+    Affidabilità per treno, tratta, giorno della settimana e ora (UTC) della prima osservazione.
+    Contatori additivi sulle giornate chiuse: giorni osservati, in ritardo, cancellati e
+    istogramma del ritardo massimo giornaliero (bucket b0..b7, vedi services/analytics.py).
+    """
+    __tablename__ = "delay_rollups"
+
+    route_id: Mapped[int] = mapped_column(ForeignKey("routes.id", ondelete="CASCADE"), primary_key=True)
+    train_code: Mapped[str] = mapped_column(String(20), primary_key=True, index=True)
+    weekday: Mapped[int] = mapped_column(Integer, primary_key=True)
+    hour: Mapped[int] = mapped_column(Integer, primary_key=True)
+    days: Mapped[int] = mapped_column(Integer, default=0)
+    late_days: Mapped[int] = mapped_column(Integer, default=0)
+    cancelled_days: Mapped[int] = mapped_column(Integer, default=0)
+    delay_sum: Mapped[int] = mapped_column(Integer, default=0)
+    max_delay: Mapped[int] = mapped_column(Integer, default=0)
+    b0: Mapped[int] = mapped_column(Integer, default=0)
+    b1: Mapped[int] = mapped_column(Integer, default=0)
+    b2: Mapped[int] = mapped_column(Integer, default=0)
+    b3: Mapped[int] = mapped_column(Integer, default=0)
+    b4: Mapped[int] = mapped_column(Integer, default=0)
+    b5: Mapped[int] = mapped_column(Integer, default=0)
+    b6: Mapped[int] = mapped_column(Integer, default=0)
+    b7: Mapped[int] = mapped_column(Integer, default=0)
+
+
 class NotificationLog(Base):
     __tablename__ = "notification_logs"
 
@@ -48,6 +150,10 @@ class NotificationLog(Base):
     event_type: Mapped[str]
     sent_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_notification_logs_route_train_event_sent", "route_id", "train_code", "event_type", "sent_at"),
+    )
+
 
 class Station(Base):
     __tablename__ = "stations"
@@ -56,3 +162,26 @@ class Station(Base):
     name: Mapped[str] = mapped_column(String(120), unique=True, index=True)
     code: Mapped[str] = mapped_column(String(20), unique=True, index=True)
 
+
+class WorkerHeartbeat(Base):
+    """Battito dei processi poller (worker dedicati o scheduler dentro l'API), letto da /scheduler/status."""
+    __tablename__ = "worker_heartbeats"
+
+    worker_id: Mapped[str] = mapped_column(String(120), primary_key=True)
+    hostname: Mapped[str] = mapped_column(String(120))
+    pid: Mapped[int] = mapped_column(Integer)
+    mode: Mapped[str] = mapped_column(String(20))  # worker / api
+    started_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    last_beat: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    last_tick_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    last_tick: Mapped[str | None] = mapped_column(Text, nullable=True)  # statistiche JSON dell'ultimo tick
+
+
+class ShardLease(Base):
+    """Lease di uno shard di polling: un solo poller alla volta può possederlo fino a expires_at."""
+    __tablename__ = "shard_leases"
+
+    shard: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    owner: Mapped[str | None] = mapped_column(String(120), nullable=True)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    epoch: Mapped[int] = mapped_column(Integer, default=0)  # incrementato ad ogni cambio di proprietario
@@ -0,0 +1,40 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..db.session import get_async_db
+from ..models import DelayRollup, Route
+from ..services.analytics import reliability
+
+router = APIRouter(prefix="/analytics", tags=["analytics"])
+
+
+@router.get("/routes/{route_id}")
+async def route_reliability(route_id: int, db: AsyncSession = Depends(get_async_db)):
+    """
+    Affidabilità di una tratta: quota di giornate in ritardo, cancellazioni, percentili
+    del ritardo massimo giornaliero, suddivisi per giorno della settimana (0 = domenica),
+    ora UTC di prima osservazione e treno. Letta dai rollup precalcolati.
+    """
+    if await db.get(Route, route_id) is None:
+        raise HTTPException(status_code=404, detail="Route not found")
+    stats = await reliability(db, DelayRollup.route_id == route_id, DelayRollup.train_code)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="No closed days for this route yet")
+    trains = stats.pop("items")
+    return {"route_id": route_id, **stats, "trains": trains}
+
+
+@router.get("/trains/{train_code}")
+async def train_reliability(
+    train_code: str,
+    route_id: int | None = Query(None),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Affidabilità di un treno su tutte le tratte monitorate (o solo su route_id)."""
+    where = DelayRollup.train_code == train_code
+    if route_id is not None:
+        where = where & (DelayRollup.route_id == route_id)
+    stats = await reliability(db, where, DelayRollup.route_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="No closed days for this train yet")
+    routes = stats.pop("items")
+    return {"train_code": train_code, **stats, "routes": routes}
@@ -1,26 +1,115 @@
-from fastapi import APIRouter, Depends, HTTPException
+import base64
+import csv
+import math
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from ..db.session import SessionLocal
+from ..db.session import get_async_db, get_db
 from .. import schemas, models
-from ..services.viaggiatreno import get_station_code
+from ..config import settings
+from ..services.http_client import UpstreamUnavailable
+from ..services.route_import import import_routes, parse_rows
+from ..services.status_cache import status_cache
+from ..services.viaggiatreno import get_or_cache_station_code
 
 router = APIRouter(prefix="/routes", tags=["routes"])
 
-def get_db():
-    db = SessionLocal()
+@router.get("", response_model=list[schemas.RouteOut])
+async def list_routes(user_id: int, db: AsyncSession = Depends(get_async_db)):
+    result = await db.scalars(select(models.Route).where(models.Route.user_id == user_id))
+    return result.all()
+
+def _encode_cursor(source: str, last_update: datetime, row_id: int) -> str:
+    raw = f"{source}|{last_update.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple[str, tuple[datetime, int]]:
     try:
-        yield db
-    finally:
-        db.close()
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        source, ts, row_id = raw.split("|")
+        if source not in ("t", "i"):
+            raise ValueError(source)
+        return source, (datetime.fromisoformat(ts), int(row_id))
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Cursore non valido")
+
+
+async def _history_rows(db: AsyncSession, source: str, route_id: int, train_code, since, until, after, limit: int):
+    """Una pagina keyset di trains ("t") o di train_intervals ("i"), nelle colonne di TrainStatusOut."""
+    if source == "t":
+        M, at = models.Train, models.Train.last_update
+        stmt = select(M)
+    else:
+        M, at = models.TrainInterval, models.TrainInterval.started_at
+        stmt = select(
+            M.id, M.route_id, M.train_code, M.status.label("last_status"), M.delay_minutes, at.label("last_update")
+        )
+    stmt = stmt.where(M.route_id == route_id)
+    if train_code:
+        stmt = stmt.where(M.train_code == train_code)
+    if since:
+        stmt = stmt.where(at >= since)
+    if until:
+        stmt = stmt.where(at < until)
+    if after:
+        stmt = stmt.where(tuple_(at, M.id) < after)
+    stmt = stmt.order_by(at.desc(), M.id.desc()).limit(limit)
+    return (await (db.scalars(stmt) if source == "t" else db.execute(stmt))).all()
+
+
+@router.get("/{route_id}/history", response_model=schemas.TrainHistoryPage)
+async def route_history(
+    route_id: int,
+    train_code: str | None = None,
+    since: datetime | None = Query(None, description="Da (incluso), ISO 8601 UTC"),
+    until: datetime | None = Query(None, description="Fino a (escluso), ISO 8601 UTC"),
+    limit: int = Query(100, ge=1, le=500),
+    cursor: str | None = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Storico dei cambi di stato della tratta, dal più recente, a pagine.
+    Paginazione keyset su (last_update, id): ogni pagina è una scansione dell'indice
+    ix_trains_route_update (o ix_trains_route_train_update con train_code) a partire
+    dal cursore, a costo costante qualunque sia la profondità.
+    Oltre retention_raw_days le righe sono già compattate: la paginazione prosegue sugli
+    intervalli di train_intervals (uno per stato, inizio in last_update), tutti più vecchi
+    delle righe di trains. Oltre retention_interval_days restano solo i riepiloghi
+    giornalieri, che non fanno parte di questo storico.
+    """
+    source, after = _decode_cursor(cursor) if cursor else ("t", None)
+    rows: list[tuple[str, object]] = []
+    if source == "t":
+        rows = [("t", r) for r in await _history_rows(db, "t", route_id, train_code, since, until, after, limit + 1)]
+        after = None
+    if len(rows) <= limit:
+        # righe grezze esaurite: si continua con gli intervalli compattati
+        older = await _history_rows(db, "i", route_id, train_code, since, until, after, limit + 1 - len(rows))
+        rows += [("i", r) for r in older]
+
+    if not rows and not cursor and await db.get(models.Route, route_id) is None:
+        raise HTTPException(404, "Route non trovata")
+    next_cursor = None
+    if len(rows) > limit:
+        last_source, last = rows[limit - 1]
+        next_cursor = _encode_cursor(last_source, last.last_update, last.id)
+    return {"items": [r for _, r in rows[:limit]], "next_cursor": next_cursor}
 
-@router.get("", response_model=list[schemas.RouteOut])
-def list_routes(user_id: int, db: Session = Depends(get_db)):
-    return db.query(models.Route).filter(models.Route.user_id == user_id).all()
 
 @router.post("", response_model=schemas.RouteOut)
 def create_route(payload: schemas.RouteCreate, db: Session = Depends(get_db)):
-    dep_code = get_station_code(payload.departure_name)
-    arr_code = get_station_code(payload.arrival_name)
+    try:
+        dep_code = get_or_cache_station_code(payload.departure_name, db)
+        arr_code = get_or_cache_station_code(payload.arrival_name, db)
+    except UpstreamUnavailable as e:
+        raise HTTPException(
+            status_code=503, detail="Viaggiatreno non raggiungibile, riprova più tardi.",
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
     if not dep_code or not arr_code:
         raise HTTPException(status_code=400, detail="Stazione non trovata (controlla i nomi).")
     rt = models.Route(
@@ -37,6 +126,28 @@ def create_route(payload: schemas.RouteCreate, db: Session = Depends(get_db)):
     db.refresh(rt)
     return rt
 
+@router.post("/bulk")
+async def bulk_create_routes(
+    request: Request,
+    format: str | None = Query(None, pattern="^(csv|jsonl)$"),
+    user_id: int | None = Query(None, description="Utente delle righe senza user_id"),
+):
+    """
+    Import in blocco di tratte da JSON lines o CSV (formato dal parametro format
+    o dal Content-Type). Risponde in streaming NDJSON con l'esito di ogni riga.
+    Esempio CSV:
+        user_id,departure_name,arrival_name,train_number
+        1,Pinerolo,Torino Porta Susa,
+    """
+    fmt = format or ("csv" if "csv" in request.headers.get("content-type", "") else "jsonl")
+    try:
+        rows = parse_rows(await request.body(), fmt)
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise HTTPException(400, f"File non leggibile: {e}")
+    if len(rows) > settings.bulk_import_max_rows:
+        raise HTTPException(413, f"Massimo {settings.bulk_import_max_rows} righe per import")
+    return StreamingResponse(import_routes(rows, user_id), media_type="application/x-ndjson")
+
 @router.delete("/{route_id}")
 def delete_route(route_id: int, db: Session = Depends(get_db)):
     rt = db.query(models.Route).get(route_id)
@@ -44,4 +155,5 @@ def delete_route(route_id: int, db: Session = Depends(get_db)):
         raise HTTPException(404, "Route non trovata")
     db.delete(rt)
     db.commit()
+    status_cache.forget_route(route_id)
     return {"deleted": route_id}
@@ -1,25 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from ..db.session import SessionLocal
+from ..db.session import get_async_db, get_db
 from ..models import Station
+from ..services.station_directory import aensure_index, load_station_directory, station_index
 
 router = APIRouter(prefix="/stations", tags=["stations"])
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-
 @router.get("/")
-def list_stations(db: Session = Depends(get_db)):
+async def list_stations(db: AsyncSession = Depends(get_async_db)):
     """
     Restituisce la lista delle stazioni memorizzate in cache locale.
     """
-    stations = db.query(Station).order_by(Station.name.asc()).all()
+    stations = (await db.scalars(select(Station).order_by(Station.name.asc()))).all()
     if not stations:
         raise HTTPException(status_code=404, detail="No cached stations found")
     return [
@@ -28,6 +23,28 @@ def list_stations(db: Session = Depends(get_db)):
     ]
 
 
+@router.get("/search")
+async def search_stations(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(10, ge=1, le=50),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Ricerca locale per prefisso e fuzzy (accenti e abbreviazioni), senza chiamate a Viaggiatreno.
+    Esempio: /stations/search?q=P. Susa
+    """
+    return (await aensure_index(db)).search(q, limit=limit)
+
+
+@router.post("/load")
+def load_stations(db: Session = Depends(get_db)):
+    """
+    Scarica l'anagrafica completa delle stazioni da Viaggiatreno, popola la cache
+    locale e ricostruisce l'indice di ricerca.
+    """
+    return load_station_directory(db)
+
+
 @router.delete("/")
 def clear_stations_cache(db: Session = Depends(get_db)):
     """
@@ -36,4 +53,5 @@ def clear_stations_cache(db: Session = Depends(get_db)):
     """
     deleted = db.query(Station).delete()
     db.commit()
+    station_index.clear()
     return {"message": "Cache cleared", "deleted": deleted}
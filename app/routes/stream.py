@@ -0,0 +1,101 @@
+from fastapi import APIRouter, Header, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from ..config import settings
+from ..services.events import event_broker
+
+router = APIRouter(prefix="/stream", tags=["stream"])
+
+
+def _parse_filters(routes: str | None, trains: str | None) -> tuple[set[int], set[str]]:
+    route_ids = {int(r) for r in (routes or "").split(",") if r.strip().isdigit()}
+    train_codes = {t.strip() for t in (trains or "").split(",") if t.strip()}
+    return route_ids, train_codes
+
+
+def _parse_last_id(value: str | None) -> str | None:
+    return value.strip() or None if value else None
+
+
+# ✅ Endpoint: Server-Sent Events
+@router.get("/trains")
+async def stream_trains(
+    request: Request,
+    routes: str | None = Query(None, description="ID tratte separati da virgola"),
+    trains: str | None = Query(None, description="Numeri treno separati da virgola"),
+    last_event_id: str | None = Query(None),
+    last_event_id_header: str | None = Header(None, alias="Last-Event-ID"),
+):
+    """
+    Stream SSE dei cambi di stato rilevati dallo scheduler.
+    Senza filtri riceve tutti gli eventi. Alla riconnessione il browser invia
+    Last-Event-ID e vengono riprodotti gli eventi persi; se sono troppo vecchi o
+    emessi da un altro processo (riavvio, più istanze API) arriva un evento 'reset'
+    e il client deve rileggere /trains/status.
+    Esempio: /stream/trains?routes=12,15&trains=4659
+    """
+    route_ids, train_codes = _parse_filters(routes, trains)
+    sub, replay, reset = event_broker.subscribe(
+        route_ids, train_codes, _parse_last_id(last_event_id_header or last_event_id)
+    )
+
+    async def events():
+        try:
+            yield f"retry: {settings.stream_retry_ms}\n\n"
+            if reset:
+                yield f"id: {event_broker.last_id}\nevent: reset\ndata: {{}}\n\n"
+            for event in replay:
+                yield f"id: {event.id}\nevent: train_status\ndata: {event.to_json()}\n\n"
+            while not sub.overflow:
+                event = await sub.next(settings.stream_heartbeat_seconds)
+                if await request.is_disconnected():
+                    break
+                if event is None:
+                    yield ": ping\n\n"
+                else:
+                    yield f"id: {event.id}\nevent: train_status\ndata: {event.to_json()}\n\n"
+            if sub.overflow:
+                # client troppo lento: chiude lo stream chiedendo un riallineamento
+                yield f"id: {event_broker.last_id}\nevent: reset\ndata: {{}}\n\n"
+        finally:
+            sub.close()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# ✅ Endpoint: WebSocket
+@router.websocket("/ws")
+async def stream_ws(
+    websocket: WebSocket,
+    routes: str | None = None,
+    trains: str | None = None,
+    last_event_id: str | None = None,
+):
+    """
+    Stessi eventi dello stream SSE in formato JSON su WebSocket.
+    Messaggi: {"type": "train_status", ...}, {"type": "ping"}, {"type": "reset"}.
+    """
+    await websocket.accept()
+    route_ids, train_codes = _parse_filters(routes, trains)
+    sub, replay, reset = event_broker.subscribe(route_ids, train_codes, _parse_last_id(last_event_id))
+    try:
+        if reset:
+            await websocket.send_json({"type": "reset", "id": event_broker.last_id})
+        for event in replay:
+            await websocket.send_json({"type": "train_status", **event.to_dict()})
+        while not sub.overflow:
+            event = await sub.next(settings.stream_heartbeat_seconds)
+            if event is None:
+                await websocket.send_json({"type": "ping"})
+            else:
+                await websocket.send_json({"type": "train_status", **event.to_dict()})
+        if sub.overflow:
+            await websocket.send_json({"type": "reset", "id": event_broker.last_id})
+            await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sub.close()
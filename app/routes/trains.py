@@ -1,8 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+import json
+import math
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from ..db.session import SessionLocal
+from ..db.session import get_async_db, get_db
 from .. import models, schemas
-from ..models import Route, Train
+from ..models import Route, TrainState
+from ..db.bulk import WriteBatch
+from ..services.http_client import UpstreamUnavailable
+from ..services.state_store import load_states
+from ..services.status_cache import is_not_modified, make_validators, status_cache
 from ..services.viaggiatreno import (
     get_trains_for_route,
     get_or_cache_station_code,
@@ -11,58 +20,81 @@ from ..services.viaggiatreno import (
 router = APIRouter(prefix="/trains", tags=["trains"])
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+async def _resolve_route_id(db: AsyncSession, from_station: str, to_station: str) -> int | None:
+    """Risolve la tratta dai nomi, usando la cache per evitare le query ilike ad ogni polling."""
+    route_id = status_cache.route_id(from_station, to_station)
+    if route_id is not None:
+        # la tratta può essere stata eliminata (e ricreata) da un altro worker: verifica per PK
+        if await db.get(Route, route_id) is not None:
+            return route_id
+        status_cache.forget_route(route_id)
+    route_id = await db.scalar(
+        select(Route.id)
+        .where(Route.departure_name.ilike(from_station))
+        .where(Route.arrival_name.ilike(to_station))
+        .limit(1)
+    )
+    if route_id is None:
+        return None
+    status_cache.remember_route(from_station, to_station, route_id)
+    return route_id
 
 
 # ✅ Endpoint: stato treni formattato
 @router.get("/status")
-def get_trains_status(
+async def get_trains_status(
     from_station: str = Query(..., alias="from"),
     to_station: str = Query(..., alias="to"),
-    db: Session = Depends(get_db)
+    if_none_match: str | None = Header(None),
+    if_modified_since: str | None = Header(None),
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Restituisce lo stato formattato dei treni per una tratta specifica.
+    Supporta le richieste condizionali (ETag / Last-Modified → 304 Not Modified):
+    la versione della risposta è l'ultimo aggiornamento registrato per la tratta.
     """
-    route = (
-        db.query(Route)
-        .filter(Route.departure_name.ilike(from_station))
-        .filter(Route.arrival_name.ilike(to_station))
-        .first()
-    )
-
-    if not route:
+    route_id = await _resolve_route_id(db, from_station, to_station)
+    if route_id is None:
         raise HTTPException(status_code=404, detail="Route not found")
 
-    trains = (
-        db.query(Train)
-        .filter(Train.route_id == route.id)
-        .order_by(Train.last_update.desc())
-        .all()
+    version = await db.scalar(
+        select(func.max(TrainState.last_update)).where(TrainState.route_id == route_id)
     )
-
-    if not trains:
+    if version is None:
         raise HTTPException(status_code=404, detail="No train data for this route")
 
-    response = {
-        "route": f"{route.departure_name} → {route.arrival_name}",
-        "last_update": max(t.last_update for t in trains),
-        "trains": [
-            {
-                "code": t.train_code,
-                "status": t.last_status,
-                "delay_minutes": t.delay_minutes
-            }
-            for t in trains
-        ]
-    }
-
-    return response
+    etag, last_modified = make_validators(route_id, version)
+    headers = {"ETag": etag, "Last-Modified": last_modified, "Cache-Control": "no-cache"}
+    if is_not_modified(etag, version, if_none_match, if_modified_since):
+        return Response(status_code=304, headers=headers)
+
+    entry = status_cache.get(route_id, version)
+    if entry is None:
+        # solo lo stato corrente di ogni treno: lo storico completo è in /routes/{id}/history
+        route = await db.get(Route, route_id)
+        trains = (await db.scalars(
+            select(TrainState)
+            .where(TrainState.route_id == route_id)
+            .order_by(TrainState.last_update.desc())
+        )).all()
+
+        response = {
+            "route": f"{route.departure_name} → {route.arrival_name}",
+            "last_update": version,
+            "trains": [
+                {
+                    "code": t.train_code,
+                    "status": t.last_status,
+                    "delay_minutes": t.delay_minutes
+                }
+                for t in trains
+            ]
+        }
+        body = json.dumps(jsonable_encoder(response), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        entry = status_cache.put(route_id, version, body)
+
+    return Response(content=entry.body, media_type="application/json", headers=headers)
 
 
 # ✅ Endpoint: aggiornamento manuale
@@ -86,29 +118,39 @@ def manual_check(
     if not route:
         raise HTTPException(status_code=404, detail="Route not found")
 
-    # 🔹 Se la tratta non ha ancora codici, li risolviamo ora e li cacheiamo
-    if not route.departure_code or not route.arrival_code:
-        route.departure_code = get_or_cache_station_code(route.departure_name, db)
-        route.arrival_code = get_or_cache_station_code(route.arrival_name, db)
-        db.commit()
-
-    # 🔹 Interroga Viaggiatreno
-    trains_data = get_trains_for_route(route.departure_code, route.arrival_code)
+    try:
+        # 🔹 Se la tratta non ha ancora codici, li risolviamo ora e li cacheiamo
+        if not route.departure_code or not route.arrival_code:
+            route.departure_code = get_or_cache_station_code(route.departure_name, db)
+            route.arrival_code = get_or_cache_station_code(route.arrival_name, db)
+            db.commit()
+
+        # 🔹 Interroga Viaggiatreno (dato fresco: viene scritto come stato corrente)
+        trains_data = get_trains_for_route(route.departure_code, route.arrival_code, allow_stale=False)
+    except UpstreamUnavailable as e:
+        # upstream giù: nessuna scrittura, lo stato corrente dei treni resta valido
+        raise HTTPException(
+            status_code=503, detail=f"Viaggiatreno unavailable ({e.reason})",
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
 
     if not trains_data:
         raise HTTPException(status_code=404, detail="No train data found for this route")
 
-    # 🔹 Aggiorna/Inserisce nel DB
+    # 🔹 Scrive (storico + stato corrente) solo i treni il cui stato è cambiato
     from datetime import datetime
+    states = load_states(db, [route.id])
+    batch = WriteBatch(db)
+    now = datetime.utcnow()
+    changed = 0
     for train in trains_data:
-        record = Train(
-            route_id=route.id,
-            train_code=train["train_code"],
-            last_status=train["status"],
-            delay_minutes=train["delay"],
-            last_update=datetime.utcnow(),
-        )
-        db.add(record)
+        if states.get((route.id, train["train_code"])) == (train["status"], train["delay"]):
+            continue
+        batch.add_train(route.id, train["train_code"], train["status"], train["delay"], now)
+        changed += 1
 
+    batch.flush()
     db.commit()
-    return {"message": "Route refreshed successfully", "count": len(trains_data)}
+    if changed:
+        status_cache.invalidate(route.id)
+    return {"message": "Route refreshed successfully", "count": len(trains_data), "changed": changed}
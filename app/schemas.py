@@ -42,6 +42,10 @@ class TrainStatusOut(BaseModel):
     class Config:
         from_attributes = True
 
+class TrainHistoryPage(BaseModel):
+    items: List[TrainStatusOut]
+    next_cursor: Optional[str] = None   # da passare come ?cursor= per la pagina successiva
+
 class NotifyTestIn(BaseModel):
     user_id: int
     title: str
@@ -0,0 +1,173 @@
+# app/services/adaptive.py
+
+import heapq
+import itertools
+import threading
+import time
+from typing import TYPE_CHECKING, Hashable
+from ..config import settings
+
+if TYPE_CHECKING:
+    from .viaggiatreno import TrainRecord
+
+# Chiave di una risorsa upstream: ("board", codice_stazione) oppure ("train", (codice_stazione, numero))
+PollKey = tuple[str, Hashable]
+
+
+class PollPlanner:
+    """
+    Coda a priorità delle risorse da interrogare, ciascuna con il proprio prossimo controllo.
+    Heap con invalidazione pigra: _due è la fonte di verità, le voci dell'heap
+    non più allineate vengono scartate all'estrazione.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[float, int, PollKey]] = []
+        self._due: dict[PollKey, float] = {}
+        self._last_delay: dict[PollKey, int] = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def _push(self, key: PollKey, due: float) -> None:
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, next(self._seq), key))
+
+    def sync(self, keys: set[PollKey], now: float | None = None) -> None:
+        """Allinea la coda alle risorse attive: le nuove sono subito dovute, le sparite vengono rimosse."""
+        now = now or time.time()
+        with self._lock:
+            for key in keys - self._due.keys():
+                self._push(key, now)
+            for key in self._due.keys() - keys:
+                del self._due[key]
+                self._last_delay.pop(key, None)
+            if len(self._heap) > 4 * len(self._due) + 64:
+                self._heap = [(d, s, k) for d, s, k in self._heap if self._due.get(k) == d]
+                heapq.heapify(self._heap)
+
+    def pop_due(self, now: float | None = None, limit: int | None = None) -> list[PollKey]:
+        """
+        Estrae le risorse scadute, dalla più in ritardo, fino a limit (poll_max_per_tick
+        solo con adaptive_polling: senza, ogni tick interroga tutte le risorse come prima).
+        Ogni risorsa estratta viene riprogrammata provvisoriamente a now + poll_min_seconds,
+        così non va persa se il tick fallisce prima di reschedule().
+        """
+        now = now or time.time()
+        limit = limit or (settings.poll_max_per_tick if settings.adaptive_polling else len(self._due))
+        due: list[PollKey] = []
+        with self._lock:
+            while self._heap and len(due) < limit and self._heap[0][0] <= now:
+                when, _, key = heapq.heappop(self._heap)
+                if self._due.get(key) != when:
+                    continue
+                due.append(key)
+            for key in due:
+                self._push(key, now + settings.poll_min_seconds)
+        return due
+
+    def reschedule(self, key: PollKey, interval: float, now: float | None = None) -> None:
+        now = now or time.time()
+        with self._lock:
+            if key in self._due:
+                self._push(key, now + interval)
+
+    def next_due(self) -> float | None:
+        with self._lock:
+            return min(self._due.values()) if self._due else None
+
+    def delay_trend(self, key: PollKey, delay: int | None) -> int:
+        """Variazione del ritardo rispetto all'osservazione precedente della stessa risorsa."""
+        with self._lock:
+            previous = self._last_delay.get(key)
+            if delay is None:
+                self._last_delay.pop(key, None)
+                return 0
+            self._last_delay[key] = delay
+        return 0 if previous is None else delay - previous
+
+
+# ================================
+# 🔹 Politica degli intervalli
+# ================================
+def _bounded(seconds: float) -> float:
+    return max(settings.poll_min_seconds, min(settings.poll_max_seconds, seconds))
+
+
+def interval_for(minutes_to_departure: float | None, finished: bool, trend: int) -> float:
+    """
+    Intervallo fino al prossimo controllo:
+    - treno arrivato o cancellato → intervallo massimo;
+    - in viaggio o in partenza entro 15 minuti → intervallo minimo;
+    - più lontano nel tempo → intervallo crescente;
+    - ritardo in aumento → intervallo dimezzato.
+    Con adaptive_polling disattivato la risorsa è di nuovo dovuta al tick successivo.
+    """
+    if not settings.adaptive_polling:
+        return 0
+    if finished:
+        return settings.poll_max_seconds
+    if minutes_to_departure is None:
+        seconds = settings.scheduler_interval_minutes * 60
+    elif minutes_to_departure <= 15:
+        seconds = settings.poll_min_seconds
+    elif minutes_to_departure <= 60:
+        seconds = settings.poll_min_seconds * 3
+    elif minutes_to_departure <= 180:
+        seconds = settings.poll_min_seconds * 10
+    else:
+        seconds = settings.poll_max_seconds
+    if trend > 0:
+        seconds /= 2
+    return _bounded(seconds)
+
+
+def unavailable_interval() -> float:
+    """Risorsa non raggiungibile: si riprova alla chiusura prevista del circuito, non prima."""
+    if not settings.adaptive_polling:
+        return 0
+    return _bounded(settings.breaker_reset_seconds)
+
+
+def _minutes_until(epoch_ms, delay: int, now: float) -> float | None:
+    if not epoch_ms:
+        return None
+    return (epoch_ms / 1000 + delay * 60 - now) / 60
+
+
+def board_interval(planner: PollPlanner, key: PollKey, relevant: list["TrainRecord"], now: float | None = None) -> float:
+    """Intervallo per un tabellone partenze, guidato dal treno rilevante più imminente."""
+    now = now or time.time()
+    if not relevant:
+        planner.delay_trend(key, None)
+        return interval_for(None, False, 0)
+    upcoming = []
+    for tr in relevant:
+        if tr.cancelled:
+            continue
+        minutes = _minutes_until(tr.departure_ms, tr.delay, now)
+        if minutes is not None:
+            upcoming.append(max(minutes, 0))
+    trend = planner.delay_trend(key, max(tr.delay for tr in relevant))
+    if not upcoming:
+        return interval_for(None, all(tr.cancelled for tr in relevant), trend)
+    return interval_for(min(upcoming), False, trend)
+
+
+def train_interval(planner: PollPlanner, key: PollKey, data: "TrainRecord | None", now: float | None = None) -> float:
+    """Intervallo per un singolo treno (andamentoTreno), in base a partenza, arrivo e ritardo."""
+    now = now or time.time()
+    if not data:
+        return interval_for(None, False, 0)
+    delay = data.delay
+    arrival = _minutes_until(data.arrival_ms, delay, now)
+    finished = data.cancelled or data.arrived or (arrival is not None and arrival < -5)
+    departure = _minutes_until(data.departure_ms, delay, now)
+    trend = planner.delay_trend(key, delay)
+    return interval_for(max(departure, 0) if departure is not None else None, finished, trend)
+
+
+# Istanza condivisa del processo
+poll_planner = PollPlanner()
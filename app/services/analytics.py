@@ -0,0 +1,283 @@
+# app/services/analytics.py
+
+import threading
+from datetime import date, datetime
+from sqlalchemy import Integer, and_, case, cast, delete, exists, extract, func, insert, select, tuple_, union_all, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from ..config import settings
+from ..db.bulk import dialect_insert, greatest
+from ..db.session import SessionLocal
+from ..models import DelayRollup, Train, TrainDay, TrainInterval
+from .sharding import lease_manager
+
+# Limite inferiore (minuti) di ciascun bucket dell'istogramma b0..b7:
+# 0 | 1-4 | 5-9 | 10-14 | 15-29 | 30-59 | 60-119 | 120+
+BUCKET_BOUNDS = (0, 1, 5, 10, 15, 30, 60, 120)
+BUCKETS = [f"b{i}" for i in range(len(BUCKET_BOUNDS))]
+_ADDITIVE = ["days", "late_days", "cancelled_days", "delay_sum", *BUCKETS]
+_ROLLUP_KEY = ["route_id", "train_code", "weekday", "hour"]
+
+
+def _bucket_sums(delay) -> list:
+    sums = []
+    for i, lo in enumerate(BUCKET_BOUNDS):
+        hi = BUCKET_BOUNDS[i + 1] if i + 1 < len(BUCKET_BOUNDS) else None
+        cond = delay >= lo if hi is None else and_(delay >= lo, delay < hi)
+        sums.append(func.sum(case((cond, 1), else_=0)))
+    return sums
+
+
+def _rollup_select(days, where=None):
+    """Aggregazione set-based di giornate (colonne di train_days) in righe di delay_rollups."""
+    stmt = select(
+        days.c.route_id, days.c.train_code, days.c.weekday, days.c.hour,
+        func.count(),
+        func.sum(case((days.c.max_delay >= settings.analytics_late_minutes, 1), else_=0)),
+        func.sum(days.c.cancelled),
+        func.sum(days.c.max_delay),
+        func.max(days.c.max_delay),
+        *_bucket_sums(days.c.max_delay),
+    )
+    if where is not None:
+        stmt = stmt.where(where)
+    return stmt.group_by(days.c.route_id, days.c.train_code, days.c.weekday, days.c.hour)
+
+
+def _add_to_rollups(db: Session, source) -> int:
+    """INSERT ... SELECT con somma dei contatori sulle righe già presenti."""
+    stmt = dialect_insert(db)(DelayRollup).from_select(
+        [*_ROLLUP_KEY, "days", "late_days", "cancelled_days", "delay_sum", "max_delay", *BUCKETS], source
+    )
+    ex = stmt.excluded
+    set_ = {c: getattr(DelayRollup, c) + getattr(ex, c) for c in _ADDITIVE}
+    set_["max_delay"] = greatest(ex.max_delay, DelayRollup.max_delay)
+    return db.execute(stmt.on_conflict_do_update(index_elements=_ROLLUP_KEY, set_=set_)).rowcount
+
+
+# ================================
+# 🔹 Aggiornamento incrementale
+# ================================
+class DayTracker:
+    """
+    Ricorda quali treni sono già stati visti nella giornata UTC corrente, così un treno
+    il cui stato non cambia da giorni produce comunque una riga in train_days (una al giorno).
+    Un treno va segnato con mark() solo dopo il commit del tick che ha scritto la giornata:
+    se il tick viene annullato, il tick successivo la riscrive.
+    Solo memoria di processo: dopo un riavvio la giornata viene ritoccata, l'upsert la combina.
+    """
+
+    def __init__(self):
+        self._day: date | None = None
+        self._seen: set[tuple[int, str]] = set()
+        self._lock = threading.Lock()
+
+    def first_sighting(self, key: tuple[int, str], day: date) -> bool:
+        with self._lock:
+            return day != self._day or key not in self._seen
+
+    def mark(self, sightings: list[tuple[tuple[int, str], date]]) -> None:
+        with self._lock:
+            for key, day in sightings:
+                if self._day is None or day > self._day:
+                    self._day, self._seen = day, set()
+                if day == self._day:
+                    self._seen.add(key)
+
+
+# Istanza condivisa del processo
+day_tracker = DayTracker()
+
+
+def fold_closed_days(db: Session, today: date | None = None) -> int:
+    """
+    Somma ai rollup le giornate chiuse (precedenti a today, UTC) non ancora sommate e le segna
+    con folded = 1. Le giornate vengono aggiornate dal WriteBatch ad ogni cambio di stato;
+    qui confluiscono una volta sola, quando il loro ritardo massimo non può più cambiare.
+    Le chiavi delle giornate chiuse vengono lette (e bloccate) una volta sola: aggregazione
+    e marcatura usano esattamente quell'insieme, a blocchi di db_batch_size, così una
+    giornata scritta in ritardo da un tick concorrente non viene persa né contata due volte.
+    """
+    today = today or datetime.utcnow().date()
+    days = TrainDay.__table__
+    key = tuple_(days.c.route_id, days.c.train_code, days.c.day)
+    closed = [tuple(k) for k in db.execute(
+        select(days.c.route_id, days.c.train_code, days.c.day)
+        .where(days.c.day < today, days.c.folded == 0)
+        .with_for_update()
+    )]
+    for i in range(0, len(closed), settings.db_batch_size):
+        chunk = closed[i:i + settings.db_batch_size]
+        _add_to_rollups(db, _rollup_select(days, key.in_(chunk)))
+        db.execute(update(days).where(key.in_(chunk)).values(folded=1))
+    db.commit()
+    return len(closed)
+
+
+def analytics_job() -> None:
+    """Job dello scheduler: eseguito solo dal poller che possiede lo shard 0."""
+    if 0 not in lease_manager.owned:
+        return
+    db = SessionLocal()
+    try:
+        folded = fold_closed_days(db)
+        if folded:
+            print(f"[ANALYTICS] {folded} giornate aggiunte ai rollup")
+    except Exception as e:
+        db.rollback()
+        print(f"[ANALYTICS] error: {e}")
+    finally:
+        db.close()
+
+
+# ================================
+# 🔹 Ricalcolo completo
+# ================================
+def _weekday_hour(db: Session, col):
+    if db.get_bind().dialect.name == "sqlite":
+        return cast(func.strftime("%w", col), Integer), cast(func.strftime("%H", col), Integer)
+    return cast(extract("dow", col), Integer), cast(extract("hour", col), Integer)
+
+
+def recompute(db: Session, today: date | None = None) -> dict:
+    """
+    Ricostruisce i rollup da train_days, che contiene ogni giornata osservata (anche quelle
+    senza cambi di stato, che non finiscono nello storico), con poche istruzioni set-based
+    in un'unica transazione. Le giornate presenti solo nello storico conservato (righe di
+    trains più intervalli compattati, es. precedenti all'introduzione di train_days)
+    vengono prima aggiunte a train_days; quelle già presenti non vengono toccate.
+    I periodi già ridotti a riepiloghi giornalieri non hanno l'ora e non vengono ricontati.
+    """
+    today = today or datetime.utcnow().date()
+    observations = union_all(
+        select(
+            Train.route_id, Train.train_code, Train.last_update.label("at"), Train.delay_minutes.label("delay"),
+            case((Train.last_status == "Cancellato", 1), else_=0).label("cancelled"),
+        ),
+        select(
+            TrainInterval.route_id, TrainInterval.train_code, TrainInterval.started_at, TrainInterval.delay_minutes,
+            case((TrainInterval.status == "Cancellato", 1), else_=0),
+        ),
+    ).subquery()
+    day = func.date(observations.c.at)
+    per_day = (
+        select(
+            observations.c.route_id, observations.c.train_code, day.label("day"),
+            func.min(observations.c.at).label("first_at"),
+            func.count().label("observations"),
+            func.max(observations.c.delay).label("max_delay"),
+            func.max(observations.c.cancelled).label("cancelled"),
+        )
+        .group_by(observations.c.route_id, observations.c.train_code, day)
+        .subquery()
+    )
+    weekday, hour = _weekday_hour(db, per_day.c.first_at)
+    known = select(TrainDay.day).where(
+        TrainDay.route_id == per_day.c.route_id,
+        TrainDay.train_code == per_day.c.train_code,
+        TrainDay.day == per_day.c.day,
+    )
+    restored = db.execute(
+        insert(TrainDay).from_select(
+            ["route_id", "train_code", "day", "weekday", "hour", "observations", "max_delay", "cancelled"],
+            select(
+                per_day.c.route_id, per_day.c.train_code, per_day.c.day, weekday, hour,
+                per_day.c.observations, per_day.c.max_delay, per_day.c.cancelled,
+            ).where(~exists(known)),
+        )
+    ).rowcount
+
+    days = TrainDay.__table__
+    db.execute(delete(DelayRollup))
+    rollups = _add_to_rollups(db, _rollup_select(days, days.c.day < today))
+    db.execute(update(days).values(folded=case((days.c.day < today, 1), else_=0)))
+    open_days = db.scalar(select(func.count()).select_from(days).where(days.c.day >= today))
+    db.commit()
+    return {"rollup_rows": rollups, "restored_days": restored, "open_days": open_days}
+
+
+# ================================
+# 🔹 Lettura
+# ================================
+def _percentile(hist: list[int], total: int, max_delay: int, p: float) -> int | None:
+    """Percentile del ritardo massimo giornaliero, interpolato linearmente dentro il bucket."""
+    if not total:
+        return None
+    target = p * total
+    cumulative = 0
+    for i, count in enumerate(hist):
+        if count and cumulative + count >= target:
+            lo = BUCKET_BOUNDS[i]
+            hi = BUCKET_BOUNDS[i + 1] if i + 1 < len(BUCKET_BOUNDS) else max(max_delay, lo)
+            if i == 0:
+                return 0
+            return round(lo + (target - cumulative) / count * (min(hi, max_delay) - lo))
+        cumulative += count
+    return max_delay
+
+
+def _summary(row) -> dict:
+    hist = [int(getattr(row, b) or 0) for b in BUCKETS]
+    days = int(row.days or 0)
+    max_delay = int(row.max_delay or 0)
+    return {
+        "days": days,
+        "late_rate": round(row.late_days / days, 3) if days else None,
+        "cancellation_rate": round(row.cancelled_days / days, 3) if days else None,
+        "avg_max_delay": round(row.delay_sum / days, 1) if days else None,
+        "p50_delay": _percentile(hist, days, max_delay, 0.5),
+        "p90_delay": _percentile(hist, days, max_delay, 0.9),
+        "max_delay": max_delay,
+        "histogram": dict(zip(_bucket_labels(), hist)),
+    }
+
+
+def _bucket_labels() -> list[str]:
+    labels = []
+    for i, lo in enumerate(BUCKET_BOUNDS):
+        hi = BUCKET_BOUNDS[i + 1] - 1 if i + 1 < len(BUCKET_BOUNDS) else None
+        labels.append(str(lo) if lo == hi else f"{lo}-{hi}" if hi is not None else f"{lo}+")
+    return labels
+
+
+def _totals(*group_by):
+    R = DelayRollup
+    return select(
+        *group_by,
+        func.sum(R.days).label("days"),
+        func.sum(R.late_days).label("late_days"),
+        func.sum(R.cancelled_days).label("cancelled_days"),
+        func.sum(R.delay_sum).label("delay_sum"),
+        func.max(R.max_delay).label("max_delay"),
+        *(func.sum(getattr(R, b)).label(b) for b in BUCKETS),
+    )
+
+
+async def reliability(db: AsyncSession, where, breakdown) -> dict | None:
+    """
+    Statistiche dai rollup filtrati da `where`: totale, per giorno della settimana, per ora
+    e per `breakdown` (treno o tratta). Poche righe per treno: il costo non dipende dallo storico.
+    """
+    overall = (await db.execute(_totals().where(where))).one()
+    if not overall.days:
+        return None
+    by_weekday = (await db.execute(
+        _totals(DelayRollup.weekday).where(where).group_by(DelayRollup.weekday).order_by(DelayRollup.weekday)
+    )).all()
+    by_hour = (await db.execute(
+        _totals(DelayRollup.hour).where(where).group_by(DelayRollup.hour).order_by(DelayRollup.hour)
+    )).all()
+    by_item = (await db.execute(_totals(breakdown).where(where).group_by(breakdown).order_by(breakdown))).all()
+    return {
+        "closed_before": datetime.utcnow().date().isoformat(),   # la giornata UTC in corso non è ancora nei rollup
+        "late_threshold_minutes": settings.analytics_late_minutes,
+        "overall": _summary(overall),
+        "by_weekday": [{"weekday": r.weekday, **_summary(r)} for r in by_weekday],
+        "by_hour_utc": [{"hour": r.hour, **_summary(r)} for r in by_hour],
+        "items": [{breakdown.key: getattr(r, breakdown.key), **_summary(r)} for r in by_item],
+    }
+
+
+if __name__ == "__main__":
+    with SessionLocal() as session:
+        print(recompute(session))
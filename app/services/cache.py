@@ -0,0 +1,259 @@
+# app/services/cache.py
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable
+from ..config import settings
+from .metrics import collector
+
+# Un loader restituisce (valore, memoria stimata del valore in byte) oppure solleva un'eccezione:
+# gli errori non vengono mai messi in cache.
+Loader = Callable[[], tuple[Any, int]]
+AsyncLoader = Callable[[], Awaitable[tuple[Any, int]]]
+
+
+def ttl_for(key: str) -> float:
+    """TTL della risorsa upstream, dedotto dal primo segmento della chiave (es. 'partenze/S00035')."""
+    resource = key.split("/", 1)[0]
+    return {
+        "partenze": settings.cache_ttl_partenze,
+        "andamentoTreno": settings.cache_ttl_andamento_treno,
+        "autocompletaStazione": settings.cache_ttl_autocompleta_stazione,
+    }.get(resource, settings.cache_ttl_default)
+
+
+class _Entry:
+    __slots__ = ("value", "size", "fresh_until", "stale_until")
+
+    def __init__(self, value: Any, size: int, fresh_until: float, stale_until: float):
+        self.value = value
+        self.size = size
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+
+
+class _Flight:
+    """Caricamento in corso per una chiave: i chiamanti concorrenti attendono questo invece di andare upstream."""
+    __slots__ = ("event", "waiters", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self.value: Any = None
+        self.error: BaseException | None = None
+
+
+def _wake(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+
+class ResponseCache:
+    """
+    Cache in-process delle risposte upstream, indicizzata per risorsa.
+    - TTL per tipo di risorsa (vedi ttl_for) più una finestra stale-while-revalidate:
+      una voce scaduta da poco viene servita subito e aggiornata in background;
+    - eviction LRU oltre il tetto di memoria (dimensione stimata dei valori tenuti in cache,
+      cioè i record proiettati, non il body upstream);
+    - single-flight: miss concorrenti sulla stessa chiave generano una sola chiamata,
+      sia da thread sincroni (API) sia da task asincroni (scheduler).
+    """
+
+    def __init__(self, max_bytes: int | None = None, stale_seconds: float | None = None):
+        self.max_bytes = max_bytes if max_bytes is not None else settings.cache_max_bytes
+        self.stale_seconds = stale_seconds if stale_seconds is not None else settings.cache_stale_seconds
+        self._data: OrderedDict[str, _Entry] = OrderedDict()
+        self._inflight: dict[str, _Flight] = {}
+        self._refreshing: set[str] = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cache-refresh")
+        self.bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.evictions = 0
+        self.refreshes = 0
+
+    # ================================
+    # 🔹 Operazioni di base
+    # ================================
+    def _lookup(self, key: str, now: float) -> tuple[str, Any]:
+        """Da chiamare con il lock acquisito. Restituisce ('fresh'|'stale'|'miss', valore)."""
+        entry = self._data.get(key)
+        if entry is None:
+            return "miss", None
+        if now >= entry.stale_until:
+            self._drop(key)
+            return "miss", None
+        self._data.move_to_end(key)
+        return ("fresh" if now < entry.fresh_until else "stale"), entry.value
+
+    def _drop(self, key: str) -> None:
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def put(self, key: str, value: Any, size: int) -> None:
+        ttl = ttl_for(key)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._drop(key)
+            self._data[key] = _Entry(value, size, now + ttl, now + ttl + self.stale_seconds)
+            self.bytes += size
+            while self.bytes > self.max_bytes and self._data:
+                _, evicted = self._data.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._drop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "collapsed": self.collapsed,
+                "evictions": self.evictions,
+                "refreshes": self.refreshes,
+                "hit_ratio": round((self.hits + self.stale_hits) / lookups, 3) if lookups else 0.0,
+            }
+
+    # ================================
+    # 🔹 Stale-while-revalidate
+    # ================================
+    def _schedule_refresh(self, key: str, loader: Loader) -> None:
+        """Da chiamare con il lock acquisito: aggiorna la voce in background (una volta sola)."""
+        if key in self._refreshing or key in self._inflight:
+            return
+        self._refreshing.add(key)
+        self.refreshes += 1
+        self._executor.submit(self._refresh, key, loader)
+
+    def _refresh(self, key: str, loader: Loader) -> None:
+        try:
+            value, size = loader()
+            self.put(key, value, size)
+        except Exception as e:
+            print(f"[CACHE] Refresh fallito per {key}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    # ================================
+    # 🔹 Single-flight
+    # ================================
+    def _begin(self, key: str, loader: Loader, allow_stale: bool = True) -> tuple[str, Any, _Flight | None, bool]:
+        """
+        Da chiamare con il lock acquisito. Restituisce (stato, valore, flight, leader):
+        se leader è True il chiamante deve eseguire il caricamento e chiudere il flight.
+        Con allow_stale=False una voce scaduta conta come miss.
+        """
+        state, value = self._lookup(key, time.monotonic())
+        if state == "fresh":
+            self.hits += 1
+            return state, value, None, False
+        if state == "stale" and allow_stale:
+            self.stale_hits += 1
+            self._schedule_refresh(key, loader)
+            return state, value, None, False
+
+        flight = self._inflight.get(key)
+        if flight is not None:
+            self.collapsed += 1
+            return state, None, flight, False
+        self.misses += 1
+        flight = self._inflight[key] = _Flight()
+        return state, None, flight, True
+
+    def _finish(self, key: str, flight: _Flight, value: Any, size: int, error: BaseException | None) -> None:
+        if error is None:
+            self.put(key, value, size)
+        with self._lock:
+            self._inflight.pop(key, None)
+            flight.value, flight.error = value, error
+            flight.event.set()
+            waiters, flight.waiters = flight.waiters, []
+        for loop, fut in waiters:
+            loop.call_soon_threadsafe(_wake, fut)
+
+    @staticmethod
+    def _result(flight: _Flight) -> Any:
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def get_or_load(self, key: str, loader: Loader, allow_stale: bool = True) -> Any:
+        """
+        Versione sincrona: restituisce il valore in cache oppure lo carica con loader().
+        allow_stale=False per chi scrive lo stato in DB (es. /trains/check): niente voci scadute.
+        """
+        with self._lock:
+            state, value, flight, leader = self._begin(key, loader, allow_stale)
+        if flight is None:
+            return value
+        if not leader:
+            flight.event.wait()
+            return self._result(flight)
+
+        try:
+            value, size = loader()
+        except BaseException as e:
+            self._finish(key, flight, None, 0, e)
+            raise
+        self._finish(key, flight, value, size, None)
+        return value
+
+    async def aget_or_load(self, key: str, aloader: AsyncLoader, loader: Loader, allow_stale: bool = True) -> Any:
+        """
+        Versione asincrona. aloader viene usato per i miss, loader (sincrono)
+        per gli aggiornamenti stale-while-revalidate in background.
+        allow_stale=False (scheduler) non accetta voci scadute: attende un dato fresco,
+        sempre passando dal single-flight.
+        """
+        with self._lock:
+            state, value, flight, leader = self._begin(key, loader, allow_stale)
+            if flight is not None and not leader and not flight.event.is_set():
+                fut = asyncio.get_running_loop().create_future()
+                flight.waiters.append((asyncio.get_running_loop(), fut))
+            else:
+                fut = None
+        if flight is None:
+            return value
+        if not leader:
+            if fut is not None:
+                await fut
+            return self._result(flight)
+
+        try:
+            value, size = await aloader()
+        except BaseException as e:
+            self._finish(key, flight, None, 0, e)
+            raise
+        self._finish(key, flight, value, size, None)
+        return value
+
+
+# Istanza condivisa del processo
+response_cache = ResponseCache()
+collector(
+    "trainwatcher_upstream_cache", "Cache risposte upstream: voci, byte, hit, miss, eviction", "gauge", "stat",
+    response_cache.stats,
+)
@@ -0,0 +1,158 @@
+# app/services/capture.py
+
+import bisect
+import gzip
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+# Un record per tentativo di richiesta upstream, una riga JSON compressa gzip:
+# {"t": epoch, "path": "partenze/S00035", "status": 200, "latency_ms": 84.2, "body": "...", "error": null}
+# status 0 + error = eccezione di rete (timeout, connessione rifiutata...).
+
+
+class CaptureLog:
+    """
+    Log append-only delle risposte upstream (modalità record).
+    Ogni avvio aggiunge un nuovo membro gzip allo stesso file: gzip lo legge come un flusso unico.
+    Le righe vengono scritte su disco ogni flush_every record e alla chiusura.
+    """
+
+    def __init__(self, path: str, flush_every: int = 100):
+        self.path = path
+        self.flush_every = flush_every
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = gzip.open(path, "at", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.records = 0
+
+    def write(self, path: str, status: int, latency: float, body: str | None = None, error: str | None = None) -> None:
+        line = json.dumps(
+            {"t": round(time.time(), 3), "path": path, "status": status,
+             "latency_ms": round(latency * 1000, 1), "body": body, "error": error},
+            ensure_ascii=False, separators=(",", ":"),
+        )
+        with self._lock:
+            self._file.write(line + "\n")
+            self.records += 1
+            self._pending += 1
+            if self._pending >= self.flush_every:
+                self._file.flush()
+                self._pending = 0
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+class ReplayRecord:
+    __slots__ = ("t", "status", "latency", "body", "error")
+
+    def __init__(self, raw: dict):
+        self.t = raw["t"]
+        self.status = raw["status"]
+        self.latency = raw.get("latency_ms", 0.0) / 1000
+        self.body = raw.get("body") or ""
+        self.error = raw.get("error")
+
+
+def read_capture(path: str):
+    """Legge i record di un file di cattura (anche con più membri gzip)."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class ReplaySource:
+    """
+    Serve le risposte catturate (modalità replay).
+    - speed > 0: orologio simulato che parte alla prima richiesta e avanza speed volte
+      più veloce del tempo reale; per ogni path si serve l'ultima risposta registrata
+      prima dell'istante simulato, con la latenza originale divisa per speed.
+      Quando la cattura finisce resta valida l'ultima risposta di ogni path.
+    - speed <= 0: sequenziale e senza attese, ogni richiesta a un path consuma
+      il record successivo (utile per riprodurre esattamente una sequenza di tick).
+    I path mai visti rispondono 404.
+    """
+
+    def __init__(self, path: str, speed: float = 1.0):
+        self.speed = speed
+        self._by_path: dict[str, list[ReplayRecord]] = defaultdict(list)
+        for raw in read_capture(path):
+            self._by_path[raw["path"]].append(ReplayRecord(raw))
+        for records in self._by_path.values():
+            records.sort(key=lambda r: r.t)
+        self._times = {p: [r.t for r in records] for p, records in self._by_path.items()}
+        self.start_t = min((times[0] for times in self._times.values()), default=0.0)
+        self.end_t = max((times[-1] for times in self._times.values()), default=0.0)
+        self._cursor: dict[str, int] = defaultdict(int)
+        self._started: float | None = None
+        self._lock = threading.Lock()
+        self.served = 0
+        self.missing = 0
+
+    def __len__(self) -> int:
+        return sum(len(r) for r in self._by_path.values())
+
+    def now(self) -> float:
+        """Istante della cattura corrispondente ad adesso."""
+        with self._lock:
+            if self._started is None:
+                self._started = time.monotonic()
+            return self.start_t + (time.monotonic() - self._started) * self.speed
+
+    def lookup(self, path: str) -> tuple[ReplayRecord | None, float]:
+        """Record da servire per il path e attesa (secondi) che simula la latenza originale."""
+        records = self._by_path.get(path)
+        if not records:
+            with self._lock:
+                self.missing += 1
+            return None, 0.0
+        if self.speed <= 0:
+            with self._lock:
+                i = self._cursor[path]
+                self._cursor[path] = min(i + 1, len(records) - 1)
+                self.served += 1
+            return records[i], 0.0
+        i = max(bisect.bisect_right(self._times[path], self.now()) - 1, 0)
+        with self._lock:
+            self.served += 1
+        return records[i], records[i].latency / self.speed
+
+    def stats(self) -> dict:
+        return {
+            "records": len(self),
+            "paths": len(self._by_path),
+            "span_s": round(self.end_t - self.start_t, 1),
+            "speed": self.speed,
+            "served": self.served,
+            "missing": self.missing,
+        }
+
+
+if __name__ == "__main__":
+    import sys
+    from collections import Counter
+
+    # Riepilogo di un file di cattura: python -m app.services.capture captures/upstream.jsonl.gz
+    families: Counter[str] = Counter()
+    statuses: Counter[int] = Counter()
+    first = last = None
+    for rec in read_capture(sys.argv[1]):
+        families[rec["path"].split("/", 1)[0]] += 1
+        statuses[rec["status"]] += 1
+        first = rec["t"] if first is None else min(first, rec["t"])
+        last = rec["t"] if last is None else max(last, rec["t"])
+    print(json.dumps({
+        "records": sum(families.values()),
+        "span_s": round((last or 0) - (first or 0), 1),
+        "by_endpoint": dict(families),
+        "by_status": {str(k): v for k, v in statuses.items()},
+    }, indent=2))
@@ -0,0 +1,103 @@
+# app/services/dedup.py
+
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from ..config import settings
+from ..models import NotificationLog
+
+# (route_id, train_code, event_type)
+DedupKey = tuple[int, str, str]
+
+
+class DedupWindow:
+    """
+    Finestra anti-spam in memoria: ricorda l'ultimo invio (o la prenotazione di una notifica
+    ancora in coda) per (tratta, treno, evento) e scarta le notifiche ripetute entro
+    window_seconds, senza leggere notification_logs.
+    Le voci scadute vengono rimosse in ordine di inserimento; oltre max_entries
+    vengono eliminate le più vecchie.
+    """
+
+    def __init__(self, window_seconds: int | None = None, max_entries: int | None = None):
+        self.window = timedelta(seconds=window_seconds or settings.notification_dedup_seconds)
+        self.max_entries = max_entries or settings.notification_dedup_max_entries
+        self._data: OrderedDict[DedupKey, datetime] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _prune(self, now: datetime) -> None:
+        while self._data:
+            key, sent_at = next(iter(self._data.items()))
+            if now - sent_at < self.window and len(self._data) <= self.max_entries:
+                break
+            self._data.popitem(last=False)
+
+    def seen_recently(self, key: DedupKey, now: datetime | None = None) -> bool:
+        """True se per la chiave è già stata inviata una notifica dentro la finestra."""
+        now = now or datetime.utcnow()
+        with self._lock:
+            self._prune(now)
+            sent_at = self._data.get(key)
+            return sent_at is not None and now - sent_at < self.window
+
+    def reserve(self, key: DedupKey, now: datetime | None = None) -> datetime | None:
+        """
+        Prenota la chiave per una notifica appena accodata, così i tick successivi la
+        scartano mentre è ancora in coda o in retry. Restituisce l'istante della prenotazione,
+        oppure None se dentro la finestra c'è già un invio o un'altra prenotazione.
+        """
+        now = now or datetime.utcnow()
+        with self._lock:
+            self._prune(now)
+            sent_at = self._data.get(key)
+            if sent_at is not None and now - sent_at < self.window:
+                return None
+            self._data[key] = now
+            self._data.move_to_end(key)
+            return now
+
+    def release(self, key: DedupKey, reserved_at: datetime) -> None:
+        """Annulla una prenotazione la cui notifica non è stata consegnata (se non già sostituita)."""
+        with self._lock:
+            if self._data.get(key) == reserved_at:
+                del self._data[key]
+
+    def mark(self, key: DedupKey, when: datetime | None = None) -> None:
+        """Registra un invio per la chiave."""
+        when = when or datetime.utcnow()
+        with self._lock:
+            self._data[key] = when
+            self._data.move_to_end(key)
+            self._prune(when)
+
+    def warm(self, db: Session) -> int:
+        """Carica con un'unica query gli invii ancora dentro la finestra (da chiamare all'avvio)."""
+        since = datetime.utcnow() - self.window
+        rows = (
+            db.query(
+                NotificationLog.route_id,
+                NotificationLog.train_code,
+                NotificationLog.event_type,
+                func.max(NotificationLog.sent_at),
+            )
+            .filter(NotificationLog.sent_at >= since)
+            .group_by(NotificationLog.route_id, NotificationLog.train_code, NotificationLog.event_type)
+            .order_by(func.max(NotificationLog.sent_at))
+            .all()
+        )
+        with self._lock:
+            for route_id, train_code, event_type, sent_at in rows:
+                self._data[(route_id, train_code, event_type)] = sent_at
+                self._data.move_to_end((route_id, train_code, event_type))
+            self._prune(datetime.utcnow())
+        print(f"[DEDUP] Finestra anti-spam caricata: {len(rows)} voci")
+        return len(rows)
+
+
+# Istanza condivisa del processo
+notification_window = DedupWindow()
@@ -0,0 +1,344 @@
+# app/services/dispatch.py
+
+import queue
+import random
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import insert, update
+from ..config import settings
+from ..db.session import SessionLocal
+from ..models import NotificationLog, User
+from .dedup import DedupKey, notification_window
+from .metrics import collector
+
+# Esiti per singolo messaggio restituiti dai sender
+SENT, RETRY, INVALID, FAILED = "sent", "retry", "invalid", "failed"
+
+
+class PushMessage:
+    __slots__ = ("token", "title", "body", "key", "reserved_at", "enqueued_at", "attempts")
+
+    def __init__(self, token: str, title: str, body: str, key: DedupKey | None = None):
+        self.token = token
+        self.title = title
+        self.body = body
+        self.key = key   # (tratta, treno, evento): registrata in notification_logs solo se consegnata
+        self.reserved_at: datetime | None = None   # prenotazione nella finestra anti-duplicato
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+# ================================
+# 🔹 Sender
+# ================================
+class FirebaseSender:
+    """Invio tramite firebase_admin: un'unica chiamata send_each per batch (max 500 messaggi)."""
+
+    max_batch = 500
+
+    def send(self, batch: list[PushMessage]) -> list[str]:
+        from firebase_admin import exceptions, messaging
+
+        messages = [
+            messaging.Message(
+                notification=messaging.Notification(title=m.title, body=m.body),
+                token=m.token,
+            )
+            for m in batch
+        ]
+        try:
+            response = messaging.send_each(messages)
+        except (exceptions.UnavailableError, exceptions.InternalError, exceptions.DeadlineExceededError):
+            return [RETRY] * len(batch)
+        except Exception as e:
+            print(f"[ERROR] Firebase send_each failed: {e}")
+            return [FAILED] * len(batch)
+
+        outcomes = []
+        for r in response.responses:
+            if r.success:
+                outcomes.append(SENT)
+            elif isinstance(r.exception, (messaging.UnregisteredError, messaging.SenderIdMismatchError)):
+                # InvalidArgumentError può dipendere dal payload: non basta per scartare il token
+                outcomes.append(INVALID)
+            elif isinstance(r.exception, (exceptions.UnavailableError, exceptions.InternalError,
+                                          exceptions.DeadlineExceededError, messaging.QuotaExceededError)):
+                outcomes.append(RETRY)
+            else:
+                outcomes.append(FAILED)
+        return outcomes
+
+
+class FakeSender:
+    """
+    Sender locale per test e sviluppo offline: registra i messaggi invece di inviarli.
+    Può simulare latenza, token non validi ed errori transitori.
+    """
+
+    max_batch = 500
+
+    def __init__(self, latency: float = 0.0, invalid_tokens: set[str] | None = None, transient_rate: float = 0.0):
+        self.latency = latency
+        self.invalid_tokens = invalid_tokens or set()
+        self.transient_rate = transient_rate
+        self.sent: list[PushMessage] = []
+        self.calls = 0
+
+    def send(self, batch: list[PushMessage]) -> list[str]:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        outcomes = []
+        for m in batch:
+            if m.token in self.invalid_tokens:
+                outcomes.append(INVALID)
+            elif random.random() < self.transient_rate:
+                outcomes.append(RETRY)
+            else:
+                self.sent.append(m)
+                outcomes.append(SENT)
+        return outcomes
+
+
+# ================================
+# 🔹 Coda di invio
+# ================================
+class NotificationDispatcher:
+    """
+    Coda in-process delle notifiche push, svuotata da un pool di worker.
+    - enqueue() non blocca mai: se la coda è piena il messaggio viene scartato e contato;
+    - i worker raccolgono fino a batch_size messaggi (attendendo al massimo batch_wait)
+      e li inviano con una sola chiamata al sender;
+    - gli errori transitori vengono ritentati con backoff, i token non validi
+      vengono rimossi da User.firebase_token;
+    - una notifica con chiave prenota la finestra anti-duplicato all'accodamento, così
+      lo stesso evento non viene riaccodato mentre è in coda o in retry; solo le notifiche
+      consegnate vengono registrate in notification_logs, mentre uno scarto o un errore
+      definitivo libera la prenotazione e non blocca i tentativi successivi.
+    """
+
+    def __init__(
+        self,
+        sender=None,
+        workers: int | None = None,
+        queue_size: int | None = None,
+        batch_size: int | None = None,
+        batch_wait: float | None = None,
+        max_retries: int | None = None,
+    ):
+        self.sender = sender or (FakeSender() if settings.notification_sender == "fake" else FirebaseSender())
+        self.workers = workers or settings.notification_workers
+        self.batch_size = min(batch_size or settings.notification_batch_size, self.sender.max_batch)
+        self.batch_wait = batch_wait if batch_wait is not None else settings.notification_batch_wait_seconds
+        self.max_retries = max_retries if max_retries is not None else settings.notification_max_retries
+        self._queue: queue.Queue[PushMessage] = queue.Queue(maxsize=queue_size or settings.notification_queue_size)
+        self._threads: list[threading.Thread] = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.counters = {"enqueued": 0, "dropped": 0, "sent": 0, "failed": 0, "retried": 0, "invalid_tokens": 0,
+                         "deduplicated": 0}
+        self._send_time = 0.0
+        self._send_calls = 0
+        self._send_max = 0.0
+        self._delivery_time = 0.0
+
+    # ================================
+    # 🔹 Ciclo di vita
+    # ================================
+    def start(self) -> "NotificationDispatcher":
+        if self._threads:
+            return self
+        self._stop.clear()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"push-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        print(f"[PUSH] Dispatcher avviato ({self.workers} worker, sender {type(self.sender).__name__})")
+        return self
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Attende (fino a timeout) lo svuotamento della coda e ferma i worker."""
+        deadline = time.monotonic() + timeout
+        while not self._queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._stop.set()
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        self._threads = []
+
+    # ================================
+    # 🔹 Accodamento
+    # ================================
+    def enqueue(self, token: str, title: str, body: str, key: DedupKey | None = None) -> bool:
+        """
+        Accoda una notifica senza bloccare. Restituisce False se la coda è piena
+        o se per la chiave c'è già una notifica inviata o in corso dentro la finestra.
+        """
+        msg = PushMessage(token, title, body, key)
+        if key is not None:
+            msg.reserved_at = notification_window.reserve(key)
+            if msg.reserved_at is None:
+                self._count("deduplicated")
+                return False
+        return self._put(msg)
+
+    def _put(self, msg: PushMessage) -> bool:
+        try:
+            self._queue.put_nowait(msg)
+        except queue.Full:
+            self._count("dropped")
+            self._give_up(msg)
+            print(f"[PUSH] Coda piena, notifica scartata per {msg.token[:10]}…")
+            return False
+        if msg.attempts == 0:
+            self._count("enqueued")
+        return True
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += n
+
+    # ================================
+    # 🔹 Worker
+    # ================================
+    def _next_batch(self) -> list[PushMessage]:
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._send(batch)
+
+    def _send(self, batch: list[PushMessage]) -> None:
+        started = time.monotonic()
+        outcomes = self.sender.send(batch)
+        elapsed = time.monotonic() - started
+
+        invalid: list[str] = []
+        delivered_keys: list[DedupKey] = []
+        delivered = 0.0
+        with self._lock:
+            self._send_calls += 1
+            self._send_time += elapsed
+            self._send_max = max(self._send_max, elapsed)
+        for msg, outcome in zip(batch, outcomes):
+            if outcome == SENT:
+                self._count("sent")
+                delivered += time.monotonic() - msg.enqueued_at
+                if msg.key:
+                    delivered_keys.append(msg.key)
+            elif outcome == INVALID:
+                invalid.append(msg.token)
+                self._give_up(msg)
+            elif outcome == RETRY and msg.attempts < self.max_retries:
+                msg.attempts += 1
+                self._count("retried")
+                delay = random.uniform(0, min(30.0, 0.5 * 2 ** msg.attempts))
+                timer = threading.Timer(delay, self._put, [msg])
+                timer.daemon = True
+                timer.start()
+            else:
+                self._count("failed")
+                self._give_up(msg)
+        with self._lock:
+            self._delivery_time += delivered
+
+        if delivered_keys:
+            self._log_delivered(delivered_keys)
+        if invalid:
+            self._clear_tokens(invalid)
+
+    @staticmethod
+    def _give_up(msg: PushMessage) -> None:
+        """Notifica persa definitivamente: libera la prenotazione anti-duplicato."""
+        if msg.key is not None and msg.reserved_at is not None:
+            notification_window.release(msg.key, msg.reserved_at)
+
+    def _log_delivered(self, keys: list[DedupKey]) -> None:
+        """Finestra anti-duplicato e notification_logs per le notifiche consegnate (una INSERT per batch)."""
+        now = datetime.utcnow()
+        for key in keys:
+            notification_window.mark(key, now)
+        db = SessionLocal()
+        try:
+            db.execute(insert(NotificationLog), [
+                {"route_id": r, "train_code": t, "event_type": e, "sent_at": now} for r, t, e in keys
+            ])
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"[ERROR] Log notifiche fallito: {e}")
+        finally:
+            db.close()
+
+    def _clear_tokens(self, tokens: list[str]) -> None:
+        """Rimuove dagli utenti i token FCM non più validi (una sola UPDATE per batch)."""
+        self._count("invalid_tokens", len(tokens))
+        db = SessionLocal()
+        try:
+            db.execute(update(User).where(User.firebase_token.in_(tokens)).values(firebase_token=None))
+            db.commit()
+            print(f"[PUSH] Rimossi {len(tokens)} token non validi")
+        except Exception as e:
+            db.rollback()
+            print(f"[ERROR] Pulizia token fallita: {e}")
+        finally:
+            db.close()
+
+    # ================================
+    # 🔹 Osservabilità
+    # ================================
+    def stats(self) -> dict:
+        with self._lock:
+            sent = self.counters["sent"]
+            return {
+                **self.counters,
+                "queue_depth": self._queue.qsize(),
+                "workers": len(self._threads),
+                "send_calls": self._send_calls,
+                "send_latency_avg_s": round(self._send_time / self._send_calls, 4) if self._send_calls else 0.0,
+                "send_latency_max_s": round(self._send_max, 4),
+                "delivery_latency_avg_s": round(self._delivery_time / sent, 4) if sent else 0.0,
+            }
+
+
+_dispatcher: NotificationDispatcher | None = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher() -> NotificationDispatcher:
+    """Restituisce il dispatcher del processo, avviandolo al primo utilizzo."""
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = NotificationDispatcher().start()
+                collector(
+                    "trainwatcher_notifications_total", "Notifiche push per esito", "counter", "outcome",
+                    lambda: dict(_dispatcher.counters),
+                )
+                collector(
+                    "trainwatcher_notification_queue_depth", "Notifiche in coda", "gauge", "",
+                    lambda: {"": _dispatcher._queue.qsize()},
+                )
+    return _dispatcher
+
+
+def current_dispatcher() -> NotificationDispatcher | None:
+    """Il dispatcher del processo se già avviato, senza crearlo (es. API con il polling nel worker)."""
+    return _dispatcher
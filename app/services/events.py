@@ -0,0 +1,257 @@
+# app/services/events.py
+
+import asyncio
+import json
+import secrets
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from ..config import settings
+from ..db.session import SessionLocal
+from ..models import TrainState
+from .metrics import collector
+
+
+class TrainEvent:
+    """
+    Cambio di stato di un treno su una tratta. L'id per la ripresa dello stream è
+    "<epoca>-<progressivo>": l'epoca identifica il broker (processo) che l'ha emesso.
+    """
+    __slots__ = ("id", "seq", "route_id", "train_code", "status", "delay", "at")
+
+    def __init__(self, epoch: str, seq: int, route_id: int, train_code: str, status: str, delay: int, at: datetime):
+        self.id = f"{epoch}-{seq}"
+        self.seq = seq
+        self.route_id = route_id
+        self.train_code = train_code
+        self.status = status
+        self.delay = delay
+        self.at = at
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "route_id": self.route_id,
+            "train_code": self.train_code,
+            "status": self.status,
+            "delay_minutes": self.delay,
+            "last_update": self.at.isoformat(),
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), ensure_ascii=False, separators=(",", ":"))
+
+
+class Subscription:
+    """
+    Iscrizione di un client: una coda asyncio legata all'event loop del client.
+    Un client inattivo costa solo la coda e il task in attesa.
+    Se il client non consuma e la coda si riempie, l'iscrizione viene chiusa
+    con overflow=True: il client deve riconnettersi e riallinearsi.
+    """
+
+    def __init__(self, broker: "EventBroker", routes: set[int] | None, trains: set[str] | None):
+        self.broker = broker
+        self.routes = routes or set()
+        self.trains = trains or set()
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue[TrainEvent | None] = asyncio.Queue(maxsize=settings.stream_queue_size)
+        self.overflow = False
+
+    @property
+    def wildcard(self) -> bool:
+        return not self.routes and not self.trains
+
+    def matches(self, event: TrainEvent) -> bool:
+        return self.wildcard or event.route_id in self.routes or event.train_code in self.trains
+
+    def push(self, event: TrainEvent | None) -> None:
+        """Eseguito nel loop del client (via call_soon_threadsafe)."""
+        if self.overflow:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflow = True
+            self.broker.unsubscribe(self)
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    async def next(self, timeout: float) -> TrainEvent | None:
+        """Prossimo evento, oppure None allo scadere del timeout (momento di inviare un heartbeat)."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self) -> None:
+        self.broker.unsubscribe(self)
+
+
+class EventBroker:
+    """
+    Pub/sub in-process dei cambi di stato.
+    publish() può essere chiamato da qualsiasi thread (lo scheduler gira fuori dal loop dell'API);
+    le iscrizioni sono indicizzate per tratta e per treno, così un evento raggiunge
+    solo i client interessati. Gli ultimi eventi restano in memoria per la ripresa
+    da Last-Event-ID. Il progressivo riparte ad ogni avvio e ogni processo API ha il suo:
+    l'epoca casuale negli id distingue gli eventi di questa istanza da tutti gli altri.
+    """
+
+    def __init__(self, history_size: int | None = None):
+        self._lock = threading.Lock()
+        self.epoch = secrets.token_hex(4)
+        self._next_id = 1
+        self._history: deque[TrainEvent] = deque(maxlen=history_size or settings.stream_history_size)
+        self._by_route: dict[int, set[Subscription]] = {}
+        self._by_train: dict[str, set[Subscription]] = {}
+        self._wildcard: set[Subscription] = set()
+        self.published = 0
+
+    @property
+    def last_id(self) -> str:
+        return f"{self.epoch}-{self._next_id - 1}"
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            subs = set(self._wildcard)
+            for group in (*self._by_route.values(), *self._by_train.values()):
+                subs |= group
+            return len(subs)
+
+    # ================================
+    # 🔹 Iscrizioni
+    # ================================
+    def subscribe(
+        self,
+        routes: set[int] | None = None,
+        trains: set[str] | None = None,
+        last_event_id: str | None = None,
+    ) -> tuple[Subscription, list[TrainEvent], bool]:
+        """
+        Iscrive il client (va chiamato dal suo event loop). Restituisce l'iscrizione,
+        gli eventi persi da riprodurre e un flag 'reset' se last_event_id non è riproducibile:
+        epoca diversa (altro processo o id di prima di un riavvio), formato non valido,
+        progressivo più vecchio della storia disponibile o successivo all'ultimo emesso.
+        Con il reset il client deve rileggere lo stato completo.
+        """
+        sub = Subscription(self, routes, trains)
+        with self._lock:
+            if sub.wildcard:
+                self._wildcard.add(sub)
+            for rid in sub.routes:
+                self._by_route.setdefault(rid, set()).add(sub)
+            for code in sub.trains:
+                self._by_train.setdefault(code, set()).add(sub)
+
+            replay: list[TrainEvent] = []
+            reset = False
+            if last_event_id is not None:
+                epoch, _, seq = last_event_id.rpartition("-")
+                last_seq = self._next_id - 1
+                if epoch != self.epoch or not seq.isdigit() or int(seq) > last_seq:
+                    reset = True
+                elif int(seq) < last_seq:
+                    oldest = self._history[0].seq if self._history else self._next_id
+                    reset = int(seq) < oldest - 1
+                    replay = [e for e in self._history if e.seq > int(seq) and sub.matches(e)]
+        return sub, replay, reset
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            self._wildcard.discard(sub)
+            for rid in sub.routes:
+                group = self._by_route.get(rid)
+                if group is not None:
+                    group.discard(sub)
+                    if not group:
+                        del self._by_route[rid]
+            for code in sub.trains:
+                group = self._by_train.get(code)
+                if group is not None:
+                    group.discard(sub)
+                    if not group:
+                        del self._by_train[code]
+
+    # ================================
+    # 🔹 Pubblicazione
+    # ================================
+    def publish(self, route_id: int, train_code: str, status: str, delay: int, at: datetime) -> TrainEvent:
+        with self._lock:
+            event = TrainEvent(self.epoch, self._next_id, route_id, train_code, status, delay, at)
+            self._next_id += 1
+            self._history.append(event)
+            self.published += 1
+            targets = set(self._wildcard)
+            targets |= self._by_route.get(route_id, set())
+            targets |= self._by_train.get(train_code, set())
+        for sub in targets:
+            try:
+                sub.loop.call_soon_threadsafe(sub.push, event)
+            except RuntimeError:
+                # loop del client già chiuso
+                self.unsubscribe(sub)
+        return event
+
+
+class ChangeFeed:
+    """
+    Alimenta il broker dell'API quando il polling gira in un processo separato:
+    legge periodicamente da train_states le righe aggiornate di recente e le pubblica.
+    La finestra di lettura si sovrappone di stream_feed_overlap_seconds per non perdere
+    i cambi di un tick che ha fatto commit dopo la lettura precedente; i duplicati
+    vengono scartati confrontando l'ultimo aggiornamento già pubblicato per treno.
+    """
+
+    def __init__(self, broker: EventBroker):
+        self.broker = broker
+        self.cursor = datetime.utcnow()
+        self._published: dict[tuple[int, str], datetime] = {}
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def poll(self) -> int:
+        since = self.cursor - timedelta(seconds=settings.stream_feed_overlap_seconds)
+        with SessionLocal() as db:
+            rows = (
+                db.query(TrainState)
+                .filter(TrainState.last_update > since)
+                .order_by(TrainState.last_update)
+                .all()
+            )
+        count = 0
+        for r in rows:
+            key = (r.route_id, r.train_code)
+            if self._published.get(key, since) >= r.last_update:
+                continue
+            self._published[key] = r.last_update
+            self.broker.publish(r.route_id, r.train_code, r.last_status, r.delay_minutes, r.last_update)
+            count += 1
+        if rows:
+            self.cursor = max(self.cursor, rows[-1].last_update)
+        self._published = {k: v for k, v in self._published.items() if v > since}
+        return count
+
+    def _run(self) -> None:
+        while not self._stop.wait(settings.stream_feed_poll_seconds):
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"[STREAM] Change feed error: {e}")
+
+    def start(self) -> "ChangeFeed":
+        self._thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+        self._thread.start()
+        print(f"[STREAM] Change feed da DB avviato (ogni {settings.stream_feed_poll_seconds}s)")
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+# Istanza condivisa del processo
+event_broker = EventBroker()
+collector(
+    "trainwatcher_stream_subscribers", "Client SSE/WebSocket collegati", "gauge", "",
+    lambda: {"": event_broker.subscriber_count()},
+)
@@ -0,0 +1,74 @@
+# app/services/heartbeat.py
+
+import json
+import os
+import socket
+from datetime import datetime, timedelta
+from sqlalchemy.orm import Session
+from ..config import settings
+from ..db.bulk import upsert
+from ..db.session import SessionLocal
+from ..models import WorkerHeartbeat
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+STARTED_AT = datetime.utcnow()
+
+# Statistiche dell'ultimo tick eseguito da questo processo (aggiornate dallo scheduler)
+last_tick: dict = {}
+
+
+def record_tick(stats: dict) -> None:
+    last_tick.clear()
+    last_tick.update(stats, at=datetime.utcnow().isoformat())
+
+
+def beat(mode: str) -> None:
+    """Aggiorna (upsert) la riga di heartbeat di questo processo."""
+    db = SessionLocal()
+    try:
+        upsert(
+            db,
+            WorkerHeartbeat,
+            [{
+                "worker_id": WORKER_ID,
+                "hostname": socket.gethostname(),
+                "pid": os.getpid(),
+                "mode": mode,
+                "started_at": STARTED_AT,
+                "last_beat": datetime.utcnow(),
+                "last_tick_at": datetime.fromisoformat(last_tick["at"]) if last_tick else None,
+                "last_tick": json.dumps(last_tick) if last_tick else None,
+            }],
+            keys=["worker_id"],
+        )
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"[HEARTBEAT] error: {e}")
+    finally:
+        db.close()
+
+
+def clear() -> None:
+    """Rimuove l'heartbeat di questo processo (uscita pulita)."""
+    with SessionLocal() as db:
+        db.query(WorkerHeartbeat).filter(WorkerHeartbeat.worker_id == WORKER_ID).delete()
+        db.commit()
+
+
+def list_workers(db: Session) -> list[dict]:
+    """Heartbeat registrati, con flag alive in base a worker_heartbeat_timeout_seconds."""
+    threshold = datetime.utcnow() - timedelta(seconds=settings.worker_heartbeat_timeout_seconds)
+    rows = db.query(WorkerHeartbeat).order_by(WorkerHeartbeat.last_beat.desc()).all()
+    return [
+        {
+            "worker_id": w.worker_id,
+            "mode": w.mode,
+            "alive": w.last_beat >= threshold,
+            "started_at": w.started_at,
+            "last_beat": w.last_beat,
+            "last_tick_at": w.last_tick_at,
+            "last_tick": json.loads(w.last_tick) if w.last_tick else None,
+        }
+        for w in rows
+    ]
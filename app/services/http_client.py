@@ -0,0 +1,314 @@
+# app/services/http_client.py
+
+import asyncio
+import atexit
+import random
+import threading
+import time
+from typing import Any
+import httpx
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from ..config import settings
+from .capture import CaptureLog, ReplayRecord, ReplaySource
+from .metrics import UPSTREAM_ERRORS, UPSTREAM_LATENCY, endpoint_family
+from .upstream_guard import breakers, rate_limiter
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/120.0 Safari/537.36"
+)
+
+_RETRY_EXCEPTIONS = (requests.Timeout, requests.ConnectionError)
+_ARETRY_EXCEPTIONS = (httpx.TransportError,)  # include anche i timeout
+
+
+class UpstreamError(Exception):
+    """Risposta upstream non utilizzabile (status HTTP diverso da 2xx)."""
+
+    def __init__(self, path: str, status: int):
+        super().__init__(f"{path}: HTTP {status}")
+        self.path = path
+        self.status = status
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Viaggiatreno non risponde: retry esauriti (rete, timeout, 5xx, 429), circuito aperto
+    o limite di richieste saturo. Da non confondere con una risposta valida ma vuota.
+    """
+
+    def __init__(self, path: str, reason: str, retry_after: float | None = None):
+        super().__init__(f"{path}: {reason}")
+        self.path = path
+        self.reason = reason
+        self.retry_after = retry_after if retry_after is not None else settings.breaker_reset_seconds
+
+
+def _unavailable(status: int) -> bool:
+    return status >= 500 or status == 429
+
+
+def backoff_delay(attempt: int) -> float:
+    """Backoff esponenziale con full jitter: uniforme in [0, min(max, base * 2^attempt)]."""
+    cap = min(settings.http_backoff_max, settings.http_backoff_base * (2 ** attempt))
+    return random.uniform(0, cap)
+
+
+def _observe(family: str, started: float, status: int | None = None, error: str | None = None) -> None:
+    """Latenza di un singolo tentativo ed eventuale errore, per famiglia di endpoint."""
+    UPSTREAM_LATENCY.labels(family).observe(time.perf_counter() - started)
+    if error:
+        UPSTREAM_ERRORS.labels(family, error).inc()
+    elif status is not None and status >= 400:
+        UPSTREAM_ERRORS.labels(family, f"http_{status // 100}xx").inc()
+
+
+def _requests_response(url: str, record: ReplayRecord | None) -> requests.Response:
+    resp = requests.Response()
+    resp.url = url
+    resp.status_code = record.status if record else 404
+    resp._content = (record.body if record else "").encode("utf-8")
+    resp.encoding = "utf-8"
+    return resp
+
+
+def _httpx_response(url: str, record: ReplayRecord | None) -> httpx.Response:
+    return httpx.Response(
+        record.status if record else 404,
+        content=(record.body if record else "").encode("utf-8"),
+        request=httpx.Request("GET", url),
+    )
+
+
+class UpstreamClient:
+    """
+    Client HTTP condiviso verso Viaggiatreno.
+    Un'unica Session requests con pool di connessioni keep-alive, User-Agent coerente
+    e retry con backoff esponenziale (jitter) su 5xx, timeout ed errori di connessione.
+    Fornisce anche il client httpx per il polling asincrono con gli stessi parametri.
+    Con upstream_mode="record" ogni tentativo viene aggiunto al file di cattura;
+    con "replay" le risposte arrivano dal file e la rete non viene mai usata.
+    """
+
+    def __init__(self, base_url: str | None = None):
+        self.base_url = (base_url or settings.viaggiatreno_base_url).rstrip("/")
+        self.retries = settings.http_max_retries
+        self.timeout = (settings.http_connect_timeout, settings.http_read_timeout)
+
+        self.session = requests.Session()
+        self.session.headers.update({"User-Agent": USER_AGENT})
+        adapter = HTTPAdapter(
+            pool_connections=settings.http_pool_connections,
+            pool_maxsize=settings.http_pool_maxsize,
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.capture: CaptureLog | None = None
+        self.replay: ReplaySource | None = None
+        if settings.upstream_mode == "record":
+            self.capture = CaptureLog(settings.upstream_capture_path)
+            atexit.register(self.capture.close)
+            print(f"[UPSTREAM] Cattura delle risposte su {settings.upstream_capture_path}")
+        elif settings.upstream_mode == "replay":
+            self.replay = ReplaySource(settings.upstream_capture_path, settings.upstream_replay_speed)
+            print(f"[UPSTREAM] Replay da {settings.upstream_capture_path}: {self.replay.stats()}")
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    # ================================
+    # 🔹 Chiamate sincrone
+    # ================================
+    def _admit(self, path: str, family: str):
+        """Circuito della famiglia di endpoint: fallisce subito se è aperto."""
+        breaker = breakers.get(family)
+        if not breaker.allow():
+            UPSTREAM_ERRORS.labels(family, "circuit_open").inc()
+            raise UpstreamUnavailable(path, "circuito aperto", breaker.retry_after())
+        return breaker
+
+    def _token_wait(self, family: str) -> float | None:
+        """
+        Attesa per un token del limite globale (nessuna in replay, la rete non viene usata).
+        None se l'attesa supererebbe upstream_rate_max_wait.
+        """
+        if self.replay:
+            return 0.0
+        wait = rate_limiter.reserve(settings.upstream_rate_max_wait)
+        if wait is None:
+            UPSTREAM_ERRORS.labels(family, "rate_limited").inc()
+        return wait
+
+    @staticmethod
+    def _rate_limited(path: str) -> UpstreamUnavailable:
+        return UpstreamUnavailable(path, "limite di richieste saturo", settings.upstream_rate_max_wait)
+
+    def get(self, path: str) -> requests.Response:
+        """
+        GET con retry, limite globale di richieste e circuito per famiglia di endpoint.
+        Restituisce la risposta (2xx o 4xx) oppure solleva UpstreamUnavailable quando
+        i tentativi sono esauriti su errori di rete, 5xx o 429.
+        """
+        url = self.url(path)
+        family = endpoint_family(path)
+        breaker = self._admit(path, family)
+        ok: bool | None = False
+        try:
+            for attempt in range(self.retries + 1):
+                wait = self._token_wait(family)
+                if wait is None:
+                    # limite locale saturo: non dice nulla sulla salute di Viaggiatreno
+                    ok = None
+                    raise self._rate_limited(path)
+                if wait:
+                    time.sleep(wait)
+                started = time.perf_counter()
+                try:
+                    resp = self._send(path, url)
+                except _RETRY_EXCEPTIONS as e:
+                    _observe(family, started, error=type(e).__name__)
+                    if attempt >= self.retries:
+                        raise UpstreamUnavailable(path, type(e).__name__) from e
+                else:
+                    _observe(family, started, status=resp.status_code)
+                    if not _unavailable(resp.status_code):
+                        ok = True
+                        return resp
+                    if attempt >= self.retries:
+                        raise UpstreamUnavailable(path, f"HTTP {resp.status_code}")
+                time.sleep(backoff_delay(attempt))
+        finally:
+            breaker.record(ok)
+
+    def _send(self, path: str, url: str) -> requests.Response:
+        """Un singolo tentativo: dalla rete (eventualmente registrato) oppure dal file di replay."""
+        if self.replay:
+            record, wait = self.replay.lookup(path)
+            if wait:
+                time.sleep(wait)
+            if record and record.error:
+                raise requests.ConnectionError(f"{path}: {record.error} (replay)")
+            return _requests_response(url, record)
+
+        started = time.perf_counter()
+        try:
+            resp = self.session.get(url, timeout=self.timeout)
+        except _RETRY_EXCEPTIONS as e:
+            if self.capture:
+                self.capture.write(path, 0, time.perf_counter() - started, error=type(e).__name__)
+            raise
+        if self.capture:
+            self.capture.write(path, resp.status_code, time.perf_counter() - started, resp.text)
+        return resp
+
+    def get_json(self, path: str) -> tuple[Any, int]:
+        """GET di una risorsa JSON. Restituisce (dati, byte ricevuti) oppure solleva UpstreamError."""
+        resp = self.get(path)
+        if not resp.ok:
+            raise UpstreamError(path, resp.status_code)
+        return orjson.loads(resp.content), len(resp.content)  # orjson: decodifica diretta dai byte
+
+    def get_text(self, path: str) -> tuple[str, int]:
+        """GET di una risorsa testuale. Restituisce (testo, byte ricevuti) oppure solleva UpstreamError."""
+        resp = self.get(path)
+        if not resp.ok:
+            raise UpstreamError(path, resp.status_code)
+        return resp.text, len(resp.content)
+
+    # ================================
+    # 🔹 Chiamate asincrone
+    # ================================
+    def async_client(self, max_connections: int, max_keepalive: int) -> httpx.AsyncClient:
+        """Crea un client httpx legato all'event loop corrente, con gli stessi header e timeout."""
+        return httpx.AsyncClient(
+            headers={"User-Agent": USER_AGENT},
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+            ),
+            timeout=httpx.Timeout(settings.http_read_timeout, connect=settings.http_connect_timeout),
+        )
+
+    async def aget(self, client: httpx.AsyncClient, path: str) -> httpx.Response:
+        """Versione asincrona di get(), con la stessa politica di retry, limite e circuito."""
+        url = self.url(path)
+        family = endpoint_family(path)
+        breaker = self._admit(path, family)
+        ok: bool | None = False
+        try:
+            for attempt in range(self.retries + 1):
+                wait = self._token_wait(family)
+                if wait is None:
+                    # limite locale saturo: non dice nulla sulla salute di Viaggiatreno
+                    ok = None
+                    raise self._rate_limited(path)
+                if wait:
+                    await asyncio.sleep(wait)
+                started = time.perf_counter()
+                try:
+                    resp = await self._asend(client, path, url)
+                except _ARETRY_EXCEPTIONS as e:
+                    _observe(family, started, error=type(e).__name__)
+                    if attempt >= self.retries:
+                        raise UpstreamUnavailable(path, type(e).__name__) from e
+                else:
+                    _observe(family, started, status=resp.status_code)
+                    if not _unavailable(resp.status_code):
+                        ok = True
+                        return resp
+                    if attempt >= self.retries:
+                        raise UpstreamUnavailable(path, f"HTTP {resp.status_code}")
+                await asyncio.sleep(backoff_delay(attempt))
+        finally:
+            # anche la cancellazione per deadline conta come fallimento
+            breaker.record(ok)
+
+    async def _asend(self, client: httpx.AsyncClient, path: str, url: str) -> httpx.Response:
+        if self.replay:
+            record, wait = self.replay.lookup(path)
+            if wait:
+                await asyncio.sleep(wait)
+            if record and record.error:
+                raise httpx.ConnectError(f"{path}: {record.error} (replay)")
+            return _httpx_response(url, record)
+
+        started = time.perf_counter()
+        try:
+            resp = await client.get(url)
+        except _ARETRY_EXCEPTIONS as e:
+            if self.capture:
+                self.capture.write(path, 0, time.perf_counter() - started, error=type(e).__name__)
+            raise
+        if self.capture:
+            self.capture.write(path, resp.status_code, time.perf_counter() - started, resp.text)
+        return resp
+
+    async def aget_json(self, client: httpx.AsyncClient, path: str) -> tuple[Any, int]:
+        resp = await self.aget(client, path)
+        if not resp.is_success:
+            raise UpstreamError(path, resp.status_code)
+        return orjson.loads(resp.content), len(resp.content)
+
+    async def aget_text(self, client: httpx.AsyncClient, path: str) -> tuple[str, int]:
+        resp = await self.aget(client, path)
+        if not resp.is_success:
+            raise UpstreamError(path, resp.status_code)
+        return resp.text, len(resp.content)
+
+
+_client: UpstreamClient | None = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> UpstreamClient:
+    """Restituisce il client condiviso del processo (creato alla prima richiesta)."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = UpstreamClient()
+    return _client
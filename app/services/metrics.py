@@ -0,0 +1,114 @@
+# app/services/metrics.py
+
+import threading
+import time
+from typing import Callable
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Bucket predefiniti (secondi): da 5 ms a 60 s, adatti sia alle query che ai tick
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _CallbackCollector:
+    """
+    Metrica letta al momento dell'esportazione per i valori già tenuti altrove
+    (cache, coda notifiche, stream, circuiti): nessun costo sul ciclo caldo.
+    fn restituisce {valore_etichetta: valore}; senza etichetta la chiave è "".
+    """
+
+    def __init__(self, name: str, help: str, type_name: str, label: str, fn: Callable[[], dict]):
+        self.name = name
+        self.help = help
+        self.family = CounterMetricFamily if type_name == "counter" else GaugeMetricFamily
+        self.labels = [label] if label else []
+        self.fn = fn
+
+    def describe(self):
+        # registrazione senza chiamare fn (il valore può non essere ancora disponibile)
+        return [self.family(self.name, self.help, labels=self.labels)]
+
+    def collect(self):
+        family = self.family(self.name, self.help, labels=self.labels)
+        try:
+            values = self.fn()
+        except Exception as e:
+            print(f"[METRICS] collector {self.name} error: {e}")
+            return []
+        for key, value in sorted(values.items()):
+            family.add_metric([str(key)] if self.labels else [], value)
+        return [family]
+
+
+def collector(name: str, help: str, type_name: str, label: str, fn: Callable[[], dict]) -> None:
+    """Registra una metrica letta all'esportazione: fn restituisce {valore_etichetta: valore}."""
+    REGISTRY.register(_CallbackCollector(name, help, type_name, label, fn))
+
+
+# ================================
+# 🔹 Metriche del processo
+# ================================
+TICK_DURATION = Histogram(
+    "trainwatcher_tick_duration_seconds", "Durata di un tick dello scheduler", buckets=DEFAULT_BUCKETS
+)
+TICK_DB_SECONDS = Histogram(
+    "trainwatcher_tick_db_seconds", "Tempo speso in query DB per tick", buckets=DEFAULT_BUCKETS
+)
+TICKS = Counter("trainwatcher_ticks_total", "Tick eseguiti per esito", ["outcome"])
+ROUTES_PROCESSED = Counter("trainwatcher_routes_processed_total", "Tratte elaborate dallo scheduler")
+TRAINS_PROCESSED = Counter("trainwatcher_trains_processed_total", "Stati treno confrontati dallo scheduler")
+LAST_TICK_ROUTES = Gauge("trainwatcher_last_tick_routes", "Tratte elaborate nell'ultimo tick")
+LAST_TICK_TRAINS = Gauge("trainwatcher_last_tick_trains", "Stati treno confrontati nell'ultimo tick")
+TRAINS_SKIPPED = Counter(
+    "trainwatcher_trains_skipped_total", "Treni con payload invariato, saltati prima della normalizzazione"
+)
+STATE_CHANGES = Counter("trainwatcher_state_changes_total", "Cambi di stato rilevati")
+NOTIFICATIONS_SKIPPED = Counter(
+    "trainwatcher_notifications_skipped_total", "Notifiche non inviate per motivo", ["reason"]
+)
+
+UPSTREAM_LATENCY = Histogram(
+    "trainwatcher_upstream_request_seconds", "Latenza delle richieste a Viaggiatreno per endpoint", ["endpoint"],
+    buckets=DEFAULT_BUCKETS,
+)
+UPSTREAM_ERRORS = Counter(
+    "trainwatcher_upstream_errors_total", "Errori delle richieste a Viaggiatreno per endpoint e tipo", ["endpoint", "kind"]
+)
+
+HTTP_LATENCY = Histogram(
+    "trainwatcher_http_request_seconds", "Latenza delle richieste HTTP servite dall'API",
+    ["method", "route", "status"], buckets=DEFAULT_BUCKETS,
+)
+
+
+def endpoint_family(path: str) -> str:
+    """Famiglia dell'endpoint upstream (primo segmento del path), per etichette a cardinalità limitata."""
+    return path.split("/", 1)[0] or "root"
+
+
+# ================================
+# 🔹 Tempo DB per thread
+# ================================
+_db_time = threading.local()
+
+
+def instrument_engine(engine) -> None:
+    """Somma il tempo delle query del thread corrente (letto e azzerato dallo scheduler ad ogni tick)."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("_query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["_query_started"].pop()
+        _db_time.seconds = getattr(_db_time, "seconds", 0.0) + time.perf_counter() - started
+
+
+def reset_db_time() -> None:
+    _db_time.seconds = 0.0
+
+
+def db_time() -> float:
+    return getattr(_db_time, "seconds", 0.0)
@@ -1,9 +1,9 @@
 # app/services/notifications.py
 
-import datetime
 from firebase_admin import messaging
 from sqlalchemy.orm import Session
-from app.models import NotificationLog
+from app.services.dedup import notification_window
+from app.services.dispatch import get_dispatcher
 
 def send_push_notification(user_token: str, title: str, body: str) -> bool:
     """Invia una notifica push Firebase. Restituisce True se riuscita."""
@@ -19,36 +19,19 @@ def send_push_notification(user_token: str, title: str, body: str) -> bool:
         print(f"[ERROR] Firebase send failed: {e}")
         return False
 
-def log_notification(db: Session, route_id: int, train_code: str, new_status: str):
-    """Salva nel DB la notifica inviata (evita duplicati)."""
-    log = NotificationLog(
-        route_id=route_id,
-        train_code=train_code,
-        status=new_status,
-        sent_at=datetime.datetime.utcnow(),
-    )
-    db.add(log)
-    db.commit()
-
 def check_and_notify(db: Session, route, train, new_status: str):
     """
     Confronta lo stato del treno con l'ultimo noto.
     Se cambia, invia notifica agli utenti della tratta.
     """
-    last_log = (
-        db.query(NotificationLog)
-        .filter_by(route_id=route.id, train_code=train.code)
-        .order_by(NotificationLog.sent_at.desc())
-        .first()
-    )
-
-    if not last_log or last_log.status != new_status:
+    key = (route.id, train.code, new_status)
+    if not notification_window.seen_recently(key):
         title = f"Treno {train.code} → {route.arrival_station}"
         body = f"Stato aggiornato: {new_status}"
         for user in route.users:
             if user.firebase_token:
-                send_push_notification(user.firebase_token, title, body)
-        log_notification(db, route.id, train.code, new_status)
+                # log e finestra anti-duplicato: a consegna avvenuta, dal dispatcher
+                get_dispatcher().enqueue(user.firebase_token, title, body, key=key)
         print(f"[NOTIFY] {train.code}: {new_status}")
     else:
         print(f"[SKIP] {train.code}: stato invariato ({new_status})")
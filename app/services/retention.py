@@ -0,0 +1,189 @@
+# app/services/retention.py
+
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import Integer, and_, case, cast, delete, func, insert, null, select, union_all, update
+from sqlalchemy.orm import Session, aliased
+from ..config import settings
+from ..db.session import SessionLocal
+from ..models import NotificationLog, Train, TrainDailySummary, TrainDay, TrainInterval
+from .sharding import lease_manager
+
+# Granularità dello storico, dalla più fine:
+#   trains (ogni cambio di stato)      → retention_raw_days
+#   train_intervals (stato + durata)   → retention_interval_days
+#   train_daily_summaries (per giorno) → retention_daily_days
+#   train_days già sommate ai rollup   → retention_daily_days (base di analytics.recompute)
+# Ogni passo è una sequenza di istruzioni set-based (funzioni finestra e subquery correlate
+# sugli indici composti), valide sia su Postgres sia su SQLite.
+
+
+def _same_key(a, b):
+    return and_(a.route_id == b.route_id, a.train_code == b.train_code)
+
+
+def dedup_consecutive(db: Session, before: datetime) -> int:
+    """
+    Elimina le righe di trains anteriori a `before` identiche (stato e ritardo) alla precedente
+    dello stesso treno. La precedente può anche essere l'ultimo intervallo già compattato
+    (ancora aperto), così i duplicati a cavallo di due passaggi vengono eliminati lo stesso.
+    """
+    rows = union_all(
+        select(
+            Train.id.label("id"), Train.route_id, Train.train_code,
+            Train.last_status.label("status"), Train.delay_minutes.label("delay"), Train.last_update.label("at"),
+        ).where(Train.last_update < before),
+        select(
+            cast(null(), Integer).label("id"), TrainInterval.route_id, TrainInterval.train_code,
+            TrainInterval.status, TrainInterval.delay_minutes, TrainInterval.started_at,
+        ).where(TrainInterval.ended_at.is_(None)),
+    ).subquery()
+    window = {"partition_by": (rows.c.route_id, rows.c.train_code), "order_by": (rows.c.at, rows.c.id)}
+    ranked = select(
+        rows.c.id, rows.c.status, rows.c.delay,
+        func.lag(rows.c.status).over(**window).label("prev_status"),
+        func.lag(rows.c.delay).over(**window).label("prev_delay"),
+    ).subquery()
+    duplicates = select(ranked.c.id).where(
+        ranked.c.id.is_not(None),
+        ranked.c.status == ranked.c.prev_status,
+        ranked.c.delay == ranked.c.prev_delay,
+    )
+    return db.execute(delete(Train).where(Train.id.in_(duplicates))).rowcount
+
+
+def compact_raw(db: Session, before: datetime) -> int:
+    """
+    Sposta le righe di trains anteriori a `before` in train_intervals (una riga per stato),
+    poi chiude gli intervalli aperti con l'inizio dello stato successivo, che sia
+    già un intervallo oppure ancora una riga di trains.
+    """
+    moved = db.execute(
+        insert(TrainInterval).from_select(
+            ["route_id", "train_code", "status", "delay_minutes", "started_at"],
+            select(Train.route_id, Train.train_code, Train.last_status, Train.delay_minutes, Train.last_update)
+            .where(Train.last_update < before),
+        )
+    ).rowcount
+    if not moved:
+        return 0
+    db.execute(delete(Train).where(Train.last_update < before))
+
+    nxt = aliased(TrainInterval)
+    next_interval = (
+        select(func.min(nxt.started_at))
+        .where(_same_key(nxt, TrainInterval), nxt.started_at > TrainInterval.started_at)
+        .scalar_subquery()
+    )
+    next_raw = (
+        select(func.min(Train.last_update))
+        .where(_same_key(Train, TrainInterval), Train.last_update > TrainInterval.started_at)
+        .scalar_subquery()
+    )
+    db.execute(
+        update(TrainInterval)
+        .where(TrainInterval.ended_at.is_(None))
+        .values(ended_at=func.coalesce(next_interval, next_raw))
+        .execution_options(synchronize_session=False)
+    )
+    return moved
+
+
+def summarize_intervals(db: Session, before: datetime) -> int:
+    """Aggrega in riepiloghi giornalieri gli intervalli iniziati prima di `before` (mezzanotte) e li elimina."""
+    day = func.date(TrainInterval.started_at)
+    inserted = db.execute(
+        insert(TrainDailySummary).from_select(
+            ["route_id", "train_code", "day", "transitions", "delay_sum", "max_delay", "cancellations"],
+            select(
+                TrainInterval.route_id,
+                TrainInterval.train_code,
+                day,
+                func.count(),
+                func.sum(TrainInterval.delay_minutes),
+                func.max(TrainInterval.delay_minutes),
+                func.sum(case((TrainInterval.status == "Cancellato", 1), else_=0)),
+            )
+            .where(TrainInterval.started_at < before)
+            .group_by(TrainInterval.route_id, TrainInterval.train_code, day),
+        )
+    ).rowcount
+    db.execute(delete(TrainInterval).where(TrainInterval.started_at < before))
+    return inserted
+
+
+def _midnight(dt: datetime) -> datetime:
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def run_retention(db: Session, now: datetime | None = None) -> dict:
+    """
+    Un passaggio completo del compattatore. Le righe grezze vengono compattate a finestre
+    di retention_slice_hours, una transazione per finestra, così lock e WAL restano limitati.
+    """
+    now = now or datetime.utcnow()
+    started = time.perf_counter()
+    stats = {
+        "deduplicated": 0, "intervals": 0, "summaries": 0,
+        "deleted_summaries": 0, "deleted_days": 0, "deleted_logs": 0,
+    }
+
+    if settings.retention_raw_days:
+        cutoff = now - timedelta(days=settings.retention_raw_days)
+        oldest = db.scalar(select(func.min(Train.last_update)))
+        while oldest is not None and oldest < cutoff:
+            upto = min(cutoff, oldest + timedelta(hours=settings.retention_slice_hours))
+            stats["deduplicated"] += dedup_consecutive(db, upto)
+            stats["intervals"] += compact_raw(db, upto)
+            db.commit()
+            oldest = db.scalar(select(func.min(Train.last_update)))
+
+    if settings.retention_interval_days:
+        # solo giorni interi: ogni giorno viene riassunto una volta sola
+        cutoff = _midnight(now - timedelta(days=settings.retention_interval_days))
+        stats["summaries"] = summarize_intervals(db, cutoff)
+        db.commit()
+
+    if settings.retention_daily_days:
+        cutoff = (now - timedelta(days=settings.retention_daily_days)).date()
+        stats["deleted_summaries"] = db.execute(
+            delete(TrainDailySummary).where(TrainDailySummary.day < cutoff)
+        ).rowcount
+        stats["deleted_days"] = db.execute(
+            delete(TrainDay).where(TrainDay.day < cutoff, TrainDay.folded == 1)
+        ).rowcount
+        db.commit()
+
+    if settings.retention_notification_days:
+        cutoff = now - timedelta(days=settings.retention_notification_days)
+        stats["deleted_logs"] = db.execute(
+            delete(NotificationLog).where(NotificationLog.sent_at < cutoff)
+        ).rowcount
+        db.commit()
+
+    stats["duration_s"] = round(time.perf_counter() - started, 3)
+    return stats
+
+
+def retention_job() -> None:
+    """
+    Job dello scheduler. Con più poller lo esegue solo chi possiede lo shard 0,
+    così il compattatore non gira mai in parallelo con sé stesso.
+    """
+    if 0 not in lease_manager.owned:
+        return
+    db = SessionLocal()
+    try:
+        stats = run_retention(db)
+        if any(v for k, v in stats.items() if k != "duration_s"):
+            print(f"[RETENTION] {stats}")
+    except Exception as e:
+        db.rollback()
+        print(f"[RETENTION] error: {e}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    with SessionLocal() as session:
+        print(run_retention(session))
@@ -0,0 +1,189 @@
+# app/services/route_import.py
+
+import asyncio
+import csv
+import io
+from typing import AsyncIterator
+import orjson
+from pydantic import ValidationError
+from sqlalchemy import insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from ..config import settings
+from ..db.bulk import dialect_insert
+from ..db.session import AsyncSessionLocal
+from ..models import Route, Station, User
+from ..schemas import RouteCreate
+from .http_client import UpstreamUnavailable
+from .station_directory import aensure_index, normalize_name, station_index
+from .viaggiatreno import AsyncViaggiatreno
+
+# Righe del file: (numero di riga, dati grezzi oppure None, errore di parsing)
+ParsedRow = tuple[int, dict | None, str | None]
+
+
+# ================================
+# 🔹 Parsing
+# ================================
+def parse_rows(body: bytes, fmt: str) -> list[ParsedRow]:
+    """
+    Legge un import in blocco: JSON lines (un oggetto per riga) oppure CSV con intestazione
+    (user_id, departure_name, arrival_name, train_number, active). Le righe vuote sono ignorate.
+    """
+    rows: list[ParsedRow] = []
+    text = body.decode("utf-8-sig")
+    if fmt == "csv":
+        for n, raw in enumerate(csv.DictReader(io.StringIO(text)), start=2):
+            rows.append((n, {k.strip(): (v or "").strip() for k, v in raw.items() if k}, None))
+        return rows
+    for n, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            raw = orjson.loads(line)
+        except orjson.JSONDecodeError as e:
+            rows.append((n, None, f"JSON non valido: {e}"))
+            continue
+        rows.append((n, raw, None) if isinstance(raw, dict) else (n, None, "La riga deve essere un oggetto JSON"))
+    return rows
+
+
+def _validate(raw: dict, default_user_id: int | None) -> RouteCreate:
+    raw = {k: v for k, v in raw.items() if v not in ("", None)}   # celle CSV vuote = campo assente
+    number = raw.get("train_number")
+    if isinstance(number, int) and not isinstance(number, bool):
+        raw["train_number"] = str(number)   # JSON {"train_number": 4659}, come "4659" nel CSV
+    if default_user_id is not None:
+        raw.setdefault("user_id", default_user_id)
+    return RouteCreate.model_validate(raw)
+
+
+# ================================
+# 🔹 Risoluzione stazioni
+# ================================
+def _station_key(name: str) -> str:
+    return " ".join(normalize_name(name))
+
+
+async def resolve_stations(db, names: set[str]) -> dict[str, str | UpstreamUnavailable | None]:
+    """
+    Risolve ogni nome distinto una sola volta, solo per corrispondenza esatta:
+    - l'indice locale (nome identico dopo la normalizzazione, mai il match fuzzy di /stations/search);
+    - la tabella stations, per i nomi salvati da altri processi dopo la costruzione dell'indice;
+    - Viaggiatreno in parallelo per i soli nomi mancanti, con la concorrenza, la cache
+      e la protezione upstream del polling. I nuovi codici vengono salvati in stations.
+    Restituisce nome → codice, None (stazione inesistente) o UpstreamUnavailable.
+    """
+    index = await aensure_index(db)
+    resolved: dict[str, str | UpstreamUnavailable | None] = {}
+    for name in names:
+        code = index.resolve(name)
+        if code:
+            resolved[name] = code
+    unknown = [name for name in names if name not in resolved]
+    if unknown:
+        for name, code in await db.execute(select(Station.name, Station.code).where(Station.name.in_(unknown))):
+            resolved[name] = code
+            index.add(name, code)
+    missing = [name for name in unknown if name not in resolved]
+    if not missing:
+        return resolved
+
+    async def lookup(vt: AsyncViaggiatreno, name: str):
+        try:
+            return await vt.get_station_code(name)
+        except UpstreamUnavailable as e:
+            return e
+
+    async with AsyncViaggiatreno() as vt:
+        codes = await asyncio.gather(*(lookup(vt, name) for name in missing))
+
+    new_stations: dict[str, str] = {}
+    for name, code in zip(missing, codes):
+        resolved[name] = code
+        if isinstance(code, str):
+            new_stations.setdefault(code, name)
+    if new_stations:
+        # il codice (o il nome) può essere già presente con un'altra grafia: si tiene quello esistente
+        rows = [{"name": name, "code": code} for code, name in new_stations.items()]
+        await db.execute(dialect_insert(db)(Station).values(rows).on_conflict_do_nothing())
+        await db.commit()
+        for code, name in new_stations.items():
+            station_index.add(name, code)
+    print(f"[IMPORT] Stazioni: {len(names) - len(missing)} locali, {len(missing)} da Viaggiatreno")
+    return resolved
+
+
+# ================================
+# 🔹 Import
+# ================================
+def _line(payload: dict) -> bytes:
+    return orjson.dumps(payload) + b"\n"
+
+
+async def import_routes(rows: list[ParsedRow], default_user_id: int | None = None) -> AsyncIterator[bytes]:
+    """
+    Crea in blocco le tratte di un import, restituendo man mano una riga NDJSON per riga
+    del file ({"row", "status": "created"|"error", ...}) e infine un riepilogo.
+    Gli errori di una riga non fermano le altre.
+    """
+    created = failed = 0
+    valid: list[tuple[int, RouteCreate]] = []
+    for n, raw, error in rows:
+        if raw is not None:
+            try:
+                valid.append((n, _validate(raw, default_user_id)))
+                continue
+            except ValidationError as e:
+                error = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+        failed += 1
+        yield _line({"row": n, "status": "error", "error": error})
+
+    async with AsyncSessionLocal() as db:
+        # 🔹 Utenti inesistenti (una sola query per tutto l'import)
+        user_ids = {r.user_id for _, r in valid}
+        known = set((await db.scalars(select(User.id).where(User.id.in_(user_ids)))).all()) if user_ids else set()
+
+        # 🔹 Ogni stazione distinta risolta una sola volta
+        names: dict[str, str] = {}
+        for _, r in valid:
+            for name in (r.departure_name, r.arrival_name):
+                names.setdefault(_station_key(name), name.strip())
+        codes = await resolve_stations(db, set(names.values()))
+
+        def code_of(name: str):
+            return codes.get(names[_station_key(name)])
+
+        pending: list[tuple[int, dict]] = []
+        for n, r in valid:
+            dep, arr = code_of(r.departure_name), code_of(r.arrival_name)
+            if r.user_id not in known:
+                error = f"Utente {r.user_id} inesistente"
+            elif isinstance(dep, UpstreamUnavailable) or isinstance(arr, UpstreamUnavailable):
+                error = "Viaggiatreno non raggiungibile, riprova più tardi."
+            elif not dep or not arr:
+                error = f"Stazione non trovata: {r.departure_name if not dep else r.arrival_name}"
+            else:
+                pending.append((n, {**r.model_dump(), "departure_code": dep, "arrival_code": arr}))
+                continue
+            failed += 1
+            yield _line({"row": n, "status": "error", "error": error})
+
+        # 🔹 Inserimento a blocchi: una sola istruzione (executemany con RETURNING) per blocco
+        stmt = insert(Route).returning(Route.id, sort_by_parameter_order=True)
+        for i in range(0, len(pending), settings.db_batch_size):
+            chunk = pending[i:i + settings.db_batch_size]
+            try:
+                ids = (await db.scalars(stmt, [values for _, values in chunk])).all()
+                await db.commit()
+            except SQLAlchemyError as e:
+                await db.rollback()
+                failed += len(chunk)
+                for n, _ in chunk:
+                    yield _line({"row": n, "status": "error", "error": f"Errore DB: {type(e).__name__}"})
+                continue
+            created += len(chunk)
+            for (n, _), route_id in zip(chunk, ids):
+                yield _line({"row": n, "status": "created", "route_id": route_id})
+
+    print(f"[IMPORT] {created} tratte create, {failed} righe scartate")
+    yield _line({"summary": {"rows": len(rows), "created": created, "failed": failed}})
@@ -1,64 +1,253 @@
 # app/services/scheduler.py
 
+import asyncio
+import time
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.base import BaseScheduler
 from sqlalchemy.orm import Session
-from datetime import datetime
+from collections import defaultdict
+from datetime import date, datetime
+from typing import AsyncIterator
+from ..config import settings
+from ..db.bulk import WriteBatch
 from ..db.session import SessionLocal
-from ..models import Route, Train, NotificationLog, User
-from .viaggiatreno import get_departures, get_train_status, normalize_status
-from .notifications import send_push_notification  # nuova funzione
+from ..models import Route, User
+from . import heartbeat
+from .adaptive import board_interval, poll_planner, train_interval, unavailable_interval
+from .dedup import notification_window
+from . import metrics
+from .events import event_broker
+from .analytics import analytics_job, day_tracker
+from .retention import retention_job
+from .sharding import lease_manager, maintain_leases, shard_of
+from .state_store import StateMap, load_states, payload_fingerprints
+from .status_cache import status_cache
+from .http_client import UpstreamUnavailable
+from .viaggiatreno import AsyncViaggiatreno, TrainRecord, fingerprint, normalize_status
+from .dispatch import get_dispatcher
 
 
-def _check_routes():
+class _Tick:
+    """Contesto di un singolo tick: sessione, stato corrente dei treni e scritture in attesa."""
+
+    def __init__(self, db: Session, route_ids: list[int] | None = None):
+        self.db = db
+        self.states: StateMap = load_states(db, route_ids)
+        self.batch = WriteBatch(db)
+        self.changed_routes: set[int] = set()
+        self.trains = 0
+        self.skipped = 0
+        # impronte dei payload visti nel tick, applicate alla mappa condivisa dopo il commit
+        self.fingerprints: dict[tuple[int, str], tuple[tuple, tuple[str, int]]] = {}
+        self.events: list[tuple[int, str, str, int, datetime]] = []
+        # notifiche decise nel tick, accodate solo dopo il commit: (chiave dedup, token, messaggio)
+        self.notifications: list[tuple[tuple, str, str]] = []
+        # prime osservazioni della giornata, segnate nel day_tracker solo dopo il commit
+        self.first_sightings: list[tuple[tuple[int, str], date]] = []
+
+
+def _group_routes(routes: list[Route]) -> tuple[dict[str, list[Route]], dict[tuple[str, str], list[Route]]]:
+    """
+    Raggruppa le tratte per risorsa upstream: tabellone partenze per stazione
+    oppure andamentoTreno per (stazione, numero treno) se il treno è fissato.
+    """
+    boards: dict[str, list[Route]] = defaultdict(list)
+    pinned: dict[tuple[str, str], list[Route]] = defaultdict(list)
+    for rt in routes:
+        if rt.train_number:
+            pinned[(rt.departure_code, str(rt.train_number))].append(rt)
+        else:
+            boards[rt.departure_code].append(rt)
+    return boards, pinned
+
+
+# Risultato di una risorsa per cui Viaggiatreno non ha risposto (diverso da "nessun treno")
+UNAVAILABLE = object()
+
+
+async def _poll_resources(
+    boards: dict[str, list[Route]],
+    pinned: dict[tuple[str, str], list[Route]],
+) -> AsyncIterator[tuple[tuple[str, object], object]]:
+    """
+    Interroga in parallelo (con concorrenza limitata) tutte le risorse del tick
+    e restituisce i risultati man mano che arrivano, non nell'ordine di richiesta.
+    """
+    async def board(vt: AsyncViaggiatreno, code: str):
+        try:
+            return ("board", code), await vt.get_departures(code)
+        except UpstreamUnavailable:
+            return ("board", code), UNAVAILABLE
+
+    async def train(vt: AsyncViaggiatreno, key: tuple[str, str]):
+        try:
+            return ("train", key), await vt.get_train_status(*key)
+        except UpstreamUnavailable:
+            return ("train", key), UNAVAILABLE
+
+    # lo scheduler deve vedere lo stato attuale: niente voci stale-while-revalidate
+    async with AsyncViaggiatreno(allow_stale=False) as vt:
+        tasks = [board(vt, code) for code in boards] + [train(vt, key) for key in pinned]
+        for fut in asyncio.as_completed(tasks):
+            yield await fut
+
+
+def _dispatch_board(tick: _Tick, group: list[Route], deps: list[TrainRecord]) -> list[TrainRecord]:
+    """
+    Distribuisce un tabellone partenze a tutte le tratte che partono dalla stazione.
+    Restituisce i treni rilevanti (diretti verso almeno una tratta) per la pianificazione.
+    """
+    by_dest: dict[str, list[TrainRecord]] = defaultdict(list)
+    for tr in deps:
+        by_dest[tr.destination.lower()].append(tr)
+    relevant: list[TrainRecord] = []
+    for rt in group:
+        for tr in by_dest.get(rt.arrival_name.strip().lower(), ()):
+            relevant.append(tr)
+            _handle_status(tick, rt, tr, tr.train_code)
+    return relevant
+
+
+async def _check_routes_async() -> dict:
     db: Session = SessionLocal()
+    stats = {
+        "routes": 0, "tracked": 0, "due": 0, "upstream_calls": 0, "saved_calls": 0,
+        "unavailable": 0, "trains": 0, "skipped": 0, "skip_ratio": 0.0, "duration_s": 0.0, "writes": {}, "shards": [],
+    }
+    started = time.perf_counter()
+    metrics.reset_db_time()
+    outcome = "error"
     try:
-        routes = db.query(Route).filter(Route.active.is_(True)).all()
-        for rt in routes:
-            # Se è stato specificato un numero treno, monitora solo quello
-            if rt.train_number:
-                status_data = get_train_status(rt.departure_code, rt.train_number)
-                if not status_data:
-                    continue
-                _handle_status(db, rt, status_data, str(rt.train_number))
+        # 🔹 Solo le stazioni di partenza degli shard di cui questo poller ha il lease
+        owned = lease_manager.renew_and_claim(db)
+        routes = [
+            rt for rt in db.query(Route).filter(Route.active.is_(True)).all()
+            if shard_of(rt.departure_code) in owned
+        ]
+        boards, pinned = _group_routes(routes)
+        payload_fingerprints.retain({rt.id for rt in routes})
+
+        # 🔹 Solo le risorse il cui prossimo controllo è scaduto, dalla più in ritardo
+        poll_planner.sync({("board", c) for c in boards} | {("train", k) for k in pinned})
+        due = poll_planner.pop_due()
+        due_boards = {key: boards[key] for kind, key in due if kind == "board"}
+        due_pinned = {key: pinned[key] for kind, key in due if kind == "train"}
+        due_routes = [rt for group in (*due_boards.values(), *due_pinned.values()) for rt in group]
+        tick = _Tick(db, [rt.id for rt in due_routes])
+
+        # 🔹 Un solo tabellone per stazione e un solo andamentoTreno per treno fissato,
+        #    elaborati appena arrivano e riprogrammati in base a quanto è probabile un cambio.
+        #    Le risorse non raggiungibili vengono saltate senza toccare lo stato dei loro treni:
+        #    un disservizio upstream non diventa un cambio di stato di massa
+        unavailable = 0
+        async for (kind, key), data in _poll_resources(due_boards, due_pinned):
+            if data is UNAVAILABLE:
+                unavailable += 1
+                poll_planner.reschedule((kind, key), unavailable_interval())
+            elif kind == "board":
+                relevant = _dispatch_board(tick, due_boards[key], data)
+                poll_planner.reschedule((kind, key), board_interval(poll_planner, (kind, key), relevant))
             else:
-                # Altrimenti controlla tutte le partenze e filtra per destinazione
-                deps = get_departures(rt.departure_code)
-                for tr in deps:
-                    dest = (tr.get("destinazione") or "").strip().lower()
-                    if dest != rt.arrival_name.strip().lower():
-                        continue
-                    train_code = str(tr.get("numeroTreno"))
-                    _handle_status(db, rt, tr, train_code)
+                if data:
+                    for rt in due_pinned[key]:
+                        _handle_status(tick, rt, data, key[1])
+                poll_planner.reschedule((kind, key), train_interval(poll_planner, (kind, key), data))
+
+        # 🔹 Scritture del tick in blocco: storico, stato corrente e giornate di servizio.
+        #    Se nel frattempo un lease è scaduto (tick troppo lungo, pausa del processo)
+        #    un altro poller può aver già preso lo shard: il tick viene scartato
+        #    senza scrivere né notificare.
+        tick.batch.flush()
+        if not lease_manager.confirm(db, owned):
+            db.rollback()
+            print("[SCHEDULER] Lease perso durante il tick, scritture e notifiche annullate")
+            outcome = "lease_lost"
+            return stats
         db.commit()
+        payload_fingerprints.update(tick.fingerprints)
+        day_tracker.mark(tick.first_sightings)
+        status_cache.invalidate_many(tick.changed_routes)
+        for event in tick.events:
+            event_broker.publish(*event)
+        for dedup_key, token, msg in tick.notifications:
+            if get_dispatcher().enqueue(token, "TrainWatcher", msg, key=dedup_key):
+                print(f"[NOTIFY] {dedup_key[1]}: {dedup_key[2]}")
+
+        stats["routes"] = len(routes)
+        stats["tracked"] = len(poll_planner)
+        stats["due"] = len(due)
+        stats["upstream_calls"] = len(due_boards) + len(due_pinned)
+        stats["unavailable"] = unavailable
+        stats["saved_calls"] = len(due_routes) - stats["upstream_calls"]
+        stats["trains"] = tick.trains
+        stats["skipped"] = tick.skipped
+        stats["skip_ratio"] = round(tick.skipped / tick.trains, 3) if tick.trains else 0.0
+        stats["duration_s"] = round(time.perf_counter() - started, 3)
+        stats["writes"] = tick.batch.written
+        stats["shards"] = sorted(owned)
+        outcome = "upstream_down" if due and unavailable == len(due) else "ok"
+
+        metrics.ROUTES_PROCESSED.inc(len(due_routes))
+        metrics.TRAINS_PROCESSED.inc(tick.trains)
+        metrics.TRAINS_SKIPPED.inc(tick.skipped)
+        metrics.LAST_TICK_ROUTES.set(len(due_routes))
+        metrics.LAST_TICK_TRAINS.set(tick.trains)
+        metrics.STATE_CHANGES.inc(len(tick.events))
+        print(
+            f"[SCHEDULER] Tick: {stats['routes']} tratte, {stats['due']}/{stats['tracked']} risorse dovute, "
+            f"{stats['upstream_calls']} chiamate upstream ({stats['saved_calls']} risparmiate, "
+            f"{stats['unavailable']} non disponibili), "
+            f"{stats['skipped']}/{stats['trains']} treni invariati saltati in {stats['duration_s']}s"
+        )
     except Exception as e:
         db.rollback()
         print(f"[SCHEDULER] error: {e}")
     finally:
         db.close()
+        metrics.TICKS.labels(outcome).inc()
+        metrics.TICK_DURATION.observe(time.perf_counter() - started)
+        metrics.TICK_DB_SECONDS.observe(metrics.db_time())
+    return stats
 
 
-def _handle_status(db: Session, rt: Route, data: dict, train_code: str):
-    status, delay = normalize_status(data)
+def _check_routes() -> dict:
+    """Job dello scheduler: esegue un tick completo in un event loop dedicato."""
+    stats = asyncio.run(_check_routes_async())
+    heartbeat.record_tick(stats)
+    return stats
 
-    # leggi ultimo record per la tratta/treno
-    last: Train | None = (
-        db.query(Train)
-        .filter(Train.route_id == rt.id, Train.train_code == train_code)
-        .order_by(Train.last_update.desc())
-        .first()
-    )
 
+def _handle_status(tick: _Tick, rt: Route, data: TrainRecord, train_code: str):
+    db = tick.db
+    tick.trains += 1
+    key = (rt.id, train_code)
+    now = datetime.utcnow()
+    first_today = day_tracker.first_sighting(key, now.date())
+    if first_today:
+        tick.first_sightings.append((key, now.date()))
+
+    # payload identico a quello dell'ultimo tick confermato (e stato in DB invariato):
+    # nessuna normalizzazione, scrittura o notifica
+    fp = fingerprint(data)
+    if not first_today and payload_fingerprints.unchanged(key, fp, tick.states):
+        tick.skipped += 1
+        return
+
+    norm = normalize_status(data)
+    status, delay = norm["status"], norm["delay"]
+    tick.fingerprints[key] = (fp, (status, delay))
+
+    # confronta con lo stato corrente caricato a inizio tick (nessuna lettura dallo storico)
     changed = False
-    if not last or last.last_status != status or last.delay_minutes != delay:
+    if tick.states.get(key) != (status, delay):
         changed = True
-        new_row = Train(
-            route_id=rt.id,
-            train_code=train_code,
-            last_status=status,
-            delay_minutes=delay,
-            last_update=datetime.utcnow(),
-        )
-        db.add(new_row)
+        tick.states[key] = (status, delay)
+        tick.changed_routes.add(rt.id)
+        tick.batch.add_train(rt.id, train_code, status, delay, now)
+        tick.events.append((rt.id, train_code, status, delay, now))
+    elif first_today:
+        # stato invariato da ieri: la giornata di servizio va comunque contata nelle statistiche
+        tick.batch.add_day(rt.id, train_code, status, delay, now)
 
     # se lo stato è cambiato, invia notifica
     if changed:
@@ -72,37 +261,60 @@ def _handle_status(db: Session, rt: Route, data: dict, train_code: str):
             event = "ripristino"
             msg = f"Treno {train_code} tornato in orario ({rt.departure_name} → {rt.arrival_name})."
 
-        # controllo anti-duplicato (evita spam su stesso stato)
-        last_log = (
-            db.query(NotificationLog)
-            .filter_by(route_id=rt.id, train_code=train_code, event_type=event)
-            .order_by(NotificationLog.sent_at.desc())
-            .first()
-        )
-        if last_log and (datetime.utcnow() - last_log.sent_at).total_seconds() < 600:
+        # controllo anti-duplicato in memoria (evita spam su stesso stato): comprende
+        # anche le notifiche ancora in coda o in retry, prenotate all'accodamento
+        dedup_key = (rt.id, train_code, event)
+        if notification_window.seen_recently(dedup_key):
+            metrics.NOTIFICATIONS_SKIPPED.labels("dedup").inc()
             print(f"[SKIP] Notifica recente per {train_code} ({event})")
             return
 
+        # invio asincrono: la notifica viene accodata dopo il commit del tick, che non attende Firebase;
+        # l'accodamento prenota la finestra anti-duplicato, il log viene scritto a consegna avvenuta
         user = db.query(User).get(rt.user_id)
         if user and user.firebase_token:
-            ok = send_push_notification(user.firebase_token, "TrainWatcher", msg)
-            if ok:
-                db.add(
-                    NotificationLog(
-                        route_id=rt.id,
-                        train_code=train_code,
-                        event_type=event,
-                        sent_at=datetime.utcnow(),
-                    )
-                )
-                print(f"[NOTIFY] {train_code}: {event}")
+            tick.notifications.append((dedup_key, user.firebase_token, msg))
         else:
+            metrics.NOTIFICATIONS_SKIPPED.labels("no_token").inc()
             print(f"[SKIP] Nessun token per utente {rt.user_id}")
 
 
+def configure_scheduler(sched: BaseScheduler, interval_minutes: int, mode: str) -> BaseScheduler:
+    """
+    Registra i job del poller su uno scheduler APScheduler (in background nell'API
+    oppure bloccante nel worker dedicato).
+    Con il polling adattivo il job gira ogni poll_tick_seconds e interroga solo le risorse scadute;
+    altrimenti ogni risorsa viene controllata ad ogni tick di interval_minutes.
+    Con più poller attivi ognuno interroga solo gli shard di cui detiene il lease.
+    """
+    if settings.adaptive_polling:
+        sched.add_job(_check_routes, "interval", seconds=settings.poll_tick_seconds, coalesce=True, max_instances=1)
+        print(f"[SCHEDULER] Configurato (adattivo, tick ogni {settings.poll_tick_seconds}s)")
+    else:
+        sched.add_job(_check_routes, "interval", minutes=interval_minutes, coalesce=True, max_instances=1)
+        print(f"[SCHEDULER] Configurato ogni {interval_minutes} minuti")
+    sched.add_job(
+        heartbeat.beat, "interval", args=[mode], seconds=settings.worker_heartbeat_seconds,
+        coalesce=True, max_instances=1, next_run_time=datetime.now(),
+    )
+    sched.add_job(
+        maintain_leases, "interval", seconds=max(settings.shard_lease_seconds // 3, 1),
+        coalesce=True, max_instances=1,
+    )
+    if settings.retention_enabled:
+        sched.add_job(
+            retention_job, "interval", minutes=settings.retention_run_minutes,
+            coalesce=True, max_instances=1,
+        )
+    sched.add_job(
+        analytics_job, "interval", minutes=settings.analytics_fold_minutes,
+        coalesce=True, max_instances=1,
+    )
+    return sched
+
+
 def start_scheduler(interval_minutes: int) -> BackgroundScheduler:
-    sched = BackgroundScheduler()
-    sched.add_job(_check_routes, "interval", minutes=interval_minutes, coalesce=True, max_instances=1)
+    sched = configure_scheduler(BackgroundScheduler(), interval_minutes, mode="api")
     sched.start()
-    print(f"[SCHEDULER] Avviato ogni {interval_minutes} minuti")
+    print("[SCHEDULER] Avviato nel processo API")
     return sched
@@ -0,0 +1,147 @@
+# app/services/sharding.py
+
+import math
+import zlib
+from datetime import datetime, timedelta
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from ..config import settings
+from ..db.session import SessionLocal
+from ..models import ShardLease, WorkerHeartbeat
+from .heartbeat import WORKER_ID
+
+
+def shard_of(departure_code: str, shards: int | None = None) -> int:
+    """
+    Shard di una stazione di partenza. Tutte le tratte (e i treni fissati) che partono
+    dalla stessa stazione finiscono nello stesso shard: ogni tabellone viene scaricato
+    da un solo poller e ogni notifica inviata da un solo poller.
+    """
+    shards = shards or settings.poll_shards
+    return zlib.crc32((departure_code or "").encode("utf-8")) % shards
+
+
+class LeaseManager:
+    """
+    Assegnazione degli shard ai poller tramite righe di lease con scadenza (shard_leases).
+    Ogni acquisizione è un UPDATE condizionato (compare-and-set) sulla scadenza,
+    quindi funziona allo stesso modo su Postgres e SQLite. Un poller che si ferma
+    smette di rinnovare: alla scadenza i suoi shard vengono presi dagli altri.
+    Ogni poller punta a ceil(shard / poller vivi) shard e rilascia quelli in eccesso.
+    """
+
+    def __init__(self, owner: str, shards: int | None = None, ttl_seconds: int | None = None):
+        self.owner = owner
+        self.shards = shards or settings.poll_shards
+        self.ttl = timedelta(seconds=ttl_seconds or settings.shard_lease_seconds)
+        self.owned: set[int] = set()
+
+    def _ensure_rows(self, db: Session) -> None:
+        existing = set(db.scalars(select(ShardLease.shard)))
+        missing = [s for s in range(self.shards) if s not in existing]
+        if not missing:
+            return
+        try:
+            db.add_all(ShardLease(shard=s, owner=None, expires_at=datetime.utcnow(), epoch=0) for s in missing)
+            db.commit()
+        except IntegrityError:
+            db.rollback()  # creati nel frattempo da un altro poller
+
+    def _live_pollers(self, db: Session, now: datetime) -> int:
+        threshold = now - timedelta(seconds=settings.worker_heartbeat_timeout_seconds)
+        alive = db.query(WorkerHeartbeat.worker_id).filter(WorkerHeartbeat.last_beat >= threshold).count()
+        return max(alive, 1)
+
+    def renew_and_claim(self, db: Session) -> set[int]:
+        """Rinnova i lease posseduti, rilascia gli shard in eccesso e acquisisce quelli liberi o scaduti."""
+        self._ensure_rows(db)
+        now = datetime.utcnow()
+
+        db.execute(
+            update(ShardLease)
+            .where(ShardLease.owner == self.owner, ShardLease.expires_at > now, ShardLease.shard < self.shards)
+            .values(expires_at=now + self.ttl)
+        )
+        owned = set(db.scalars(
+            select(ShardLease.shard).where(ShardLease.owner == self.owner, ShardLease.expires_at > now)
+        ))
+
+        target = math.ceil(self.shards / self._live_pollers(db, now))
+        if len(owned) > target:
+            extra = sorted(owned)[target:]
+            db.execute(
+                update(ShardLease)
+                .where(ShardLease.shard.in_(extra), ShardLease.owner == self.owner)
+                .values(owner=None, expires_at=now)
+            )
+            owned -= set(extra)
+        elif len(owned) < target:
+            free = db.scalars(
+                select(ShardLease.shard)
+                .where(ShardLease.expires_at <= now, ShardLease.shard < self.shards)
+                .order_by(ShardLease.shard)
+            ).all()
+            for shard in free:
+                if len(owned) >= target:
+                    break
+                claimed = db.execute(
+                    update(ShardLease)
+                    .where(ShardLease.shard == shard, ShardLease.expires_at <= now)
+                    .values(owner=self.owner, expires_at=now + self.ttl, epoch=ShardLease.epoch + 1)
+                ).rowcount
+                if claimed:
+                    owned.add(shard)
+        db.commit()
+
+        if owned != self.owned:
+            print(f"[SHARDS] {self.owner}: shard {sorted(owned)} di {self.shards}")
+        self.owned = owned
+        return owned
+
+    def confirm(self, db: Session, shards: set[int]) -> bool:
+        """
+        Verifica (prolungandoli) di possedere ancora tutti gli shard indicati.
+        Va chiamato prima del commit di un tick: se False il tick va annullato,
+        perché un altro poller potrebbe aver già preso uno degli shard.
+        """
+        if not shards:
+            return True
+        now = datetime.utcnow()
+        renewed = db.execute(
+            update(ShardLease)
+            .where(ShardLease.shard.in_(shards), ShardLease.owner == self.owner, ShardLease.expires_at > now)
+            .values(expires_at=now + self.ttl)
+        ).rowcount
+        return renewed == len(shards)
+
+    def release_all(self, db: Session) -> None:
+        db.execute(
+            update(ShardLease)
+            .where(ShardLease.owner == self.owner)
+            .values(owner=None, expires_at=datetime.utcnow())
+        )
+        db.commit()
+        self.owned = set()
+
+
+# Istanza condivisa del processo
+lease_manager = LeaseManager(WORKER_ID)
+
+
+def maintain_leases() -> None:
+    """Job dello scheduler: rinnova i lease tra un tick e l'altro e ribilancia gli shard."""
+    db = SessionLocal()
+    try:
+        lease_manager.renew_and_claim(db)
+    except Exception as e:
+        db.rollback()
+        print(f"[SHARDS] error: {e}")
+    finally:
+        db.close()
+
+
+def release_leases() -> None:
+    """Rilascia subito gli shard di questo processo (uscita pulita): gli altri poller li prendono al loro tick."""
+    with SessionLocal() as db:
+        lease_manager.release_all(db)
@@ -0,0 +1,62 @@
+# app/services/state_store.py
+
+import threading
+from sqlalchemy.orm import Session
+from ..models import Route, TrainState
+
+# (route_id, train_code) → (stato, ritardo)
+StateMap = dict[tuple[int, str], tuple[str, int]]
+
+
+def load_states(db: Session, route_ids: list[int] | None = None) -> StateMap:
+    """
+    Carica con un'unica query lo stato corrente dei treni delle tratte attive
+    (solo di route_ids, se indicato).
+    """
+    query = (
+        db.query(TrainState.route_id, TrainState.train_code, TrainState.last_status, TrainState.delay_minutes)
+        .join(Route, Route.id == TrainState.route_id)
+        .filter(Route.active.is_(True))
+    )
+    if route_ids is not None:
+        query = query.filter(TrainState.route_id.in_(route_ids))
+    rows = query.all()
+    return {(r.route_id, r.train_code): (r.last_status, r.delay_minutes) for r in rows}
+
+
+
+class FingerprintMap:
+    """
+    Impronta del payload upstream dell'ultimo tick confermato e stato normalizzato che
+    ne è derivato, per (route_id, train_code). Un treno si salta solo se anche lo stato
+    caricato dal DB a inizio tick coincide: scritture di /trains/check o di un altro poller
+    (shard passato di mano) invalidano così l'impronta senza coordinamento tra processi.
+    Aggiornate solo dopo il commit del tick e limitate alle tratte degli shard posseduti.
+    """
+
+    def __init__(self):
+        self._map: dict[tuple[int, str], tuple[tuple, tuple[str, int]]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._map)
+
+    def unchanged(self, key: tuple[int, str], fp: tuple, states: StateMap) -> bool:
+        entry = self._map.get(key)
+        return entry is not None and entry[0] == fp and states.get(key) == entry[1]
+
+    def update(self, fingerprints: dict[tuple[int, str], tuple[tuple, tuple[str, int]]]) -> None:
+        with self._lock:
+            self._map.update(fingerprints)
+
+    def retain(self, route_ids: set[int]) -> None:
+        with self._lock:
+            self._map = {k: v for k, v in self._map.items() if k[0] in route_ids}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._map.clear()
+
+
+# Istanza condivisa del processo
+payload_fingerprints = FingerprintMap()
@@ -0,0 +1,236 @@
+# app/services/station_directory.py
+
+import difflib
+import re
+import threading
+import unicodedata
+from typing import Iterable
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from ..models import Station
+from .http_client import get_client
+
+# Codici regione accettati da elencoStazioni (0 = estero/varie)
+REGION_CODES = range(0, 23)
+
+# Abbreviazioni puntate da espandere prima della tokenizzazione.
+# Quelle "a iniziale" (P. → Porta, S. → San, Staz. → Stazione) sono già coperte
+# dal match per prefisso di token.
+_ABBREVIATIONS = [
+    (re.compile(r"\bc\.\s*le\b"), "centrale"),
+    (re.compile(r"\bp\.\s*ta\b"), "porta"),
+    (re.compile(r"\bp\.\s*za\b"), "piazza"),
+    (re.compile(r"\bp\.\s*le\b"), "piazzale"),
+    (re.compile(r"\bs\.\s*ta\b"), "santa"),
+    (re.compile(r"\bs\.\s*to\b"), "santo"),
+]
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+
+def normalize_name(name: str) -> list[str]:
+    """Minuscolo, senza accenti, abbreviazioni espanse, suddiviso in token."""
+    text = unicodedata.normalize("NFKD", name)
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    for pattern, full in _ABBREVIATIONS:
+        text = pattern.sub(full, text)
+    return [t for t in _NON_ALNUM.split(text) if t]
+
+
+# ================================
+# 🔹 Indice in memoria
+# ================================
+class _TrieNode:
+    __slots__ = ("children", "ids")
+
+    def __init__(self):
+        self.children: dict[str, "_TrieNode"] = {}
+        self.ids: list[int] = []
+
+
+class StationIndex:
+    """
+    Indice in memoria delle stazioni note:
+    - trie dei token normalizzati per la ricerca per prefisso;
+    - match "ogni token della query è prefisso di un token del nome", che copre
+      accenti e abbreviazioni (es. "P. Susa" → "Torino Porta Susa");
+    - fallback fuzzy (difflib) sui nomi completi per gli errori di battitura.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.loaded = False
+        self._reset()
+
+    def _reset(self) -> None:
+        self._root = _TrieNode()
+        self._stations: list[tuple[str, str, list[str]]] = []   # (nome, codice, token)
+        self._by_norm: dict[str, int] = {}
+        self._by_code: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._stations)
+
+    # ================================
+    # 🔹 Costruzione
+    # ================================
+    def build(self, rows: Iterable[tuple[str, str]]) -> None:
+        with self._lock:
+            self._reset()
+            for name, code in rows:
+                self._add(name, code)
+            self.loaded = True
+
+    def add(self, name: str, code: str) -> None:
+        with self._lock:
+            self._add(name, code)
+
+    def _add(self, name: str, code: str) -> None:
+        tokens = normalize_name(name)
+        norm = " ".join(tokens)
+        if not tokens or norm in self._by_norm:
+            return
+        sid = len(self._stations)
+        self._stations.append((name, code, tokens))
+        self._by_norm[norm] = sid
+        self._by_code.setdefault(code, sid)
+        for token in set(tokens):
+            node = self._root
+            for ch in token:
+                node = node.children.setdefault(ch, _TrieNode())
+            node.ids.append(sid)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reset()
+            self.loaded = False
+
+    # ================================
+    # 🔹 Ricerca
+    # ================================
+    def _prefix_ids(self, prefix: str) -> set[int]:
+        node = self._root
+        for ch in prefix:
+            node = node.children.get(ch)
+            if node is None:
+                return set()
+        found: set[int] = set()
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            found.update(n.ids)
+            stack.extend(n.children.values())
+        return found
+
+    def _score(self, sid: int, query: list[str]) -> tuple:
+        name, _, tokens = self._stations[sid]
+        exact = sum(1 for q in query if q in tokens)
+        starts = 1 if tokens[0].startswith(query[0]) else 0
+        return (-exact, -starts, len(tokens), len(name), name)
+
+    def search(self, q: str, limit: int = 10) -> list[dict]:
+        query = normalize_name(q)
+        if not query:
+            return []
+        with self._lock:
+            # il token più lungo è di solito il più selettivo
+            candidates = None
+            for token in sorted(query, key=len, reverse=True):
+                ids = self._prefix_ids(token)
+                candidates = ids if candidates is None else candidates & ids
+                if not candidates:
+                    break
+            ranked = sorted(candidates or (), key=lambda sid: self._score(sid, query))
+
+            if not ranked:
+                names = list(self._by_norm)
+                close = difflib.get_close_matches(" ".join(query), names, n=limit, cutoff=0.75)
+                ranked = [self._by_norm[n] for n in close]
+
+            return [
+                {"name": self._stations[sid][0], "code": self._stations[sid][1]}
+                for sid in ranked[:limit]
+            ]
+
+    def resolve(self, name: str) -> str | None:
+        """
+        Codice della stazione con esattamente questo nome (dopo la normalizzazione), altrimenti None.
+        Nessun match approssimato: un prefisso o un nome simile indicherebbe la stazione sbagliata,
+        quindi i nomi non noti vanno risolti da Viaggiatreno. La ricerca fuzzy resta in search().
+        """
+        with self._lock:
+            sid = self._by_norm.get(" ".join(normalize_name(name)))
+            return self._stations[sid][1] if sid is not None else None
+
+
+# Istanza condivisa del processo
+station_index = StationIndex()
+
+
+def ensure_index(db: Session) -> StationIndex:
+    """Costruisce l'indice dalla tabella stations al primo utilizzo."""
+    if not station_index.loaded:
+        station_index.build(db.query(Station.name, Station.code).all())
+        print(f"[STATIONS] Indice costruito: {len(station_index)} stazioni")
+    return station_index
+
+
+async def aensure_index(db: AsyncSession) -> StationIndex:
+    """Come ensure_index(), per gli endpoint asincroni."""
+    if not station_index.loaded:
+        station_index.build((await db.execute(select(Station.name, Station.code))).all())
+        print(f"[STATIONS] Indice costruito: {len(station_index)} stazioni")
+    return station_index
+
+
+# ================================
+# 🔹 Caricamento anagrafica
+# ================================
+def fetch_station_directory() -> dict[str, str]:
+    """Scarica l'elenco completo delle stazioni da Viaggiatreno (una richiesta per regione)."""
+    directory: dict[str, str] = {}
+    for region in REGION_CODES:
+        try:
+            data, _ = get_client().get_json(f"elencoStazioni/{region}")
+        except Exception as e:
+            print(f"[WARN] elencoStazioni({region}): {e}")
+            continue
+        for s in data or []:
+            code = s.get("codStazione") or s.get("codiceStazione")
+            name = ((s.get("localita") or {}).get("nomeLungo") or "").strip()
+            if code and name:
+                directory.setdefault(code, name)
+    return directory
+
+
+def load_station_directory(db: Session) -> dict:
+    """
+    Popola la tabella stations con l'anagrafica completa e ricostruisce l'indice.
+    Le stazioni già in cache con lo stesso codice vengono mantenute; i nomi già usati
+    da un'altra stazione non vengono duplicati.
+    """
+    directory = fetch_station_directory()
+    existing_codes = {code for (code,) in db.query(Station.code)}
+    used_names = {name.lower() for (name,) in db.query(Station.name)}
+
+    new_rows = []
+    for code, name in directory.items():
+        if code in existing_codes or name.lower() in used_names:
+            continue
+        used_names.add(name.lower())
+        new_rows.append({"name": name, "code": code})
+
+    if new_rows:
+        db.bulk_insert_mappings(Station, new_rows)
+    db.commit()
+
+    station_index.build(db.query(Station.name, Station.code).all())
+    print(f"[STATIONS] Anagrafica: {len(directory)} scaricate, {len(new_rows)} nuove, indice {len(station_index)}")
+    return {"fetched": len(directory), "inserted": len(new_rows), "indexed": len(station_index)}
+
+
+if __name__ == "__main__":
+    from ..db.session import SessionLocal
+
+    with SessionLocal() as session:
+        load_station_directory(session)
@@ -0,0 +1,112 @@
+# app/services/status_cache.py
+
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+
+class StatusEntry:
+    __slots__ = ("version", "etag", "last_modified", "body")
+
+    def __init__(self, version: datetime, etag: str, last_modified: str, body: bytes):
+        self.version = version
+        self.etag = etag
+        self.last_modified = last_modified
+        self.body = body
+
+
+def make_validators(route_id: int, version: datetime) -> tuple[str, str]:
+    """ETag e Last-Modified derivati dall'ultimo aggiornamento della tratta."""
+    etag = f'W/"{route_id}-{int(version.replace(tzinfo=timezone.utc).timestamp() * 1_000_000)}"'
+    last_modified = format_datetime(version.replace(tzinfo=timezone.utc, microsecond=0), usegmt=True)
+    return etag, last_modified
+
+
+def is_not_modified(etag: str, version: datetime, if_none_match: str | None, if_modified_since: str | None) -> bool:
+    """Valuta le intestazioni condizionali (If-None-Match ha la precedenza, come da RFC 9110)."""
+    if if_none_match:
+        tags = [t.strip() for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags or etag.removeprefix("W/") in tags
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return version.replace(tzinfo=timezone.utc, microsecond=0) <= since
+    return False
+
+
+class StatusCache:
+    """
+    Cache per tratta delle risposte serializzate di /trains/status.
+    Ogni voce è legata alla versione (ultimo aggiornamento) con cui è stata costruita:
+    se la versione nel DB cambia la voce non viene più servita, e lo scheduler
+    la invalida esplicitamente appena scrive un cambio per la tratta.
+    Tiene anche la risoluzione (partenza, arrivo) → route_id per evitare le query ilike;
+    la tratta può essere eliminata da un altro processo, quindi chi legge la risoluzione
+    deve verificare che l'id esista ancora.
+    """
+
+    def __init__(self, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[int, StatusEntry] = OrderedDict()
+        self._routes: dict[tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+    # ================================
+    # 🔹 Risoluzione tratta
+    # ================================
+    @staticmethod
+    def _route_key(from_station: str, to_station: str) -> tuple[str, str]:
+        # stessa semantica della query (ilike sui nomi così come arrivano): niente strip
+        return from_station.lower(), to_station.lower()
+
+    def route_id(self, from_station: str, to_station: str) -> int | None:
+        return self._routes.get(self._route_key(from_station, to_station))
+
+    def remember_route(self, from_station: str, to_station: str, route_id: int) -> None:
+        with self._lock:
+            self._routes[self._route_key(from_station, to_station)] = route_id
+
+    def forget_route(self, route_id: int) -> None:
+        """Da chiamare quando una tratta viene eliminata (o risulta non più esistente)."""
+        with self._lock:
+            self._routes = {k: v for k, v in self._routes.items() if v != route_id}
+            self._entries.pop(route_id, None)
+
+    # ================================
+    # 🔹 Risposte
+    # ================================
+    def get(self, route_id: int, version: datetime) -> StatusEntry | None:
+        with self._lock:
+            entry = self._entries.get(route_id)
+            if entry is None or entry.version != version:
+                return None
+            self._entries.move_to_end(route_id)
+            return entry
+
+    def put(self, route_id: int, version: datetime, body: bytes) -> StatusEntry:
+        etag, last_modified = make_validators(route_id, version)
+        entry = StatusEntry(version, etag, last_modified, body)
+        with self._lock:
+            self._entries[route_id] = entry
+            self._entries.move_to_end(route_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, route_id: int) -> None:
+        with self._lock:
+            self._entries.pop(route_id, None)
+
+    def invalidate_many(self, route_ids) -> None:
+        with self._lock:
+            for rid in route_ids:
+                self._entries.pop(rid, None)
+
+
+# Istanza condivisa del processo
+status_cache = StatusCache()
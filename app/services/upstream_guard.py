@@ -0,0 +1,128 @@
+# app/services/upstream_guard.py
+
+import threading
+import time
+from ..config import settings
+from .metrics import collector
+
+
+class TokenBucket:
+    """
+    Limite globale di richieste al secondo verso Viaggiatreno, condiviso da scheduler e API.
+    Ogni tentativo prenota un token; se non ce ne sono il chiamante attende il tempo
+    restituito da reserve() (time.sleep o asyncio.sleep, a seconda del contesto).
+    rate <= 0 disattiva il limite.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: float | None = None) -> float | None:
+        """
+        Prenota un token e restituisce l'attesa necessaria (0 se disponibile subito).
+        Se l'attesa supererebbe max_wait non prenota nulla e restituisce None.
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self._tokens -= 1
+            return wait
+
+
+class CircuitBreaker:
+    """
+    Interruttore per famiglia di endpoint (partenze, andamentoTreno, ...):
+    - closed: le richieste passano, si contano i fallimenti consecutivi;
+    - open: dopo failure_threshold fallimenti le richieste falliscono subito per reset_seconds;
+    - half_open: trascorso reset_seconds passa una sola richiesta di prova,
+      che richiude il circuito se riesce o lo riapre se fallisce.
+    Un fallimento è una richiesta che ha esaurito i retry (rete, timeout, 5xx, 429);
+    la rinuncia per limite di richieste locale non conta.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, ok: bool | None) -> None:
+        """Esito di una richiesta ammessa; None = nessun esito (es. limite locale), libera solo la prova."""
+        with self._lock:
+            self._probing = False
+            if ok is None:
+                return
+            if ok:
+                self.state, self.failures = self.CLOSED, 0
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"[UPSTREAM] Circuito aperto dopo {self.failures} fallimenti consecutivi")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def retry_after(self) -> float:
+        """Secondi prima che il circuito accetti una nuova prova."""
+        with self._lock:
+            if self.state != self.OPEN:
+                return self.reset_seconds
+            return max(self.reset_seconds - (time.monotonic() - self._opened_at), 0.0)
+
+
+class BreakerBoard:
+    """Interruttori per famiglia di endpoint, creati al primo uso."""
+
+    def __init__(self):
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, family: str) -> CircuitBreaker:
+        breaker = self._breakers.get(family)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(
+                    family, CircuitBreaker(settings.breaker_failure_threshold, settings.breaker_reset_seconds)
+                )
+        return breaker
+
+    def states(self) -> dict[str, int]:
+        """0 = closed, 1 = half_open, 2 = open (per le metriche)."""
+        codes = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+        return {family: codes[b.state] for family, b in list(self._breakers.items())}
+
+
+# Istanze condivise del processo
+rate_limiter = TokenBucket(settings.upstream_rate_limit, settings.upstream_rate_burst)
+breakers = BreakerBoard()
+
+collector(
+    "trainwatcher_upstream_breaker_state", "Stato del circuito per famiglia di endpoint (0 closed, 1 half_open, 2 open)",
+    "gauge", "endpoint", breakers.states,
+)
@@ -1,60 +1,132 @@
-import requests
+import asyncio
+import sys
+import httpx
 from typing import List, Dict, Optional
+from urllib.parse import urlsplit
 from sqlalchemy.orm import Session
+from ..config import settings
 from ..models import Station
+from .cache import response_cache
+from .http_client import UpstreamError, UpstreamUnavailable, get_client
+from .station_directory import ensure_index, station_index
+
+# ================================
+# 🔹 Record compatto di un treno
+# ================================
+class TrainRecord:
+    """
+    Proiezione di un treno upstream (voce del tabellone partenze o risposta di andamentoTreno)
+    sui soli campi usati dal backend. I dict completi, con decine di campi (e l'elenco delle
+    fermate per andamentoTreno), vengono scartati subito dopo la decodifica: in cache e durante
+    il tick restano solo questi record.
+    """
+    __slots__ = (
+        "train_code", "destination", "destination_code", "delay", "cancelled",
+        "departure_ms", "arrival_ms", "arrived",
+    )
+
+    def __init__(self, raw: dict):
+        self.train_code = str(raw.get("numeroTreno"))
+        self.destination = (raw.get("destinazione") or "").strip()
+        self.destination_code = raw.get("codDestinazione") or ""
+        self.delay = int(raw.get("ritardo") or 0)
+        self.cancelled = raw.get("provvedimento") == 1
+        self.departure_ms = raw.get("orarioPartenza")
+        self.arrival_ms = raw.get("orarioArrivo")
+        self.arrived = bool(raw.get("arrivato"))
+
+    def __repr__(self) -> str:
+        return f"TrainRecord({self.train_code} → {self.destination}, delay={self.delay}, cancelled={self.cancelled})"
+
+
+def project_board(data) -> List[TrainRecord]:
+    return [TrainRecord(t) for t in data or ()]
+
+
+def project_train(data) -> TrainRecord | None:
+    return TrainRecord(data) if data else None
 
-BASE_URL = "https://www.viaggiatreno.it/infomobilita/resteasy/viaggiatreno"
 
 # ================================
 # 🔹 Utility di normalizzazione
 # ================================
-def normalize_status(train: dict) -> dict:
+def fingerprint(train: TrainRecord) -> tuple:
+    """
+    Impronta compatta di un treno upstream: uguale tra due tick ⇒ stessa normalizzazione.
+    Contiene i campi letti da normalize_status: se cambia la normalizzazione va aggiornata.
+    """
+    return (train.delay, train.cancelled)
+
+def normalize_status(train: TrainRecord) -> dict:
     """
     Pulisce e normalizza lo stato di un treno Trenitalia.
     """
-    delay = int(train.get("ritardo", 0))
-    provv = train.get("provvedimento", 0)
     stato = (
-        "Cancellato" if provv == 1
-        else "Ritardo" if delay > 0
+        "Cancellato" if train.cancelled
+        else "Ritardo" if train.delay > 0
         else "In orario"
     )
 
     return {
-        "train_code": str(train.get("numeroTreno")),
+        "train_code": train.train_code,
         "status": stato,
-        "delay": delay,
+        "delay": train.delay,
     }
 
+
+def _resident_size(value) -> int:
+    """Stima della memoria occupata dal valore in cache (record proiettati, non il body upstream)."""
+    if isinstance(value, list):
+        return sys.getsizeof(value) + sum(_resident_size(v) for v in value)
+    if isinstance(value, TrainRecord):
+        return sys.getsizeof(value) + sum(sys.getsizeof(getattr(value, f)) for f in TrainRecord.__slots__)
+    return sys.getsizeof(value)
+
+
+def _projected(loaded: tuple, project) -> tuple:
+    """
+    Applica la proiezione al risultato (dati, byte ricevuti) di un loader della cache e
+    restituisce (valore, memoria stimata del valore): il tetto della cache conta ciò che tiene.
+    """
+    data, _ = loaded
+    value = project(data)
+    return value, _resident_size(value)
+
 # ================================
 # 🔹 Codice stazione
 # ================================
-import requests
+def _parse_station_code(name: str, text: str) -> str | None:
+    """
+    Estrae il codice dalla prima riga della risposta di autocompletaStazione.
+    La risposta è testo, es: "TORINO PORTA SUSA|S00035|TORINO P. SUSA|Torino\n..."
+    """
+    lines = text.strip().split("\n")
+    if not lines:
+        return None
+
+    first = lines[0].split("|")
+    if len(first) >= 2:
+        return first[1].strip()
+
+    print(f"[WARN] Formato non riconosciuto per {name}: {text}")
+    return None
+
 
 def get_station_code(name: str) -> str | None:
     """
     Restituisce il codice Viaggiatreno (es. 'S00035') cercando per nome stazione.
     """
-    base_url = "https://www.viaggiatreno.it/infomobilita/resteasy/viaggiatreno/autocompletaStazione/"
+    path = f"autocompletaStazione/{name}"
     try:
-        resp = requests.get(f"{base_url}{name}", timeout=5)
-        if not resp.ok or not resp.text.strip():
+        text = response_cache.get_or_load(path, lambda: _projected(get_client().get_text(path), lambda t: t))
+        if not text.strip():
             print(f"[WARN] Nessuna risposta valida per {name}")
             return None
 
-        # La risposta è testo, es: "TORINO PORTA SUSA|S00035|TORINO P. SUSA|Torino\n..."
-        lines = resp.text.strip().split("\n")
-        if not lines:
-            return None
-
-        first = lines[0].split("|")
-        if len(first) >= 2:
-            code = first[1].strip()
-            return code
-
-        print(f"[WARN] Formato non riconosciuto per {name}: {resp.text}")
-        return None
+        return _parse_station_code(name, text)
 
+    except UpstreamUnavailable:
+        raise
     except Exception as e:
         print(f"[ERROR] get_station_code({name}): {e}")
         return None
@@ -64,46 +136,44 @@ def get_station_code(name: str) -> str | None:
 # ================================
 # 🔹 Elenco partenze
 # ================================
-def get_departures(station_code: str) -> List[dict]:
+def get_departures(station_code: str, allow_stale: bool = True) -> List[TrainRecord]:
     """
     Restituisce la lista di treni in partenza da una determinata stazione.
+    Lista vuota = nessun treno (o stazione sconosciuta); se Viaggiatreno non risponde
+    solleva UpstreamUnavailable, come tutte le funzioni di questo modulo.
     """
+    path = f"partenze/{station_code}"
     try:
-        url = f"{BASE_URL}/partenze/{station_code}"
-        resp = requests.get(url, timeout=10)
-        resp.raise_for_status()
-        return resp.json()
+        return response_cache.get_or_load(
+            path, lambda: _projected(get_client().get_json(path), project_board), allow_stale
+        )
+    except UpstreamUnavailable:
+        raise
     except Exception:
         return []
 
 # ================================
 # 🔹 Stato singolo treno
 # ================================
-def get_train_status(departure_code: str, train_number: str) -> dict | None:
+def get_train_status(departure_code: str, train_number: str) -> TrainRecord | None:
     """
     Interroga Viaggiatreno per ottenere lo stato di un treno specifico.
     Esempio endpoint:
     https://www.viaggiatreno.it/infomobilita/resteasy/viaggiatreno/andamentoTreno/S00035/4659
     """
-    url = f"https://www.viaggiatreno.it/infomobilita/resteasy/viaggiatreno/andamentoTreno/{departure_code}/{train_number}"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                      "AppleWebKit/537.36 (KHTML, like Gecko) "
-                      "Chrome/120.0 Safari/537.36"
-    }
-
+    path = f"andamentoTreno/{departure_code}/{train_number}"
     try:
-        resp = requests.get(url, headers=headers, timeout=8)
-        if not resp.ok:
-            print(f"[WARN] get_train_status({train_number}): {resp.status_code}")
-            return None
-
-        data = resp.json()
+        data = response_cache.get_or_load(path, lambda: _projected(get_client().get_json(path), project_train))
         if not data:
             print(f"[WARN] Nessun dato per treno {train_number}")
             return None
 
         return data
+    except UpstreamUnavailable:
+        raise
+    except UpstreamError as e:
+        print(f"[WARN] get_train_status({train_number}): {e.status}")
+        return None
     except Exception as e:
         print(f"[ERROR] get_train_status({train_number}): {e}")
         return None
@@ -111,40 +181,156 @@ def get_train_status(departure_code: str, train_number: str) -> dict | None:
 # ================================
 # 🔹 Treni per tratta (principale)
 # ================================
-def get_trains_for_route(departure_code: str, arrival_code: str) -> List[Dict]:
+def get_trains_for_route(departure_code: str, arrival_code: str, allow_stale: bool = True) -> List[Dict]:
     """
     Restituisce tutti i treni che collegano due stazioni specifiche (es. Pinerolo → Torino Porta Susa).
+    allow_stale=False quando il risultato viene scritto come stato corrente.
     """
-    departures = get_departures(departure_code)
+    departures = get_departures(departure_code, allow_stale)
     if not departures:
         return []
 
     result = []
+    arrival = arrival_code.lower()
     for t in departures:
-        dest = t.get("codDestinazione")
-        if dest and dest.lower() == arrival_code.lower():
+        if t.destination_code and t.destination_code.lower() == arrival:
             result.append(normalize_status(t))
 
     return result
 
 def get_or_cache_station_code(name: str, db: Session) -> str | None:
     """
-    Restituisce il codice stazione da cache (DB) o lo scarica da Viaggiatreno e lo memorizza.
+    Restituisce il codice stazione dall'indice locale (anagrafica in DB) oppure
+    lo scarica da Viaggiatreno e lo memorizza.
     """
-    # 🔹 Cerca nel DB
-    station = db.query(Station).filter(Station.name.ilike(name)).first()
-    if station:
-        return station.code
+    # 🔹 Cerca nell'indice locale (nessuna chiamata di rete)
+    code = ensure_index(db).resolve(name)
+    if code:
+        return code
 
     # 🔹 Se non trovata, chiama le API Viaggiatreno
     code = get_station_code(name)
     if not code:
         return None
 
-    # 🔹 Salva nel DB per le prossime richieste
-    new_station = Station(name=name, code=code)
-    db.add(new_station)
-    db.commit()
-    db.refresh(new_station)
+    # 🔹 Salva nel DB per le prossime richieste (il codice potrebbe essere già noto con un altro nome)
+    if not db.query(Station.id).filter(Station.code == code).first():
+        db.add(Station(name=name, code=code))
+        db.commit()
+    station_index.add(name, code)
+
+    return code
 
-    return code
\ No newline at end of file
+
+# ================================
+# 🔹 Client asincrono (polling concorrente)
+# ================================
+class AsyncViaggiatreno:
+    """
+    Client asincrono per Viaggiatreno con concorrenza limitata (globale e per host)
+    e deadline per singola richiesta. Va usato come context manager dentro un event loop:
+
+        async with AsyncViaggiatreno() as vt:
+            deps = await vt.get_departures("S00035")
+
+    Gli errori vengono gestiti come nelle funzioni sincrone (lista vuota / None);
+    deadline superata e upstream non disponibile sollevano UpstreamUnavailable.
+    Con allow_stale=False (scheduler) le voci di cache scadute non vengono servite.
+    """
+
+    def __init__(
+        self,
+        concurrency: int | None = None,
+        per_host: int | None = None,
+        deadline: float | None = None,
+        allow_stale: bool = True,
+    ):
+        self.concurrency = concurrency or settings.upstream_concurrency
+        self.per_host = per_host or settings.upstream_per_host_limit
+        self.deadline = deadline or settings.upstream_deadline_seconds
+        self.allow_stale = allow_stale
+        self._global: asyncio.Semaphore | None = None
+        self._hosts: dict[str, asyncio.Semaphore] = {}
+        self._client: httpx.AsyncClient | None = None
+
+    async def __aenter__(self) -> "AsyncViaggiatreno":
+        self._global = asyncio.Semaphore(self.concurrency)
+        self._client = get_client().async_client(self.concurrency, self.per_host)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self._client.aclose()
+        self._client = None
+
+    def _host_slot(self, path: str) -> asyncio.Semaphore:
+        host = urlsplit(get_client().url(path)).netloc
+        sem = self._hosts.get(host)
+        if sem is None:
+            sem = self._hosts[host] = asyncio.Semaphore(self.per_host)
+        return sem
+
+    async def _cached(self, path: str, text: bool = False, project=None):
+        """
+        Legge la risorsa dalla cache condivisa; in caso di miss la scarica occupando uno slot.
+        La deadline vale per la richiesta (retry compresi), non per l'attesa di uno slot libero.
+        Con project la risposta JSON viene proiettata prima di entrare in cache.
+        """
+        client = get_client()
+        fetch, afetch = (client.get_text, client.aget_text) if text else (client.get_json, client.aget_json)
+        project = project or (lambda data: data)
+
+        async def aload():
+            async with self._global, self._host_slot(path):
+                loaded = await asyncio.wait_for(afetch(self._client, path), timeout=self.deadline)
+            return _projected(loaded, project)
+
+        return await response_cache.aget_or_load(
+            path, aload, lambda: _projected(fetch(path), project), self.allow_stale
+        )
+
+    async def get_departures(self, station_code: str) -> List[TrainRecord]:
+        try:
+            return await self._cached(f"partenze/{station_code}", project=project_board)
+        except asyncio.TimeoutError:
+            print(f"[WARN] get_departures({station_code}): deadline superata")
+            raise UpstreamUnavailable(f"partenze/{station_code}", "deadline superata")
+        except UpstreamUnavailable:
+            raise
+        except Exception:
+            return []
+
+    async def get_train_status(self, departure_code: str, train_number: str) -> TrainRecord | None:
+        try:
+            data = await self._cached(f"andamentoTreno/{departure_code}/{train_number}", project=project_train)
+            if not data:
+                print(f"[WARN] Nessun dato per treno {train_number}")
+                return None
+
+            return data
+        except asyncio.TimeoutError:
+            print(f"[WARN] get_train_status({train_number}): deadline superata")
+            raise UpstreamUnavailable(f"andamentoTreno/{departure_code}/{train_number}", "deadline superata")
+        except UpstreamUnavailable:
+            raise
+        except UpstreamError as e:
+            print(f"[WARN] get_train_status({train_number}): {e.status}")
+            return None
+        except Exception as e:
+            print(f"[ERROR] get_train_status({train_number}): {e}")
+            return None
+
+    async def get_station_code(self, name: str) -> str | None:
+        try:
+            text = await self._cached(f"autocompletaStazione/{name}", text=True)
+            if not text.strip():
+                print(f"[WARN] Nessuna risposta valida per {name}")
+                return None
+            return _parse_station_code(name, text)
+        except asyncio.TimeoutError:
+            print(f"[WARN] get_station_code({name}): deadline superata")
+            raise UpstreamUnavailable(f"autocompletaStazione/{name}", "deadline superata")
+        except UpstreamUnavailable:
+            raise
+        except Exception as e:
+            print(f"[ERROR] get_station_code({name}): {e}")
+            return None
@@ -0,0 +1,52 @@
+# app/worker.py
+
+import signal
+from apscheduler.schedulers.blocking import BlockingScheduler
+from prometheus_client import start_http_server
+from .config import settings
+from .db.init_db import init_db
+from .db.session import SessionLocal
+from .services import heartbeat
+from .services.dedup import notification_window
+from .services.dispatch import get_dispatcher
+from .services.scheduler import configure_scheduler
+from .services.sharding import release_leases
+
+
+def main() -> None:
+    """
+    Poller dedicato: esegue il polling Viaggiatreno e l'invio delle notifiche
+    in un processo separato dall'API (che va avviata con RUN_SCHEDULER_IN_API=false).
+    Uso: python -m app.worker
+    """
+    print(f"[WORKER] Avvio poller TrainWatcher ({heartbeat.WORKER_ID})...")
+    init_db()
+    with SessionLocal() as db:
+        notification_window.warm(db)
+    get_dispatcher()
+    if settings.worker_metrics_port:
+        # il worker non ha un server HTTP proprio, ma è lì che girano tick, chiamate upstream e notifiche
+        start_http_server(settings.worker_metrics_port)
+        print(f"[METRICS] Esposte su :{settings.worker_metrics_port}/metrics")
+
+    sched = configure_scheduler(BlockingScheduler(), settings.scheduler_interval_minutes, mode="worker")
+
+    def _shutdown(signum, frame):
+        print(f"[WORKER] Segnale {signum} ricevuto, arresto in corso...")
+        sched.shutdown(wait=False)
+
+    signal.signal(signal.SIGTERM, _shutdown)
+    signal.signal(signal.SIGINT, _shutdown)
+
+    print("[WORKER] Pronto ✅")
+    try:
+        sched.start()
+    finally:
+        get_dispatcher().stop()
+        release_leases()
+        heartbeat.clear()
+        print("[WORKER] Terminato")
+
+
+if __name__ == "__main__":
+    main()
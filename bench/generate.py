@@ -0,0 +1,80 @@
+# bench/generate.py
+
+import random
+from sqlalchemy.orm import Session
+from app.models import Route, Station, User
+from .mock_server import station_code, station_name
+
+
+def generate(
+    db: Session,
+    users: int,
+    routes: int,
+    stations: int,
+    destinations: int = 5,
+    trains_per_destination: int = 2,
+    pinned_ratio: float = 0.1,
+    seed: int = 42,
+) -> dict:
+    """
+    Popola il DB con N utenti, M tratte e K stazioni sintetiche, coerenti con MockViaggiatreno:
+    ogni tratta va da una stazione a una delle `destinations` successive, e una frazione
+    pinned_ratio segue un singolo treno (andamentoTreno invece del tabellone).
+    Inserimenti in blocco, un commit per tabella.
+    """
+    rng = random.Random(seed)
+
+    db.bulk_insert_mappings(Station, [{"name": station_name(i), "code": station_code(i)} for i in range(stations)])
+    db.bulk_insert_mappings(
+        User, [{"email": f"bench{u}@example.com", "firebase_token": f"bench-token-{u}"} for u in range(users)]
+    )
+    db.commit()
+    user_ids = [uid for (uid,) in db.query(User.id).filter(User.email.like("bench%@example.com"))]
+
+    rows = []
+    for _ in range(routes):
+        dep = rng.randrange(stations)
+        d = rng.randint(1, destinations)
+        arr = (dep + d) % stations
+        train_number = None
+        if rng.random() < pinned_ratio:
+            n = rng.randrange(trains_per_destination)
+            train_number = str(10000 + (dep * destinations + d - 1) * trains_per_destination + n)
+        rows.append({
+            "user_id": rng.choice(user_ids),
+            "departure_name": station_name(dep),
+            "arrival_name": station_name(arr),
+            "departure_code": station_code(dep),
+            "arrival_code": station_code(arr),
+            "train_number": train_number,
+            "active": True,
+        })
+    db.bulk_insert_mappings(Route, rows)
+    db.commit()
+
+    return {
+        "users": users,
+        "routes": routes,
+        "stations": stations,
+        "pinned_routes": sum(1 for r in rows if r["train_number"]),
+        "departure_stations": len({r["departure_code"] for r in rows}),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    from app.db.init_db import init_db
+    from app.db.session import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Dati sintetici per i benchmark (usa DATABASE_URL)")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--routes", type=int, default=1000)
+    parser.add_argument("--stations", type=int, default=200)
+    parser.add_argument("--pinned-ratio", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    init_db()
+    with SessionLocal() as session:
+        print(generate(session, args.users, args.routes, args.stations,
+                       pinned_ratio=args.pinned_ratio, seed=args.seed))
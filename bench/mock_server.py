@@ -0,0 +1,209 @@
+# bench/mock_server.py
+
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+BASE_PATH = "/viaggiatreno"
+
+
+def station_code(i: int) -> str:
+    return f"S{i:05d}"
+
+
+def station_name(i: int) -> str:
+    return f"Stazione {i}"
+
+
+class MockViaggiatreno:
+    """
+    Viaggiatreno finto per i benchmark: K stazioni sintetiche, ognuna con un tabellone
+    di treni diretti alle D stazioni successive (stessa convenzione di bench.generate).
+    I ritardi sono tenuti in memoria e cambiano solo con advance(), così il numero di
+    cambi di stato per tick è controllato (change_rate) e ripetibile (seed).
+    Latenza e tasso di errore (HTTP 503) sono configurabili.
+    """
+
+    def __init__(
+        self,
+        stations: int,
+        destinations: int = 5,
+        trains_per_destination: int = 2,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        change_rate: float = 0.1,
+        seed: int = 42,
+    ):
+        self.stations = stations
+        self.destinations = destinations
+        self.trains_per_destination = trains_per_destination
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.change_rate = change_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._delays: dict[str, int] = {}
+        self._cancelled: set[str] = set()
+        self.calls: Counter[str] = Counter()
+        self.errors: Counter[str] = Counter()
+        self._server: ThreadingHTTPServer | None = None
+
+    # ================================
+    # 🔹 Dati sintetici
+    # ================================
+    def _trains_from(self, i: int) -> list[tuple[str, int]]:
+        """(numero treno, indice stazione di destinazione) dei treni in partenza da i."""
+        trains = []
+        for d in range(1, self.destinations + 1):
+            dest = (i + d) % self.stations
+            for n in range(self.trains_per_destination):
+                trains.append((str(10000 + (i * self.destinations + d - 1) * self.trains_per_destination + n), dest))
+        return trains
+
+    def _train_payload(self, number: str, origin: int, dest: int, now_ms: int) -> dict:
+        offset = int(number) % 180
+        return {
+            "numeroTreno": int(number),
+            "codOrigine": station_code(origin),
+            "destinazione": station_name(dest),
+            "codDestinazione": station_code(dest),
+            "orarioPartenza": now_ms + offset * 60_000,
+            "orarioArrivo": now_ms + (offset + 45) * 60_000,
+            "ritardo": self._delays.get(number, 0),
+            "provvedimento": 1 if number in self._cancelled else 0,
+            "arrivato": False,
+        }
+
+    def advance(self) -> int:
+        """Cambia ritardo (o cancellazione) di una frazione change_rate dei treni. Restituisce i treni cambiati."""
+        changed = 0
+        with self._lock:
+            for i in range(self.stations):
+                for number, _ in self._trains_from(i):
+                    if self._rng.random() >= self.change_rate:
+                        continue
+                    changed += 1
+                    if self._rng.random() < 0.05:
+                        self._cancelled.symmetric_difference_update({number})
+                    else:
+                        self._delays[number] = self._rng.choice((0, 0, 2, 5, 10, 15, 30))
+        return changed
+
+    # ================================
+    # 🔹 Risorse
+    # ================================
+    def handle(self, path: str) -> tuple[int, str, str]:
+        """Restituisce (status, content type, body) per un path relativo a BASE_PATH."""
+        parts = [unquote(p) for p in path.strip("/").split("/")]
+        family = parts[0] if parts else ""
+        self.calls[family] += 1
+        now_ms = int(time.time() * 1000)
+
+        if self.latency_ms or self.jitter_ms:
+            time.sleep(max(0.0, self.latency_ms + self._rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+        if self.error_rate and self._rng.random() < self.error_rate:
+            self.errors[family] += 1
+            return 503, "text/plain", "Service Unavailable"
+
+        if family == "partenze" and len(parts) >= 2:
+            i = self._index(parts[1])
+            if i is None:
+                return 200, "application/json", "[]"
+            with self._lock:
+                board = [self._train_payload(n, i, dest, now_ms) for n, dest in self._trains_from(i)]
+            return 200, "application/json", json.dumps(board)
+
+        if family == "andamentoTreno" and len(parts) >= 3:
+            i = self._index(parts[1])
+            if i is None:
+                return 204, "application/json", ""
+            for number, dest in self._trains_from(i):
+                if number == parts[2]:
+                    with self._lock:
+                        return 200, "application/json", json.dumps(self._train_payload(number, i, dest, now_ms))
+            return 204, "application/json", ""
+
+        if family == "autocompletaStazione" and len(parts) >= 2:
+            query = parts[1].strip().upper()
+            lines = [
+                f"{station_name(i).upper()}|{station_code(i)}"
+                for i in range(self.stations)
+                if station_name(i).upper().startswith(query)
+            ]
+            return 200, "text/plain", "\n".join(lines[:10])
+
+        return 404, "text/plain", "Not Found"
+
+    def _index(self, code: str) -> int | None:
+        if not code.startswith("S") or not code[1:].isdigit():
+            return None
+        i = int(code[1:])
+        return i if i < self.stations else None
+
+    # ================================
+    # 🔹 Server HTTP
+    # ================================
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Avvia il server in un thread e restituisce il base URL da usare come VIAGGIATRENO_BASE_URL."""
+        mock = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if not self.path.startswith(BASE_PATH + "/"):
+                    status, ctype, body = 404, "text/plain", "Not Found"
+                else:
+                    status, ctype, body = mock.handle(self.path[len(BASE_PATH):])
+                data = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="mock-viaggiatreno", daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}{BASE_PATH}"
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def reset_counters(self) -> None:
+        self.calls.clear()
+        self.errors.clear()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Viaggiatreno finto per prove locali")
+    parser.add_argument("--stations", type=int, default=100)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--change-every", type=float, default=60.0, help="secondi tra un advance() e l'altro")
+    args = parser.parse_args()
+
+    mock = MockViaggiatreno(args.stations, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                            error_rate=args.error_rate)
+    print(f"[MOCK] In ascolto su {mock.start(port=args.port)}")
+    try:
+        while True:
+            time.sleep(args.change_every)
+            print(f"[MOCK] {mock.advance()} treni cambiati")
+    except KeyboardInterrupt:
+        mock.stop()
@@ -0,0 +1,194 @@
+# bench/run.py
+"""
+Benchmark dello scheduler contro un Viaggiatreno finto locale.
+
+Esempio (dalla root del repo):
+    python -m bench.run --users 200 --routes 5000 --stations 500 --ticks 5 --latency-ms 30 --out bench.json
+    python -m bench.run ... --baseline bench.json      # exit code 1 se peggiora oltre --tolerance
+
+Senza --database-url usa un SQLite temporaneo; con un Postgres locale serve --reset
+(le tabelle vengono ricreate). Il polling adattivo è disattivato, così ogni tick
+interroga tutte le risorse; la cache upstream viene svuotata prima di ogni tick
+(salvo --keep-cache). L'output è JSON su stdout (e su --out).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from .mock_server import MockViaggiatreno
+
+# metriche confrontate con la baseline (valori più alti = peggio)
+COMPARED = ("wall_s_median", "db_queries_mean", "upstream_calls_mean", "peak_mem_bytes_max")
+
+
+def _parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark di _check_routes contro un Viaggiatreno finto")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--routes", type=int, default=1000)
+    parser.add_argument("--stations", type=int, default=200)
+    parser.add_argument("--pinned-ratio", type=float, default=0.1)
+    parser.add_argument("--ticks", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--change-rate", type=float, default=0.1, help="frazione di treni che cambia tra due tick")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--reset", action="store_true", help="ricrea le tabelle (obbligatorio con --database-url)")
+    parser.add_argument("--keep-cache", action="store_true", help="non svuota la cache upstream tra i tick")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="non misura la memoria allocata (meno overhead)")
+    parser.add_argument("--out", default=None)
+    parser.add_argument("--baseline", default=None, help="JSON di un run precedente da confrontare")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="peggioramento relativo ammesso")
+    return parser.parse_args(argv)
+
+
+def _configure_env(args: argparse.Namespace, base_url: str) -> str:
+    """Variabili lette da Settings e da db.session: vanno impostate prima di importare l'app."""
+    database_url = args.database_url
+    if not database_url:
+        fd, path = tempfile.mkstemp(prefix="trainwatcher-bench-", suffix=".db")
+        os.close(fd)
+        database_url = f"sqlite:///{path}"
+    os.environ.update({
+        "DATABASE_URL": database_url,
+        "VIAGGIATRENO_BASE_URL": base_url,
+        "ADAPTIVE_POLLING": "false",
+        "NOTIFICATION_SENDER": "fake",
+        "HTTP_BACKOFF_BASE": "0.05",
+        "UPSTREAM_RATE_LIMIT": "0",      # misura lo scheduler, non il limite verso Viaggiatreno
+    })
+    return database_url
+
+
+def _summary(ticks: list[dict]) -> dict:
+    # il primo tick parte da train_states vuoto (tutto è un cambio): escluso se ce ne sono altri
+    steady = ticks[1:] if len(ticks) > 1 else ticks
+    walls = sorted(t["wall_s"] for t in steady)
+    return {
+        "ticks_measured": len(steady),
+        "wall_s_median": round(statistics.median(walls), 4),
+        "wall_s_p95": round(walls[min(len(walls) - 1, int(0.95 * len(walls)))], 4),
+        "wall_s_max": round(walls[-1], 4),
+        "upstream_calls_mean": round(statistics.mean(t["upstream_calls"] for t in steady), 1),
+        "db_queries_mean": round(statistics.mean(t["db_queries"] for t in steady), 1),
+        "db_time_s_mean": round(statistics.mean(t["db_time_s"] for t in steady), 4),
+        "state_changes_mean": round(statistics.mean(t["state_changes"] for t in steady), 1),
+        "skip_ratio_mean": round(statistics.mean(t["skip_ratio"] for t in steady), 3),
+        "peak_mem_bytes_max": max(t["peak_mem_bytes"] for t in steady),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _compare(summary: dict, baseline_path: str, tolerance: float) -> list[dict]:
+    with open(baseline_path) as f:
+        baseline = json.load(f)["summary"]
+    regressions = []
+    for key in COMPARED:
+        old, new = baseline.get(key), summary.get(key)
+        if old and new is not None and new > old * (1 + tolerance):
+            regressions.append({"metric": key, "baseline": old, "current": new, "ratio": round(new / old, 3)})
+    return regressions
+
+
+def main(argv=None) -> int:
+    args = _parse_args(argv)
+    if args.database_url and not args.reset:
+        print("--database-url richiede --reset (le tabelle vengono ricreate)", file=sys.stderr)
+        return 2
+
+    mock = MockViaggiatreno(
+        args.stations, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate, change_rate=args.change_rate, seed=args.seed,
+    )
+    database_url = _configure_env(args, mock.start())
+
+    # import dopo la configurazione dell'ambiente
+    from sqlalchemy import event
+    from app.db.init_db import init_db
+    from app.db.session import SessionLocal, engine
+    from app.models import Base
+    from app.services import metrics
+    from app.services.cache import response_cache
+    from app.services.dispatch import get_dispatcher
+    from app.services.scheduler import _check_routes_async
+    from .generate import generate
+
+    Base.metadata.drop_all(bind=engine)
+    init_db()
+    with SessionLocal() as db:
+        dataset = generate(db, args.users, args.routes, args.stations, pinned_ratio=args.pinned_ratio, seed=args.seed)
+
+    queries = {"n": 0}
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        queries["n"] += 1
+
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+
+    ticks = []
+    for i in range(args.ticks):
+        changed = mock.advance() if i else 0
+        mock.reset_counters()
+        if not args.keep_cache:
+            response_cache.clear()
+        queries["n"] = 0
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        enqueued = get_dispatcher().counters["enqueued"]
+
+        started = time.perf_counter()
+        stats = asyncio.run(_check_routes_async())
+        wall = time.perf_counter() - started
+
+        ticks.append({
+            "tick": i,
+            "wall_s": round(wall, 4),
+            "routes": stats["routes"],
+            "upstream_calls": sum(mock.calls.values()),
+            "upstream_by_endpoint": dict(mock.calls),
+            "upstream_errors": sum(mock.errors.values()),
+            "db_queries": queries["n"],
+            "db_time_s": round(metrics.db_time(), 4),
+            "state_changes": stats["writes"].get("states", 0) if stats["writes"] else 0,
+            "skip_ratio": stats["skip_ratio"],
+            "upstream_trains_changed": changed,
+            "notifications_enqueued": get_dispatcher().counters["enqueued"] - enqueued,
+            "peak_mem_bytes": tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0,
+        })
+
+    get_dispatcher().stop()
+    mock.stop()
+
+    report = {
+        "config": {**{k: v for k, v in vars(args).items() if k not in ("out", "baseline")},
+                   "database": database_url.split(":", 1)[0]},
+        "dataset": dataset,
+        "ticks": ticks,
+        "summary": _summary(ticks),
+    }
+    exit_code = 0
+    if args.baseline:
+        report["regressions"] = _compare(report["summary"], args.baseline, args.tolerance)
+        exit_code = 1 if report["regressions"] else 0
+
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())